@@ -42,13 +42,18 @@ setup(
     ],
     extras_require={
         'ccid': ['usb-f-ccid'],
-        'randpin': ['freetype-py', 'gpiochip2', 'jeepney'],
+        'randpin': ['freetype-py', 'gpiochip2', 'ioctl-opt', 'jeepney'],
+        # Faster framebuffer for randpin.
+        'numpy': ['numpy'],
     },
     entry_points={
         'console_scripts': [
             'smartcard-openpgp-testtarget-gnuk = smartcard.app.openpgp.cli.test:gnuk [ccid]',
             'smartcard-openpgp-simple = smartcard.app.openpgp.cli.simple:main [ccid]',
             'smartcard-openpgp-randpin-epaper = smartcard.app.openpgp.cli.randpin.epaper:main [ccid,randpin]',
+            'smartcard-openpgp-benchmark = smartcard.app.openpgp.cli.benchmark:main',
+            'smartcard-openpgp-farm = smartcard.app.openpgp.cli.farm:main',
+            'smartcard-openpgp-vpcd = smartcard.app.openpgp.cli.vpcd:main',
         ],
     },
     classifiers=[
@@ -15,7 +15,10 @@
 # You should have received a copy of the GNU General Public License
 # along with python-smartcard-app-openpgp.  If not, see <http://www.gnu.org/licenses/>.
 
-from collections import defaultdict
+from collections import (
+    OrderedDict,
+    defaultdict,
+)
 import hmac
 import logging
 import os
@@ -23,6 +26,7 @@ import random
 import struct
 import threading
 import time
+import weakref
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.hashes import (
     MD5,
@@ -59,7 +63,13 @@ from smartcard.asn1 import (
 )
 from smartcard import (
     ApplicationFile,
+    Card,
     HISTORICAL_BYTES_CATEGORY_STATUS_RAW,
+    INSTRUCTION_BERTLV_MASK,
+    INSTRUCTION_GENERATE_ASYMMETRIC_KEY_PAIR,
+    INSTRUCTION_GET_CHALLENGE,
+    INSTRUCTION_GET_DATA,
+    INSTRUCTION_GET_RESPONSE,
 )
 from smartcard.status import (
     SUCCESS,
@@ -99,6 +109,18 @@ from smartcard.utils import (
     transaction_manager,
     NamedSingleton,
 )
+from .calibration import (
+    ALGORITHM_PREFILL,
+    ALGORITHM_REJECTED,
+    algorithm_policy,
+    getKeySpec,
+)
+from .events import (
+    EVENT_KEYGEN_END,
+    EVENT_KEYGEN_START,
+    event_ring,
+)
+from .metrics import registry as metrics_registry
 from .tag import (
     AlgorithmAttributesAuthentication,
     AlgorithmAttributesDecryption,
@@ -249,6 +271,12 @@ assert DEFAULT_ALGORITHM_ATTRIBUTES_AUTHENTICATION == b'\x01\x08\x00\x00\x20\x00
 assert DEFAULT_ALGORITHM_ATTRIBUTES_SIGNATURE in ROLE_TO_SUPPORTED_ALGORITHM_INFORMATION_LIST_DICT[KEY_ROLE_SIGN]
 assert DEFAULT_ALGORITHM_ATTRIBUTES_DECRYPTION in ROLE_TO_SUPPORTED_ALGORITHM_INFORMATION_LIST_DICT[KEY_ROLE_DECRYPT]
 assert DEFAULT_ALGORITHM_ATTRIBUTES_AUTHENTICATION in ROLE_TO_SUPPORTED_ALGORITHM_INFORMATION_LIST_DICT[KEY_ROLE_AUTHENTICATE]
+# Always available whatever the algorithm policy, so blank cards are usable.
+DEFAULT_ALGORITHM_ATTRIBUTES_DICT = {
+    AlgorithmAttributesSignature: DEFAULT_ALGORITHM_ATTRIBUTES_SIGNATURE,
+    AlgorithmAttributesDecryption: DEFAULT_ALGORITHM_ATTRIBUTES_DECRYPTION,
+    AlgorithmAttributesAuthentication: DEFAULT_ALGORITHM_ATTRIBUTES_AUTHENTICATION,
+}
 
 # Value received in verify & change reference data
 LEVEL_PW1_SIGN = 1
@@ -314,6 +342,257 @@ ALGORITHM_ATTRIBUTES_TO_FINGERPRINT_AND_CA_AND_TIMESTAMP = {
     ),
 }
 
+# Data objects stored in OpenPGP's card state record rather than in
+# per-data-object persistent lists: they are small and rarely modified.
+COMPACT_DATA_OBJECT_DICT = {
+    x.asTagTuple(): x
+    for x in (
+        AlgorithmAttributesSignature,
+        AlgorithmAttributesDecryption,
+        AlgorithmAttributesAuthentication,
+        KeyDerivedFunction,
+        Private1,
+        Private2,
+        Private3,
+        Private4,
+        Name,
+        LoginData,
+        LanguagePreference,
+        Sex,
+        URL,
+        SignatureKeyFingerprint,
+        DecryptionKeyFingerprint,
+        AuthenticationKeyFingerprint,
+        CAFingerprint1,
+        CAFingerprint2,
+        CAFingerprint3,
+        SignatureKeyTimestamp,
+        DecryptionKeyTimestamp,
+        AuthenticationKeyTimestamp,
+    )
+}
+
+def _replaceItem(value_tuple, index, value):
+    """
+    Return a copy of value_tuple with the item at index replaced by value.
+    """
+    return value_tuple[:index] + (value, ) + value_tuple[index + 1:]
+
+class CompactRecord(persistent.Persistent):
+    """
+    Several values stored as a single ZODB object, so they get loaded, cached
+    and committed together.
+    Values must be immutable (bytes, int, tuple, ...): modify them by assigning
+    a new value, so the record notices the change.
+    """
+    def __init__(self, **kw):
+        super().__init__()
+        for key, value in kw.items():
+            setattr(self, key, value)
+
+class KeyList(list):
+    """
+    A list of keys KeygenService can find again, to enforce its pool depth.
+    """
+    __slots__ = ('__weakref__', )
+
+class KeygenService:
+    """
+    Generates candidate key pairs in a single background thread, on behalf of
+    any number of OpenPGP instances.
+    Keys are generated one at a time, requesters taking turns, so that one
+    card with slow-to-generate key attributes does not starve the others.
+    Only the volatile key and attribute lists of each card are referenced,
+    never the card itself, so cards can be unloaded at any time.
+    """
+    def __init__(self):
+        self.__condition = threading.Condition()
+        # id(key_list) -> (key_list, algorithm_attributes_list)
+        self.__pending_dict = OrderedDict()
+        self.__thread = None
+        # Maximum number of keys generated in advance per key list, None for
+        # no limit.
+        self.__pool_depth = None
+        # id(key_list) -> key_list, for KeyList instances
+        self.__key_list_dict = weakref.WeakValueDictionary()
+        # id(key_list) -> algorithm_attributes_list
+        self.__attributes_list_dict = {}
+        # id(key_list) -> indexes to fill whatever the pool depth
+        self.__demand_dict = defaultdict(set)
+
+    def request(self, key_list, algorithm_attributes_list, demand=None):
+        """
+        Fill any None entry of key_list with a new private key, generated
+        using the attributes at the same index in algorithm_attributes_list.
+        Failing entries get set to False.
+        demand (int, or None)
+            Index of an entry needed now: filled even when the pool depth
+            is reached.
+        """
+        with self.__condition:
+            key_list_id = id(key_list)
+            if (
+                isinstance(key_list, KeyList) and
+                key_list_id not in self.__key_list_dict
+            ):
+                self.__key_list_dict[key_list_id] = key_list
+                self.__attributes_list_dict[
+                    key_list_id
+                ] = algorithm_attributes_list
+                weakref.finalize(key_list, self.__forget, key_list_id)
+            if demand is not None:
+                self.__demand_dict[key_list_id].add(demand)
+            self.__pending_dict.setdefault(
+                key_list_id,
+                (key_list, algorithm_attributes_list),
+            )
+            if self.__thread is None:
+                self.__thread = threading.Thread(
+                    target=self.__run,
+                    name='keygen',
+                    daemon=True,
+                )
+                self.__thread.start()
+            self.__condition.notify()
+
+    def __forget(self, key_list_id):
+        with self.__condition:
+            self.__attributes_list_dict.pop(key_list_id, None)
+            self.__demand_dict.pop(key_list_id, None)
+
+    @staticmethod
+    def __getHeldKeyCount(key_list):
+        return sum(
+            1
+            for key in key_list
+            if key is not None and key is not False
+        )
+
+    def getHeldKeyCount(self):
+        """
+        Return the number of keys generated in advance, in KeyList instances.
+        """
+        with self.__condition:
+            key_list_list = list(self.__key_list_dict.values())
+        return sum(
+            self.__getHeldKeyCount(key_list)
+            for key_list in key_list_list
+        )
+
+    def setPoolDepth(self, depth):
+        """
+        Set the maximum number of keys generated in advance per key list,
+        None for no limit.
+        Keys held in excess, in KeyList instances, are discarded. When the
+        depth increases, such key lists are topped up again.
+        """
+        with self.__condition:
+            previous_depth = self.__pool_depth
+            self.__pool_depth = depth
+            key_list_list = list(self.__key_list_dict.values())
+        for key_list in key_list_list:
+            if depth is not None:
+                held = 0
+                for index, key in enumerate(key_list):
+                    if key is not None and key is not False:
+                        held += 1
+                        if held > depth:
+                            key_list[index] = None
+            if depth is None or (
+                previous_depth is not None and depth > previous_depth
+            ):
+                algorithm_attributes_list = self.__attributes_list_dict.get(
+                    id(key_list),
+                )
+                if algorithm_attributes_list is not None:
+                    self.request(
+                        key_list=key_list,
+                        algorithm_attributes_list=algorithm_attributes_list,
+                    )
+
+    def _newKey(self, attributes): # pylint: disable=no-self-use
+        """
+        Called from the keygen thread to produce a private key.
+        """
+        return attributes.newKey()
+
+    def __run(self):
+        """
+        keygen thread main loop
+        """
+        condition = self.__condition
+        pending_dict = self.__pending_dict
+        while True:
+            with condition:
+                while not pending_dict:
+                    condition.wait()
+                key_list_id, (
+                    key_list,
+                    key_attributes_list,
+                ) = pending_dict.popitem(last=False)
+                pool_depth = self.__pool_depth
+                demand_set = self.__demand_dict.get(key_list_id, ())
+                can_prefetch = (
+                    pool_depth is None or
+                    self.__getHeldKeyCount(key_list) < pool_depth
+                )
+                for index, key in enumerate(key_list):
+                    attributes = key_attributes_list[index]
+                    if (
+                        key is None and
+                        attributes is not None and
+                        (can_prefetch or index in demand_set)
+                    ):
+                        break
+                else:
+                    continue
+                if index in demand_set:
+                    demand_set.discard(index)
+            event_ring.record(EVENT_KEYGEN_START, index, attributes.ID)
+            try:
+                before = time.time()
+                private_key = self._newKey(attributes)
+            except Exception: #pylint: disable=broad-except
+                event_ring.record(EVENT_KEYGEN_END, index, 0)
+                logger.error('Error in keygen thread:', exc_info=1)
+                private_key = False
+            else:
+                event_ring.record(EVENT_KEYGEN_END, index, 1)
+                duration = time.time() - before
+                metrics_registry.histogram(
+                    'smartcard_openpgp_keygen_duration_seconds',
+                    'Time taken to generate a key pair, by algorithm',
+                    algorithm=attributes.__class__.__name__,
+                ).observe(duration)
+                logger.debug(
+                    'keygen: produced key %i in %.2fs',
+                    index,
+                    duration,
+                )
+                if attributes != key_attributes_list[index]:
+                    logger.debug(
+                        'keygen: ...but parameters changed, discarding',
+                    )
+                    private_key = None
+            if private_key is not None:
+                key_list[index] = private_key
+            # Back to the end of the line, for any other missing key.
+            self.request(
+                key_list=key_list,
+                algorithm_attributes_list=key_attributes_list,
+            )
+
+keygen_service = KeygenService()
+_keygen_hit_counter, _keygen_miss_counter = (
+    metrics_registry.counter(
+        'smartcard_openpgp_keygen_requests_total',
+        'On-card key generation requests, by whether a pre-generated key '
+        'was ready',
+        result=result,
+    )
+    for result in ('hit', 'miss')
+)
+
 class OpenPGP(PersistentWithVolatileSurvivor, ApplicationFile):
     # XXX: is min length constraint even a thing ? Or is it the spec telling
     # implementors that their maximum password length must be at least this
@@ -330,9 +609,21 @@ class OpenPGP(PersistentWithVolatileSurvivor, ApplicationFile):
         127, # RESET CODE
     )
     _v_key_list = None
-    __pw1_valid_multiple_signatures = None
-    __signature_counter = None
+    # Rarely-modified state: reference data, private keys, compact data
+    # objects...
+    __card_state = None
+    # Frequently-modified state: reference data counters, signature counter.
+    __counter_state = None
+    _v_storage_upgrade_pending = False
     _has_key_derived_function = True
+    _keygen_service = keygen_service
+    _algorithm_policy = algorithm_policy
+    # Instructions which never modify persistent state, whatever their
+    # parameters.
+    _read_only_instruction_set = frozenset((
+        INSTRUCTION_GET_DATA,
+        INSTRUCTION_GET_RESPONSE,
+    ))
 
     def __init__(self, manufacturer=None, serial=None, **kw):
         if manufacturer is None or serial is None:
@@ -367,24 +658,31 @@ class OpenPGP(PersistentWithVolatileSurvivor, ApplicationFile):
         self.__blank()
 
     def __blank(self):
-        self.__reference_data_list = persistent.list.PersistentList([
+        reference_data = (
             DEFAULT_PW1, # PW1
             DEFAULT_PW3, # PW3 (!)
             DEFAULT_RC,  # PW1 reset code
-        ])
-        self.__reference_data_counter_list = persistent.list.PersistentList([
-            (
-                0
-                if x is None else
-                VERIFICATION_DATA_VALIDITY
-            )
-            for x in self.__reference_data_list
-        ])
-        self.__key_list = persistent.list.PersistentList([None] * 3)
+        )
+        self.__card_state = CompactRecord(
+            reference_data=reference_data,
+            key=(None, ) * 3,
+            key_information=(KEY_INFORMATION_NOT_PRESENT, ) * 3,
+            pw1_valid_multiple_signatures=False,
+            data_object_dict={},
+        )
+        self.__counter_state = CompactRecord(
+            reference_data_counter=tuple(
+                (
+                    0
+                    if x is None else
+                    VERIFICATION_DATA_VALIDITY
+                )
+                for x in reference_data
+            ),
+            signature_counter=0,
+        )
+        self._v_storage_upgrade_pending = False
         self._v_key_list = [None] * 3
-        self.__key_information_list = [
-            KEY_INFORMATION_NOT_PRESENT
-        ] * 3
         self.setStandardCompactSecurity(
             activate=SECURITY_CONDITION_ALLOW,
             # Termination security is handled in terminate().
@@ -421,13 +719,11 @@ class OpenPGP(PersistentWithVolatileSurvivor, ApplicationFile):
                 value=b'',
                 encode=True,
             )
-        self.__pw1_valid_multiple_signatures = False
-        self.__signature_counter = 0
 
     def setupVolatileSurvivors(self):
         # Raspberry pi zero can be slow enough at generating keys that it
         # exceeds gnupg's default 5s timeout, making key generation fail.
-        # So, spawn a thread whose only job is to top up a list of candidate
+        # So, have a thread whose only job is to top up a list of candidate
         # key pairs.
         self._setupEarlyVolatileSurvivors()
         algorithm_attributes_list = self._v_s_algorithm_attributes_list
@@ -437,12 +733,7 @@ class OpenPGP(PersistentWithVolatileSurvivor, ApplicationFile):
                     self.getData(tag, decode=False),
                     codec=CodecBER,
                 )
-        self._v_s_keygen_thread = threading.Thread(
-            target=self._maintainKeyQueue,
-            name='keygen',
-            daemon=True,
-        )
-        self._v_s_keygen_thread.start()
+        self._requestKeygen()
 
     def _setupEarlyVolatileSurvivors(self):
         # Attributes needed by initial __blank call, in which case this is
@@ -454,16 +745,33 @@ class OpenPGP(PersistentWithVolatileSurvivor, ApplicationFile):
         except AttributeError:
             self._v_s_algorithm_attributes_list = [None] * 3
         try:
-            self._v_s_keygen_semaphore
+            self._v_s_keygen_key_list
         except AttributeError:
-            self._v_s_keygen_semaphore = threading.Semaphore(1)
+            self._v_s_keygen_key_list = KeyList([None] * 3)
         try:
-            self._v_s_keygen_key_list
+            self._v_s_prefill_key_list
         except AttributeError:
-            self._v_s_keygen_key_list = [None] * 3
+            # Keys for algorithms too slow to generate on demand, generated
+            # in advance, one per key spec.
+            prefill_list = self._algorithm_policy.getPrefillList()
+            self._v_s_prefill_key_spec_list = [
+                key_spec
+                for key_spec, _, _ in prefill_list
+            ]
+            self._v_s_prefill_attributes_list = [
+                tag.getAlgorithmObject(attributes, codec=CodecBER)
+                for _, tag, attributes in prefill_list
+            ]
+            self._v_s_prefill_key_list = KeyList([None] * len(prefill_list))
 
     def __setstate__(self, state):
+        if '_OpenPGP__card_state' not in state:
+            state = self.__upgradeState(state)
+            upgrade_pending = True
+        else:
+            upgrade_pending = False
         super().__setstate__(state)
+        self._v_storage_upgrade_pending = upgrade_pending
         self._v_key_list = [
             (
                 None
@@ -473,9 +781,153 @@ class OpenPGP(PersistentWithVolatileSurvivor, ApplicationFile):
                     password=None,
                 )
             )
-            for private_key in self.__key_list
+            for private_key in self.__card_state.key
         ]
 
+    @staticmethod
+    def __upgradeState(state):
+        """
+        Convert the state of an instance stored with one persistent object per
+        list and per data object into the compact record layout.
+        The original persistent objects are left untouched: see
+        __prepareStateChange.
+        """
+        state = state.copy()
+        reference_data_counter = tuple(
+            state.pop('_OpenPGP__reference_data_counter_list'),
+        )
+        signature_counter = state.pop('_OpenPGP__signature_counter', 0)
+        state['_OpenPGP__counter_state'] = CompactRecord(
+            reference_data_counter=reference_data_counter,
+            signature_counter=signature_counter or 0,
+        )
+        base_data_object_dict = state['_BaseFile__data_object_dict']
+        state['_OpenPGP__card_state'] = CompactRecord(
+            reference_data=tuple(state.pop('_OpenPGP__reference_data_list')),
+            key=tuple(state.pop('_OpenPGP__key_list')),
+            key_information=tuple(
+                state.pop('_OpenPGP__key_information_list'),
+            ),
+            pw1_valid_multiple_signatures=bool(state.pop(
+                '_OpenPGP__pw1_valid_multiple_signatures',
+                False,
+            )),
+            data_object_dict={
+                tag_tuple: tuple(value_list)
+                for tag_tuple, value_list in base_data_object_dict.items()
+                if tag_tuple in COMPACT_DATA_OBJECT_DICT
+            },
+        )
+        return state
+
+    def __prepareStateChange(self):
+        """
+        To be called before any modification of the compact records.
+        If this instance was loaded from the previous storage layout, register
+        it as modified so the compact records get stored along with it, and
+        drop the data objects they now hold from the per-data-object storage.
+        If the transaction is aborted, this instance gets invalidated and the
+        upgrade happens again on next load.
+        """
+        if self._v_storage_upgrade_pending:
+            self._v_storage_upgrade_pending = False
+            base_data_object_dict = self._BaseFile__data_object_dict
+            for tag_tuple in COMPACT_DATA_OBJECT_DICT:
+                base_data_object_dict.pop(tag_tuple, None)
+            self._p_changed = True
+
+    def __updateCardState(self, **kw):
+        self.__prepareStateChange()
+        card_state = self.__card_state
+        for key, value in kw.items():
+            setattr(card_state, key, value)
+
+    def __updateCounterState(self, **kw):
+        self.__prepareStateChange()
+        counter_state = self.__counter_state
+        for key, value in kw.items():
+            setattr(counter_state, key, value)
+
+    def _putData(self, tag, value, index=None):
+        tag_tuple = tag.asTagTuple()
+        if tag_tuple not in COMPACT_DATA_OBJECT_DICT:
+            super()._putData(tag=tag, value=value, index=index)
+            return
+        if not isinstance(value, bytes):
+            raise TypeError(type(value))
+        data_object_dict = self.__card_state.data_object_dict
+        value_tuple = data_object_dict.get(tag_tuple, ())
+        if index is None:
+            if value_tuple:
+                raise ValueError('already set')
+            index = 0
+        if index > len(value_tuple):
+            raise IndexError(index)
+        data_object_dict = data_object_dict.copy()
+        data_object_dict[tag_tuple] = _replaceItem(value_tuple, index, value)
+        self.__updateCardState(data_object_dict=data_object_dict)
+
+    def getData(self, tag, index=None, decode=False):
+        tag_tuple = tag.asTagTuple()
+        if (
+            tag_tuple not in COMPACT_DATA_OBJECT_DICT or
+            tag in self._dynamicGetDataObjectDict
+        ):
+            return super().getData(tag=tag, index=index, decode=decode)
+        value = self.__card_state.data_object_dict.get(tag_tuple)
+        if value is not None:
+            try:
+                if index is None:
+                    value, = value
+                else:
+                    value = value[index]
+            except (ValueError, IndexError):
+                raise RecordNotFound from None
+            if decode:
+                value = tag.decode(value, codec=CodecBER)
+        return value
+
+    def iterData(self, tag_list=None, decode=False):
+        data_object_dict = self.__card_state.data_object_dict
+        if tag_list:
+            dynamic_get_data_object_dict = self._dynamicGetDataObjectDict
+            for tag in tag_list:
+                tag_tuple = tag.asTagTuple()
+                if (
+                    tag_tuple not in COMPACT_DATA_OBJECT_DICT or
+                    tag in dynamic_get_data_object_dict
+                ):
+                    yield from super().iterData(
+                        tag_list=(tag, ),
+                        decode=decode,
+                    )
+                else:
+                    for value in data_object_dict.get(tag_tuple, ()):
+                        yield tag, (
+                            tag.decode(value, codec=CodecBER)
+                            if decode else
+                            value
+                        )
+        else:
+            yield from super().iterData(decode=decode)
+            for tag_tuple, value_list in data_object_dict.items():
+                tag = COMPACT_DATA_OBJECT_DICT[tag_tuple]
+                for value in value_list:
+                    yield tag, value
+
+    def isReadOnlyCommand(self, apdu_head):
+        """
+        Whether given command is known to not modify any persistent state,
+        so that it may be run outside of a transaction.
+        Only depends on the command head, so it also holds when this
+        application is not the current file.
+        """
+        instruction = apdu_head.instruction & ~INSTRUCTION_BERTLV_MASK
+        if instruction == INSTRUCTION_GENERATE_ASYMMETRIC_KEY_PAIR:
+            # Reading an existing public key.
+            return apdu_head.parameter1 == 0x81
+        return instruction in self._read_only_instruction_set
+
     def _getExtendedLengthInformation(self):
         return (ExtendedLengthInformation.encode(
             value={
@@ -505,16 +957,17 @@ class OpenPGP(PersistentWithVolatileSurvivor, ApplicationFile):
         ), )
 
     def _getPasswordStatusBytes(self):
+        reference_data_counter = self.__counter_state.reference_data_counter
         return (
             struct.pack(
                 'BBBBBBB',
-                self.__pw1_valid_multiple_signatures,
+                self.__card_state.pw1_valid_multiple_signatures,
                 self.__reference_max_length_list[PW1_INDEX],
                 self.__reference_max_length_list[RESET_CODE_INDEX],
                 self.__reference_max_length_list[PW3_INDEX],
-                self.__reference_data_counter_list[PW1_INDEX],
-                self.__reference_data_counter_list[RESET_CODE_INDEX],
-                self.__reference_data_counter_list[PW3_INDEX],
+                reference_data_counter[PW1_INDEX],
+                reference_data_counter[RESET_CODE_INDEX],
+                reference_data_counter[PW3_INDEX],
             ),
         )
 
@@ -522,14 +975,14 @@ class OpenPGP(PersistentWithVolatileSurvivor, ApplicationFile):
         return (
             CodecBER.encode(
                 tag=SignatureCounter,
-                value=self.__signature_counter,
+                value=self.__counter_state.signature_counter,
             ),
         )
 
     def _getSignatureCounter(self):
         return (
             SignatureCounter.encode(
-                value=self.__signature_counter,
+                value=self.__counter_state.signature_counter,
                 codec=CodecBER,
             ),
         )
@@ -675,23 +1128,57 @@ class OpenPGP(PersistentWithVolatileSurvivor, ApplicationFile):
         return (
             b''.join(
                 index.to_bytes(1, 'big') + status.to_bytes(1, 'big')
-                for index, status in enumerate(self.__key_information_list)
+                for index, status in enumerate(
+                    self.__card_state.key_information,
+                )
             ),
         )
 
     def _getAlgorithmInformation(self):
-        return (b''.join(
-            KEY_ROLE_TO_ATTRIBUTE_TAG_DICT[role].encode(
-                algorithm_information,
-                codec=CodecBER,
-            )
-            for role in (
-                KEY_ROLE_SIGN, # signature key first
-                KEY_ROLE_DECRYPT,
-                KEY_ROLE_AUTHENTICATE,
-            )
-            for algorithm_information in ROLE_TO_SUPPORTED_ALGORITHM_INFORMATION_LIST_DICT[role]
-        ), )
+        result = []
+        for role in (
+            KEY_ROLE_SIGN, # signature key first
+            KEY_ROLE_DECRYPT,
+            KEY_ROLE_AUTHENTICATE,
+        ):
+            tag = KEY_ROLE_TO_ATTRIBUTE_TAG_DICT[role]
+            current_value = self.getData(tag, decode=False)
+            for algorithm_information in ROLE_TO_SUPPORTED_ALGORITHM_INFORMATION_LIST_DICT[role]:
+                if (
+                    algorithm_information == current_value or
+                    self._isAlgorithmAvailable(tag, algorithm_information)
+                ):
+                    result.append(CodecBER.encodeTagLength(
+                        tag=tag,
+                        length=len(algorithm_information),
+                    ) + algorithm_information)
+        return (b''.join(result), )
+
+    def _getPrefillIndex(self, tag, value):
+        key_spec_list = self._v_s_prefill_key_spec_list
+        if key_spec_list:
+            key_spec = getKeySpec(tag, value)
+            if key_spec in key_spec_list:
+                return key_spec_list.index(key_spec)
+        return None
+
+    def _isAlgorithmAvailable(self, tag, value):
+        """
+        Whether given algorithm attributes can be selected, according to
+        the algorithm policy.
+        """
+        if value == DEFAULT_ALGORITHM_ATTRIBUTES_DICT[tag]:
+            return True
+        status = self._algorithm_policy.getStatus(tag, value)
+        if status is ALGORITHM_REJECTED:
+            return False
+        if status is ALGORITHM_PREFILL:
+            prefill_index = self._getPrefillIndex(tag, value)
+            if prefill_index is None:
+                return False
+            private_key = self._v_s_prefill_key_list[prefill_index]
+            return private_key is not None and private_key is not False
+        return True
 
     @property
     def _dynamicGetDataObjectDict(self):
@@ -781,16 +1268,24 @@ class OpenPGP(PersistentWithVolatileSurvivor, ApplicationFile):
                 format=serialization.PrivateFormat.PKCS8,
                 encryption_algorithm=serialization.NoEncryption(),
             )
-        self.__key_list[index] = key_pem
-        self.__key_information_list[index] = information
+        card_state = self.__card_state
+        self.__updateCardState(
+            key=_replaceItem(card_state.key, index, key_pem),
+            key_information=_replaceItem(
+                card_state.key_information,
+                index,
+                information,
+            ),
+        )
         if role is KEY_ROLE_SIGN:
-            self.__signature_counter = 0
+            self.__updateCounterState(signature_counter=0)
 
     def _setAlgoAttributes(self, tag, value, role, index):
         current_value = self.getData(tag=tag, index=index, decode=False)
         if current_value == value:
             return
-        #raise WrongParameterInCommandData
+        if not self._isAlgorithmAvailable(tag, value):
+            raise WrongParameterInCommandData('algorithm not available')
         self._putData(tag=tag, value=value, index=index)
         key_index = KEY_ROLE_TO_INDEX_DICT[role]
         self._storePrivateKey(
@@ -798,12 +1293,20 @@ class OpenPGP(PersistentWithVolatileSurvivor, ApplicationFile):
             key=None,
             information=KEY_INFORMATION_NOT_PRESENT,
         )
-        self._v_s_keygen_key_list[key_index] = None
+        private_key = None
+        prefill_index = self._getPrefillIndex(tag, value)
+        if prefill_index is not None:
+            private_key = self._v_s_prefill_key_list[prefill_index]
+            if private_key is False:
+                private_key = None
+            else:
+                self._v_s_prefill_key_list[prefill_index] = None
+        self._v_s_keygen_key_list[key_index] = private_key
         self._v_s_algorithm_attributes_list[key_index] = KEY_ROLE_TO_ATTRIBUTE_TAG_DICT[role].getAlgorithmObject(
             value,
             codec=CodecBER,
         )
-        self._v_s_keygen_semaphore.release()
+        self._requestKeygen()
 
     def _setAlgoAttributesSignature(self, value, index=None):
         _ = index # Silence pylint.
@@ -849,7 +1352,9 @@ class OpenPGP(PersistentWithVolatileSurvivor, ApplicationFile):
         # Note: if PIN length modification is implemented, it must only work
         # during personalisation stage.
         if len(value) >= 1:
-            self.__pw1_valid_multiple_signatures = value == b'\x01'
+            self.__updateCardState(
+                pw1_valid_multiple_signatures=value == b'\x01',
+            )
 
     def _setSex(self, value, index=None):
         if value:
@@ -1051,7 +1556,7 @@ class OpenPGP(PersistentWithVolatileSurvivor, ApplicationFile):
             # Is PW3-level authenticated ?
             not channel.isUserAuthenticated(level=LEVEL_PW3) and
             # Is PW3 still usable ?
-            self.__reference_data_counter_list[
+            self.__counter_state.reference_data_counter[
                 REFERENCE_DATA_LEVEL_TO_LIST_OFFSET_DICT[LEVEL_PW3]
             ] > 0
         ):
@@ -1103,19 +1608,30 @@ class OpenPGP(PersistentWithVolatileSurvivor, ApplicationFile):
         index_dict[role] = key_index
 
     def _getReferenceDataSet(self, index):
-        secret = self.__reference_data_list[index]
+        secret = self.__card_state.reference_data[index]
         if secret is None:
             return ()
         return (secret, )
 
     def _setReferenceData(self, index, value):
-        self.__reference_data_list[index] = self._encodeReferenceData(
-            index=index,
-            reference_data=value,
-        )
+        self.__updateCardState(reference_data=_replaceItem(
+            self.__card_state.reference_data,
+            index,
+            self._encodeReferenceData(
+                index=index,
+                reference_data=value,
+            ),
+        ))
+
+    def __setReferenceDataTriesLeft(self, index, value):
+        self.__updateCounterState(reference_data_counter=_replaceItem(
+            self.__counter_state.reference_data_counter,
+            index,
+            value,
+        ))
 
     def _getReferenceDataTriesLeft(self, index):
-        return self.__reference_data_counter_list[index]
+        return self.__counter_state.reference_data_counter[index]
 
     def _verify(self, index, reference_data, truncate=False):
         """
@@ -1124,14 +1640,15 @@ class OpenPGP(PersistentWithVolatileSurvivor, ApplicationFile):
         On success, return the length (in chars) of the stored secret.
         Otherwise, raises.
         """
-        # XXX: store __reference_data_counter_list outside of ZODB ? this may
+        # XXX: store reference data counters outside of ZODB ? this may
         # get a lot of history...
-        if self._getReferenceDataTriesLeft(index) == 0:
+        tries_left = self._getReferenceDataTriesLeft(index)
+        if tries_left == 0:
             raise AuthMethodBlocked
         secret_set = self._getReferenceDataSet(index=index)
         if not secret_set:
             raise ReferenceDataNotUsable
-        self.__reference_data_counter_list[index] -= 1
+        self.__setReferenceDataTriesLeft(index, tries_left - 1)
 
         transaction_manager.commit()
         transaction_manager.begin()
@@ -1154,7 +1671,7 @@ class OpenPGP(PersistentWithVolatileSurvivor, ApplicationFile):
                 break
         else:
             raise SecurityNotSatisfied
-        self.__reference_data_counter_list[index] = VERIFICATION_DATA_VALIDITY
+        self.__setReferenceDataTriesLeft(index, VERIFICATION_DATA_VALIDITY)
 
         transaction_manager.commit()
         transaction_manager.begin()
@@ -1182,10 +1699,13 @@ class OpenPGP(PersistentWithVolatileSurvivor, ApplicationFile):
         if new_reference_len > 0x7f:
             raise WrongParameterInCommandData('Too long')
         self._setReferenceData(index=index, value=bytes(new_reference))
-        self.__reference_data_counter_list[index] = (
-            VERIFICATION_DATA_VALIDITY
-            if new_reference else
-            0
+        self.__setReferenceDataTriesLeft(
+            index,
+            (
+                VERIFICATION_DATA_VALIDITY
+                if new_reference else
+                0
+            ),
         )
 
     def verify(self, channel, level, command_data):
@@ -1406,8 +1926,10 @@ class OpenPGP(PersistentWithVolatileSurvivor, ApplicationFile):
                 condensate=command_data,
                 role=KEY_ROLE_SIGN,
             )
-            self.__signature_counter += 1
-            if not self.__pw1_valid_multiple_signatures:
+            self.__updateCounterState(
+                signature_counter=self.__counter_state.signature_counter + 1,
+            )
+            if not self.__card_state.pw1_valid_multiple_signatures:
                 channel.clearUserAuthentication(level=LEVEL_PW1_SIGN)
         elif (
             from_type == PERFORM_SECURITY_OPERATION_CIPHERTEXT and
@@ -1457,41 +1979,16 @@ class OpenPGP(PersistentWithVolatileSurvivor, ApplicationFile):
             key_index=key_index,
         )
 
-    def _maintainKeyQueue(self):
-        """
-        keygen thread main loop
-        """
-        semaphore = self._v_s_keygen_semaphore
-        key_list = self._v_s_keygen_key_list
-        key_attributes_list = self._v_s_algorithm_attributes_list
-        retry = False
-        while True:
-            if retry:
-                retry = False
-            else:
-                semaphore.acquire()
-            for index, key in enumerate(key_list):
-                if key is None:
-                    attributes = key_attributes_list[index]
-                    try:
-                        before = time.time()
-                        private_key = attributes.newKey()
-                    except Exception: #pylint: disable=broad-except
-                        logger.error('Error in keygen thread:', exc_info=1)
-                        private_key = False
-                    else:
-                        logger.debug(
-                            'keygen: produced key %i in %.2fs',
-                            index,
-                            time.time() - before,
-                        )
-                        if attributes != key_attributes_list[index]:
-                            logger.debug(
-                                'keygen: ...but parameters changed, discarding',
-                            )
-                            retry = True
-                            continue
-                    key_list[index] = private_key
+    def _requestKeygen(self):
+        self._keygen_service.request(
+            key_list=self._v_s_keygen_key_list,
+            algorithm_attributes_list=self._v_s_algorithm_attributes_list,
+        )
+        if self._v_s_prefill_key_list:
+            self._keygen_service.request(
+                key_list=self._v_s_prefill_key_list,
+                algorithm_attributes_list=self._v_s_prefill_attributes_list,
+            )
 
     def generateAsymmetricKeyPair(self, channel, p1, p2, command_data):
         if p2:
@@ -1509,12 +2006,23 @@ class OpenPGP(PersistentWithVolatileSurvivor, ApplicationFile):
         if p1 == 0x80:
             channel.checkUserAuthentication(level=LEVEL_PW3)
             private_key = self._v_s_keygen_key_list[index]
+            (
+                _keygen_miss_counter
+                if private_key is None else
+                _keygen_hit_counter
+            ).inc()
             if private_key is None:
+                # Generate it even if keys are not generated in advance.
+                self._keygen_service.request(
+                    key_list=self._v_s_keygen_key_list,
+                    algorithm_attributes_list=self._v_s_algorithm_attributes_list,
+                    demand=index,
+                )
                 raise ValueError('key not ready yet')
             if private_key is False:
                 raise ValueError('key generation failed (unsupported format ?)')
             self._v_s_keygen_key_list[index] = None
-            self._v_s_keygen_semaphore.release()
+            self._requestKeygen()
             self._storePrivateKey(
                 role=role,
                 key=private_key,
@@ -1575,7 +2083,7 @@ class OpenPGP(PersistentWithVolatileSurvivor, ApplicationFile):
             channel=channel,
             condensate=command_data,
             role=KEY_ROLE_AUTHENTICATE,
-        )
+        ) + SUCCESS
 
     def resetRetryCounter(self, channel, p1, p2, command_data):
         if p2 != 0x81:
@@ -1609,7 +2117,34 @@ class OpenPGP(PersistentWithVolatileSurvivor, ApplicationFile):
             new_reference=new_reference,
         )
 
-class PINQueueConnection(ZODB.Connection.Connection):
+class VolatileSurvivorConnection(ZODB.Connection.Connection):
+    """
+    Cards reset their volatile survivors (channels, with their selected file
+    and authentication status, and APDU chaining state) when they get loaded.
+    So a card ghostified between two commands, by a cache smaller than its
+    working set (see memory.MemoryMonitor), would lose the host's session.
+    Restore them instead, when the card was not garbage-collected meanwhile.
+    """
+    # pylint: disable=protected-access
+    __volatile_survivor_dict = (
+        PersistentWithVolatileSurvivor.
+        _PersistentWithVolatileSurvivor__volatile_survivor_dict
+    )
+    # pylint: enable=protected-access
+
+    def setstate(self, obj):
+        survivor_dict = None
+        if isinstance(obj, Card):
+            # Not using __getitem__, which creates missing entries.
+            survivor = self.__volatile_survivor_dict.get(obj)
+            if survivor is not None:
+                survivor_dict = vars(survivor).copy()
+        super().setstate(obj)
+        if survivor_dict:
+            for name, value in survivor_dict.items():
+                setattr(obj, name, value)
+
+class PINQueueConnection(VolatileSurvivorConnection):
     """
     See OpenPGPRandomPassword.
     """
@@ -1660,6 +2195,9 @@ class OpenPGPRandomPassword(OpenPGP):
     # XXX: can this be made compatible ? Probably not, as the pi is likely not
     # capable of deriving the key fast enough.
     _has_key_derived_function = False
+    _read_only_instruction_set = OpenPGP._read_only_instruction_set | {
+        INSTRUCTION_GET_CHALLENGE,
+    }
 
     def _getKeyDerivedFunction(self):
         raise RecordNotFound
@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2018-2020  Vincent Pelletier <plr.vincent@gmail.com>
+#
+# This file is part of python-smartcard-app-openpgp.
+# python-smartcard-app-openpgp is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# python-smartcard-app-openpgp is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with python-smartcard-app-openpgp.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Algorithm calibration: key generation and private key operation durations
+measured on the board for each algorithm attributes combination, and the
+policy deciding from latency budgets which ones cards advertise and accept.
+
+Without calibration, every supported combination is available.
+"""
+
+import json
+import logging
+import os
+from smartcard.asn1 import CodecBER
+from smartcard.utils import NamedSingleton
+from .tag import (
+    AlgorithmAttributesAuthentication,
+    AlgorithmAttributesBase,
+    AlgorithmAttributesDecryption,
+    AlgorithmAttributesSignature,
+)
+
+logger = logging.getLogger(__name__)
+
+# Advertised and accepted.
+ALGORITHM_ALLOWED = NamedSingleton('ALGORITHM_ALLOWED')
+# Key generation is too slow to happen on demand: advertised and accepted
+# only once a key got generated in advance.
+ALGORITHM_PREFILL = NamedSingleton('ALGORITHM_PREFILL')
+# Neither advertised nor accepted.
+ALGORITHM_REJECTED = NamedSingleton('ALGORITHM_REJECTED')
+
+TAG_TO_ROLE_NAME_DICT = {
+    AlgorithmAttributesSignature: 'sign',
+    AlgorithmAttributesDecryption: 'decrypt',
+    AlgorithmAttributesAuthentication: 'authenticate',
+}
+ROLE_NAME_TO_TAG_DICT = {
+    value: key
+    for key, value in TAG_TO_ROLE_NAME_DICT.items()
+}
+
+def getKeySpec(tag, attributes):
+    """
+    Return a hashable value identifying the kind of private key given
+    algorithm attributes need: attributes only differing by import format,
+    or by key role, share the same key spec.
+    """
+    decoded = tag.decode(attributes, codec=CodecBER)
+    parameter_dict = decoded['parameter_dict']
+    if decoded['algorithm'] is AlgorithmAttributesBase.RSA:
+        return ('rsa', parameter_dict['modulus_bit_length'])
+    return ('curve', parameter_dict['algo'])
+
+class AlgorithmCalibration:
+    """
+    Measured durations, in seconds, per algorithm attributes tag and value.
+    """
+    def __init__(self):
+        # tag -> attributes -> (keygen duration, operation duration or None)
+        self.__duration_dict = {
+            tag: {}
+            for tag in TAG_TO_ROLE_NAME_DICT
+        }
+
+    def set(self, tag, attributes, keygen_duration, operation_duration):
+        """
+        operation_duration (float, or None)
+            None if the private key operation failed.
+        """
+        self.__duration_dict[tag][attributes] = (
+            keygen_duration,
+            operation_duration,
+        )
+
+    def get(self, tag, attributes):
+        """
+        Return (keygen duration, operation duration or None), or None if
+        given algorithm attributes were not measured.
+        """
+        return self.__duration_dict[tag].get(attributes)
+
+    def iterItems(self):
+        """
+        Yield (tag, attributes, keygen duration, operation duration).
+        """
+        for tag, attributes_dict in self.__duration_dict.items():
+            for attributes, (
+                keygen_duration,
+                operation_duration,
+            ) in attributes_dict.items():
+                yield tag, attributes, keygen_duration, operation_duration
+
+    @classmethod
+    def load(cls, path):
+        """
+        Returns an AlgorithmCalibration instance, or None if there is no
+        calibration at given path.
+        """
+        try:
+            with open(path, 'r', encoding='utf-8') as calibration_file:
+                data = json.load(calibration_file)
+        except FileNotFoundError:
+            return None
+        result = cls()
+        for role_name, attributes_dict in data.items():
+            tag = ROLE_NAME_TO_TAG_DICT[role_name]
+            for attributes, duration_dict in attributes_dict.items():
+                result.set(
+                    tag=tag,
+                    attributes=bytes.fromhex(attributes),
+                    keygen_duration=duration_dict['keygen'],
+                    operation_duration=duration_dict['operation'],
+                )
+        return result
+
+    def save(self, path):
+        """
+        Atomically replace the calibration at given path.
+        """
+        data = {
+            role_name: {}
+            for role_name in ROLE_NAME_TO_TAG_DICT
+        }
+        for (
+            tag,
+            attributes,
+            keygen_duration,
+            operation_duration,
+        ) in self.iterItems():
+            data[TAG_TO_ROLE_NAME_DICT[tag]][attributes.hex()] = {
+                'keygen': keygen_duration,
+                'operation': operation_duration,
+            }
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as calibration_file:
+            json.dump(data, calibration_file, indent=2, sort_keys=True)
+        os.replace(temp_path, path)
+
+class AlgorithmPolicy:
+    """
+    Classifies algorithm attributes given a calibration and latency budgets.
+    Attributes absent from the calibration are allowed.
+    """
+    __calibration = None
+    __keygen_budget = None
+    __operation_budget = None
+    __prefill = True
+
+    def configure(
+        self,
+        calibration,
+        keygen_budget=None,
+        operation_budget=None,
+        prefill=True,
+    ):
+        """
+        Must be called before any card gets loaded.
+        calibration (AlgorithmCalibration, or None)
+            None to allow everything.
+        keygen_budget (float, or None)
+            Longest acceptable on-demand key generation, in seconds. None for
+            no limit.
+        operation_budget (float, or None)
+            Longest acceptable private key operation, in seconds. None for no
+            limit. Algorithms whose private key operation failed during
+            calibration are rejected in any case.
+        prefill (bool)
+            Whether algorithms exceeding the keygen budget are to be generated
+            in advance (ALGORITHM_PREFILL) instead of rejected.
+        """
+        self.__calibration = calibration
+        self.__keygen_budget = keygen_budget
+        self.__operation_budget = operation_budget
+        self.__prefill = prefill
+        if calibration is not None:
+            for (
+                tag,
+                attributes,
+                keygen_duration,
+                operation_duration,
+            ) in calibration.iterItems():
+                status = self.getStatus(tag, attributes)
+                if status is not ALGORITHM_ALLOWED:
+                    logger.info(
+                        '%s %s: %s (keygen: %.3fs, operation: %s)',
+                        TAG_TO_ROLE_NAME_DICT[tag],
+                        attributes.hex(),
+                        (
+                            'keys generated in advance'
+                            if status is ALGORITHM_PREFILL else
+                            'not available'
+                        ),
+                        keygen_duration,
+                        (
+                            'failed'
+                            if operation_duration is None else
+                            '%.3fs' % (operation_duration, )
+                        ),
+                    )
+
+    def getStatus(self, tag, attributes):
+        """
+        Return one of ALGORITHM_ALLOWED, ALGORITHM_PREFILL and
+        ALGORITHM_REJECTED.
+        """
+        calibration = self.__calibration
+        if calibration is None:
+            return ALGORITHM_ALLOWED
+        duration_tuple = calibration.get(tag, attributes)
+        if duration_tuple is None:
+            return ALGORITHM_ALLOWED
+        keygen_duration, operation_duration = duration_tuple
+        operation_budget = self.__operation_budget
+        if operation_duration is None or (
+            operation_budget is not None and
+            operation_duration > operation_budget
+        ):
+            return ALGORITHM_REJECTED
+        keygen_budget = self.__keygen_budget
+        if keygen_budget is not None and keygen_duration > keygen_budget:
+            return ALGORITHM_PREFILL if self.__prefill else ALGORITHM_REJECTED
+        return ALGORITHM_ALLOWED
+
+    def getPrefillList(self):
+        """
+        Return the keys to generate in advance, as a list of
+        (key spec, tag, attributes), one per key spec.
+        """
+        result = []
+        if self.__calibration is not None:
+            key_spec_set = set()
+            for tag, attributes, _, _ in self.__calibration.iterItems():
+                if self.getStatus(tag, attributes) is ALGORITHM_PREFILL:
+                    key_spec = getKeySpec(tag, attributes)
+                    if key_spec not in key_spec_set:
+                        key_spec_set.add(key_spec)
+                        result.append((key_spec, tag, attributes))
+        return result
+
+algorithm_policy = AlgorithmPolicy()
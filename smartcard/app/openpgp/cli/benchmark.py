@@ -0,0 +1,1066 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2018-2020  Vincent Pelletier <plr.vincent@gmail.com>
+#
+# This file is part of python-smartcard-app-openpgp.
+# python-smartcard-app-openpgp is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# python-smartcard-app-openpgp is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with python-smartcard-app-openpgp.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Measure the cost of card operations, independently from any USB gadget.
+"""
+
+import argparse
+from collections import defaultdict
+import csv
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import socket
+import sys
+import tempfile
+import time
+import ZODB.FileStorage
+from smartcard.app.openpgp import (
+    DEFAULT_ALGORITHM_ATTRIBUTES_SIGNATURE,
+    DEFAULT_PW3,
+    KEY_ROLE_SIGN,
+    KEY_ROLE_TO_ATTRIBUTE_TAG_DICT,
+    OpenPGP,
+    cryptomatrix,
+    loopback,
+    trace,
+)
+from smartcard.app.openpgp.cli import farm
+from smartcard.app.openpgp.constrained import (
+    CalibrationFactors,
+    addConstrainedArgumentList,
+    constrainedProfile,
+)
+from smartcard.app.openpgp.fastpath import ReadOnlyFastPathCard
+from smartcard.app.openpgp.loopback import (
+    LoopbackCard,
+    SELECT_OPENPGP,
+)
+from smartcard.app.openpgp.memory import (
+    MemoryAccountingCard,
+    MemoryMonitor,
+)
+
+logger = logging.getLogger(__name__)
+
+# Commands hosts issue most often, which do not modify the card.
+READ_ONLY_COMMAND_DICT = {
+    'GET DATA ApplicationRelatedData': bytes.fromhex('00ca006eff'),
+    'GET DATA HistoricalData': bytes.fromhex('00ca5f52ff'),
+    'GET DATA PasswordStatusBytes': bytes.fromhex('00ca00c4ff'),
+    'GET DATA CardholderData': bytes.fromhex('00ca0065ff'),
+    'READ PUBLIC KEY signature': bytes.fromhex('0047810002b600ff'),
+}
+
+def runAPDU(card, command):
+    """
+    Run command on card, fetching the whole response if it is chained.
+    """
+    response = bytes(card.runAPDU(bytearray(command)))
+    while response[-2] == 0x61:
+        response = response[:-2] + bytes(card.runAPDU(
+            bytearray((0x00, 0xc0, 0x00, 0x00, response[-1] or 0xff)),
+        ))
+    return response
+
+class BenchmarkCard(LoopbackCard):
+    """
+    A card holding an OpenPGP application, in a temporary FileStorage.
+    """
+    def __init__(self, openpgp_class=OpenPGP):
+        self.__tmpdir = tmpdir = tempfile.mkdtemp(
+            prefix='python-smartcard-benchmark-',
+        )
+        super().__init__(
+            openpgp_class=openpgp_class,
+            storage=ZODB.FileStorage.FileStorage(
+                file_name=os.path.join(tmpdir, 'benchmark.fs'),
+            ),
+        )
+
+    def generateKey(self, control_reference=b'\xb6\x00'):
+        """
+        Generate a key pair, waiting for the background key generation
+        to provide one if necessary. Unselects the application.
+        """
+        card = self.card
+        runAPDU(card, SELECT_OPENPGP)
+        response = runAPDU(card, b'\x00\x20\x00\x83\x08' + DEFAULT_PW3)
+        if response != b'\x90\x00':
+            raise ValueError('PW3 verification failed: %s' % (response.hex(), ))
+        command = (
+            b'\x00\x47\x80\x00' +
+            len(control_reference).to_bytes(1, 'big') + control_reference +
+            b'\xff'
+        )
+        while True:
+            response = runAPDU(card, command)
+            if response[-2:] == b'\x90\x00':
+                break
+            time.sleep(.1)
+        card.clearVolatile()
+
+    def close(self):
+        super().close()
+        shutil.rmtree(self.__tmpdir)
+
+def _timeCommand(card, command, count):
+    start = time.perf_counter()
+    for _ in range(count):
+        runAPDU(card, command)
+    return (time.perf_counter() - start) / count
+
+def benchmarkAPDU(args):
+    with BenchmarkCard() as benchmark_card:
+        benchmark_card.generateKey()
+        card = benchmark_card.card
+        fast_card = ReadOnlyFastPathCard(
+            card=card,
+            application=benchmark_card.openpgp,
+        )
+        runAPDU(card, SELECT_OPENPGP)
+        print('%-36s %12s %12s %12s' % (
+            'command', 'txn (us)', 'no txn (us)', 'saved (us)',
+        ))
+        for caption, command in READ_ONLY_COMMAND_DICT.items():
+            if runAPDU(card, command)[-2:] != b'\x90\x00':
+                print('%-36s (not available)' % (caption, ))
+                continue
+            with_transaction = _timeCommand(card, command, args.count)
+            without_transaction = _timeCommand(fast_card, command, args.count)
+            print('%-36s %12.1f %12.1f %12.1f' % (
+                caption,
+                with_transaction * 1e6,
+                without_transaction * 1e6,
+                (with_transaction - without_transaction) * 1e6,
+            ))
+
+def _runFarmClient(address, shard, shard_count, card_count, apdu_count):
+    """
+    Run apdu_count GET DATA, spread over the cards of given shard.
+    """
+    command = READ_ONLY_COMMAND_DICT['GET DATA PasswordStatusBytes']
+    card_id_list = list(range(shard, card_count, shard_count))
+    client = farm.FarmClient(
+        address=farm.getShardAddress(address, shard, shard_count),
+    )
+    with client:
+        for card_id in card_id_list:
+            client.powerOn(card_id)
+            client.runAPDU(card_id, SELECT_OPENPGP)
+        for index in range(apdu_count):
+            card_id = card_id_list[index % len(card_id_list)]
+            response = client.runAPDU(card_id, command)
+            if response[-2:] != b'\x90\x00':
+                raise ValueError(response.hex())
+
+def _waitForSocket(path, timeout=30):
+    deadline = time.monotonic() + timeout
+    while True:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(.05)
+        else:
+            return
+        finally:
+            sock.close()
+
+def benchmarkFarm(args):
+    card_count = args.cards
+    command = READ_ONLY_COMMAND_DICT['GET DATA PasswordStatusBytes']
+    # Key generation happens in the background, and would compete with
+    # card creation and APDU processing. Keep the pool small.
+    farm.key_pool.pool_size = 1
+    card_farm = farm.CardFarm()
+    max_rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    for card_id in range(card_count):
+        card_farm.powerOn(card_id)
+        card_farm.runAPDU(card_id, bytearray(SELECT_OPENPGP))
+    creation_duration = time.perf_counter() - start
+    max_rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    for index in range(args.apdu_count):
+        card_farm.runAPDU(index % card_count, bytearray(command))
+    in_process_duration = time.perf_counter() - start
+    card_farm.close()
+    print('cards created: %i in %.2fs (%.1f cards/s/core)' % (
+        card_count,
+        creation_duration,
+        card_count / creation_duration,
+    ))
+    print('memory per card: %.1f kB (max RSS growth)' % (
+        # ru_maxrss is in kilobytes on Linux
+        (max_rss_after - max_rss_before) / card_count,
+    ))
+    print('in-process: %.0f APDU/s/core' % (
+        args.apdu_count / in_process_duration,
+    ))
+    tmpdir = tempfile.mkdtemp(prefix='python-smartcard-benchmark-')
+    try:
+        address = os.path.join(tmpdir, 'farm')
+        shard_count = args.shard_count
+        server_list = []
+        try:
+            for shard in range(shard_count):
+                server = multiprocessing.Process(
+                    target=farm.serve,
+                    kwargs={
+                        'address': farm.getShardAddress(
+                            address,
+                            shard,
+                            shard_count,
+                        ),
+                        'shard': shard,
+                        'shard_count': shard_count,
+                        'key_pool_size': 1,
+                    },
+                    daemon=True,
+                )
+                server.start()
+                server_list.append(server)
+            for shard in range(shard_count):
+                _waitForSocket(farm.getShardAddress(address, shard, shard_count))
+            client_list = [
+                multiprocessing.Process(
+                    target=_runFarmClient,
+                    kwargs={
+                        'address': address,
+                        'shard': shard,
+                        'shard_count': shard_count,
+                        'card_count': card_count,
+                        'apdu_count': args.apdu_count // shard_count,
+                    },
+                )
+                for shard in range(shard_count)
+            ]
+            start = time.perf_counter()
+            for client in client_list:
+                client.start()
+            for client in client_list:
+                client.join()
+                if client.exitcode:
+                    raise RuntimeError('client failed')
+            socket_duration = time.perf_counter() - start
+        finally:
+            for server in server_list:
+                server.terminate()
+                server.join()
+    finally:
+        shutil.rmtree(tmpdir)
+    print(
+        'over UNIX socket, %i shard(s): %.0f APDU/s (including card '
+        'creation and power on)' % (
+            shard_count,
+            args.apdu_count // shard_count * shard_count / socket_duration,
+        ),
+    )
+
+def benchmarkScenario(args):
+    session = loopback.runScenarios(
+        scenario_name_list=args.scenario or tuple(loopback.SCENARIO_DICT),
+        iterations=args.iterations,
+        openpgp_class=(
+            loopback.LoopbackOpenPGPRandomPassword
+            if args.random_password else
+            loopback.LoopbackOpenPGP
+        ),
+    )
+    percentile_list = (50, 90, 99)
+    header = '%-40s %6s' + ' %10s' * len(percentile_list)
+    line = '%-40s %6i' + ' %10.3f' * len(percentile_list)
+    for caption, duration_dict in (
+        ('scenario', session.scenario_duration_dict),
+        ('command', session.command_duration_dict),
+    ):
+        print(header % (
+            (caption, 'count') +
+            tuple('p%i (ms)' % (x, ) for x in percentile_list)
+        ))
+        for name, duration_list in duration_dict.items():
+            duration_list = sorted(duration_list)
+            print(line % (
+                (name, len(duration_list)) +
+                tuple(
+                    loopback.getPercentile(duration_list, x) * 1000
+                    for x in percentile_list
+                )
+            ))
+        print()
+    for failure in session.failure_list:
+        print('FAILED: %s' % (failure, ))
+    if session.failure_list:
+        sys.exit(1)
+
+def benchmarkMemory(args):
+    monitor = MemoryMonitor(
+        accounting=True,
+        snapshot_interval=args.snapshot_interval,
+        frame_count=args.frame_count,
+        # Only checked on demand.
+        interval=3600,
+    )
+    with monitor, LoopbackCard(
+        openpgp_class=(
+            loopback.LoopbackOpenPGPRandomPassword
+            if args.random_password else
+            loopback.LoopbackOpenPGP
+        ),
+        wrapCard=lambda card: MemoryAccountingCard(
+            card=card,
+            monitor=monitor,
+        ),
+    ) as loopback_card:
+        monitor.addDatabaseGetter(loopback_card.getDatabase)
+        session = loopback.runScenarios(
+            scenario_name_list=args.scenario or tuple(loopback.SCENARIO_DICT),
+            iterations=args.iterations,
+            loopback_card=loopback_card,
+        )
+        monitor.check()
+        monitor.updateFootprint()
+        print(monitor.getReport())
+    for failure in session.failure_list:
+        print('FAILED: %s' % (failure, ))
+    if session.failure_list:
+        sys.exit(1)
+
+def _getReplayCaption(record):
+    if record.kind == trace.RECORD_KIND_POWER_ON:
+        return 'power on'
+    if record.kind == trace.RECORD_KIND_POWER_OFF:
+        return 'power off'
+    _, instruction, p1, p2 = record.head
+    return 'INS %02x P1P2 %02x%02x' % (instruction, p1, p2)
+
+def benchmarkReplay(args):
+    # caption -> ([recorded duration, ...], [replayed duration, ...])
+    duration_dict = defaultdict(lambda: ([], []))
+    skipped_count = 0
+    status_mismatch_dict = defaultdict(int)
+    recorder = (
+        None if args.output is None else
+        trace.TraceRecorder(path=args.output, capacity=args.output_size)
+    )
+    try:
+        for record, replayed_record in trace.replay(
+            record_iterable=trace.iterTrace(args.trace),
+            reader=args.reader,
+            openpgp_class=(
+                loopback.LoopbackOpenPGPRandomPassword
+                if args.random_password else
+                loopback.LoopbackOpenPGP
+            ),
+            seed=args.seed,
+            recorder=recorder,
+        ):
+            caption = _getReplayCaption(record)
+            if replayed_record is None:
+                skipped_count += 1
+                continue
+            recorded_list, replayed_list = duration_dict[caption]
+            recorded_list.append(record.duration)
+            replayed_list.append(replayed_record.duration)
+            if record.status != replayed_record.status:
+                status_mismatch_dict[
+                    (caption, record.status, replayed_record.status)
+                ] += 1
+    finally:
+        if recorder is not None:
+            recorder.close()
+    print('%-28s %6s %14s %14s %8s' % (
+        'command', 'count', 'traced p50 (ms)', 'replay p50 (ms)', 'ratio',
+    ))
+    for caption, (recorded_list, replayed_list) in sorted(
+        duration_dict.items(),
+    ):
+        recorded = loopback.getPercentile(sorted(recorded_list), 50)
+        replayed = loopback.getPercentile(sorted(replayed_list), 50)
+        print('%-28s %6i %14.3f %14.3f %8s' % (
+            caption,
+            len(recorded_list),
+            recorded * 1000,
+            replayed * 1000,
+            '%.2f' % (replayed / recorded, ) if recorded else '-',
+        ))
+    print('skipped (unrecorded data, cannot be synthesized): %i' % (
+        skipped_count,
+    ))
+    for (caption, status, replayed_status), count in sorted(
+        status_mismatch_dict.items(),
+    ):
+        print('status mismatch: %s: traced %s, replayed %s (%i times)' % (
+            caption,
+            status.hex(),
+            replayed_status.hex(),
+            count,
+        ))
+
+def benchmarkCrypto(args):
+    percentile_list = (50, 90, 99)
+    role_dict = {
+        name: role
+        for role, name in cryptomatrix.ROLE_NAME_DICT.items()
+    }
+    writer = csv.writer(sys.stdout)
+    writer.writerow(
+        ['role', 'algorithm', 'attributes', 'operation', 'count'] +
+        ['p%i_ms' % (x, ) for x in percentile_list] +
+        ['error'],
+    )
+    with loopback.LoopbackCard() as loopback_card:
+        for entry in cryptomatrix.iterMatrix(
+            loopback_card=loopback_card,
+            role_list=(
+                None if args.role is None else
+                [role_dict[x] for x in args.role]
+            ),
+            caption_filter_list=args.algorithm,
+            keygen_count=args.keygen_count,
+            operation_count=args.count,
+        ):
+            duration_list = sorted(entry.duration_list)
+            writer.writerow(
+                [
+                    cryptomatrix.ROLE_NAME_DICT[entry.role],
+                    entry.caption,
+                    entry.attributes.hex(),
+                    entry.operation,
+                    len(duration_list),
+                ] +
+                [
+                    '%.3f' % (
+                        loopback.getPercentile(duration_list, x) * 1000,
+                    ) if duration_list else ''
+                    for x in percentile_list
+                ] +
+                [entry.error or ''],
+            )
+            sys.stdout.flush()
+
+def benchmarkCalibrate(args):
+    calibration = cryptomatrix.calibrate(
+        keygen_count=args.keygen_count,
+        operation_count=args.count,
+    )
+    calibration.save(args.output)
+    print('%-14s %-36s %12s %15s' % (
+        'role', 'algorithm', 'keygen (s)', 'operation (s)',
+    ))
+    for role, attributes in cryptomatrix.iterAlgorithmAttributes():
+        keygen_duration, operation_duration = calibration.get(
+            KEY_ROLE_TO_ATTRIBUTE_TAG_DICT[role],
+            attributes,
+        )
+        print('%-14s %-36s %12.3f %15s' % (
+            cryptomatrix.ROLE_NAME_DICT[role],
+            cryptomatrix.describeAlgorithmAttributes(role, attributes),
+            keygen_duration,
+            (
+                'failed'
+                if operation_duration is None else
+                '%.3f' % (operation_duration, )
+            ),
+        ))
+
+# Battery gauge states, each differing from the previous one (including when
+# wrapping around) so every frame is drawn.
+_BATTERY_STATE_LIST = [
+    (level, charging)
+    for charging in (False, True)
+    for level in range(1, 6)
+]
+
+def _getMedian(duration_list):
+    return loopback.getPercentile(sorted(duration_list), 50)
+
+def _measureHotPathList(args):
+    """
+    Return a dict of measurement name: median duration in seconds.
+    """
+    result = {}
+    with loopback.LoopbackCard() as loopback_card:
+        loopback_card.powerOn()
+        loopback_card.transmit(SELECT_OPENPGP)
+        loopback_card.transmit(b'\x00\x20\x00\x83\x08' + DEFAULT_PW3)
+        for entry in cryptomatrix.measureAlgorithmAttributes(
+            loopback_card=loopback_card,
+            role=KEY_ROLE_SIGN,
+            attributes=DEFAULT_ALGORITHM_ATTRIBUTES_SIGNATURE,
+            keygen_count=args.keygen_count,
+            operation_count=args.count,
+            import_count=0,
+        ):
+            if entry.error is not None:
+                raise ValueError('%s %s failed: %s' % (
+                    entry.caption,
+                    entry.operation,
+                    entry.error,
+                ))
+            result['%s %s' % (entry.caption, entry.operation)] = _getMedian(
+                entry.duration_list,
+            )
+    with BenchmarkCard() as benchmark_card:
+        card = benchmark_card.card
+        runAPDU(card, SELECT_OPENPGP)
+        runAPDU(card, b'\x00\x20\x00\x83\x08' + DEFAULT_PW3)
+        duration_list = []
+        for index in range(args.count):
+            # PUT DATA Name: each modification is a ZODB commit.
+            value = b'Benchmark<<%i' % (index, )
+            start = time.perf_counter()
+            response = runAPDU(
+                card,
+                b'\x00\xda\x00\x5b' + len(value).to_bytes(1, 'big') + value,
+            )
+            duration_list.append(time.perf_counter() - start)
+            if response != b'\x90\x00':
+                raise ValueError('PUT DATA failed: %s' % (response.hex(), ))
+        result['ZODB commit'] = _getMedian(duration_list)
+    try:
+        # pylint: disable=import-outside-toplevel
+        from smartcard.app.openpgp.cli.randpin.screen import (
+            DEFAULT_FONT_PATH,
+            PinDisplayScreen,
+        )
+        import freetype
+        # pylint: enable=import-outside-toplevel
+    except ImportError:
+        logger.warning('randpin dependencies missing, skipping PIN table')
+    else:
+        # Same geometry as the randpin e-paper display.
+        screen = PinDisplayScreen(
+            width=250,
+            height=122,
+            fontface=freetype.Face(args.font or DEFAULT_FONT_PATH),
+        )
+        # Done while idle, ahead of the table rotation.
+        duration_list = []
+        for _ in range(args.count):
+            start = time.perf_counter()
+            screen.prerenderPinTable()
+            duration_list.append(time.perf_counter() - start)
+            screen.drawPinTable(tries_left=3)
+        result['PIN table prerender'] = _getMedian(duration_list)
+        # What the host waits for on rotation.
+        duration_list = []
+        for index in range(args.count):
+            screen.prerenderPinTable()
+            start = time.perf_counter()
+            screen.drawPinTable(tries_left=index % 4)
+            duration_list.append(time.perf_counter() - start)
+        result['PIN table rotation'] = _getMedian(duration_list)
+    return result
+
+def benchmarkHotPath(args):
+    result = {
+        'profile': args.constrained_profile,
+        'duration': _measureHotPathList(args),
+    }
+    if args.output is not None:
+        with open(args.output, 'w', encoding='utf-8') as result_file:
+            json.dump(result, result_file, indent=2, sort_keys=True)
+    estimate_dict = {}
+    if args.factors is not None:
+        factors = CalibrationFactors.load(args.factors)
+        estimate_dict = factors.estimate(result)
+    board_duration_dict = {}
+    if args.board_result is not None:
+        with open(args.board_result, 'r', encoding='utf-8') as board_file:
+            board_result = json.load(board_file)
+        board_duration_dict = board_result['duration']
+        if args.save_factors is not None:
+            CalibrationFactors.fromResults(
+                board_result=board_result,
+                constrained_result=result,
+            ).save(args.save_factors)
+    print('%-40s %12s %14s %12s' % (
+        'measurement', 'p50 (ms)', 'estimate (ms)', 'board (ms)',
+    ))
+    regression_list = []
+    for name, duration in result['duration'].items():
+        estimate = estimate_dict.get(name)
+        board_duration = board_duration_dict.get(name)
+        print('%-40s %12.3f %14s %12s' % (
+            name,
+            duration * 1000,
+            '' if estimate is None else '%.3f' % (estimate * 1000, ),
+            '' if board_duration is None else '%.3f' % (
+                board_duration * 1000,
+            ),
+        ))
+        if (
+            estimate is not None and
+            board_duration is not None and
+            estimate > board_duration * (1 + args.tolerance)
+        ):
+            regression_list.append(name)
+    if regression_list:
+        print(
+            'Estimated board duration regressed by more than %i%%: %s' % (
+                args.tolerance * 100,
+                ', '.join(regression_list),
+            ),
+        )
+        sys.exit(1)
+
+def benchmarkDisplay(args):
+    try:
+        # pylint: disable=import-outside-toplevel
+        from smartcard.app.openpgp.cli.randpin.display import DisplayWorker
+        from smartcard.app.openpgp.cli.randpin.headless import (
+            HeadlessEPaper,
+            getImageRowList,
+            getPBM,
+        )
+        from smartcard.app.openpgp.cli.randpin.screen import (
+            DEFAULT_FONT_PATH,
+            MESSAGE_EXITED,
+            MESSAGE_READY_UNPLUGGED,
+            PinDisplayScreen,
+        )
+        import freetype
+        # pylint: enable=import-outside-toplevel
+    except ImportError as exc:
+        print('randpin dependencies missing: %s' % (exc, ))
+        sys.exit(1)
+    display = HeadlessEPaper(frame_path=args.frame_path)
+    screen = PinDisplayScreen(
+        # Note: framebuffer and display disagree on what is height and
+        # width, but are otherwise happy.
+        width=display.height,
+        height=display.width,
+        fontface=freetype.Face(args.font or DEFAULT_FONT_PATH),
+    )
+    def setupPinTable():
+        # So PIN tables, and golden images, are reproducible.
+        random.seed(0)
+    def drawPinTable(index):
+        screen.drawPinTable(tries_left=3 - index % 4)
+    def setupBattery():
+        screen.drawMessage(*MESSAGE_READY_UNPLUGGED)
+    def drawBattery(index):
+        level, charging = _BATTERY_STATE_LIST[
+            index % len(_BATTERY_STATE_LIST)
+        ]
+        screen.drawBattery(level=level, charging=charging)
+    def drawMessage(index):
+        screen.drawMessage(*(MESSAGE_READY_UNPLUGGED, MESSAGE_EXITED)[index & 1])
+    golden_error_list = []
+    if args.record_golden:
+        if args.golden is None:
+            print('--record-golden requires --golden')
+            sys.exit(1)
+        os.makedirs(args.golden, exist_ok=True)
+    display_worker = DisplayWorker(display)
+    display_worker.start()
+    try:
+        print('%-16s %12s %12s %12s %14s %12s' % (
+            'frame', 'render (ms)', 'frames/s', 'bytes/frame',
+            'refresh (ms)', 'refreshes/s',
+        ))
+        for name, setup, draw, full in (
+            ('PIN table', setupPinTable, drawPinTable, True),
+            ('battery', setupBattery, drawBattery, False),
+            ('message', None, drawMessage, False),
+        ):
+            if setup is not None:
+                setup()
+            refresh_index = len(display.refresh_list)
+            render_duration_list = []
+            frame_duration_list = []
+            for index in range(args.count):
+                start = time.perf_counter()
+                draw(index)
+                render_end = time.perf_counter()
+                frame, dirty_rect = screen.popFrame()
+                display_worker.submit(
+                    frame=frame,
+                    dirty_rect=dirty_rect,
+                    full=full,
+                    wait=True,
+                )
+                display_worker.flush()
+                end = time.perf_counter()
+                render_duration_list.append(render_end - start)
+                frame_duration_list.append(end - start)
+                if index == 0 and args.golden is not None:
+                    # First frame of each kind only, so it does not depend on
+                    # --count.
+                    image = getPBM(
+                        getImageRowList(
+                            display.getFrame(),
+                            display.height,
+                            display.width,
+                        ),
+                        display.height,
+                    )
+                    golden_path = os.path.join(
+                        args.golden,
+                        name.replace(' ', '-').lower() + '.pbm',
+                    )
+                    if args.record_golden:
+                        with open(golden_path, 'wb') as golden_file:
+                            golden_file.write(image)
+                    elif not os.path.exists(golden_path):
+                        golden_error_list.append(golden_path + ' (missing)')
+                    else:
+                        with open(golden_path, 'rb') as golden_file:
+                            if golden_file.read() != image:
+                                golden_path += '.actual.pbm'
+                                golden_error_list.append(golden_path)
+                                with open(golden_path, 'wb') as actual_file:
+                                    actual_file.write(image)
+            refresh_list = display.refresh_list[refresh_index:]
+            refresh_duration = sum(x for _, _, x in refresh_list) / len(
+                refresh_list,
+            )
+            print('%-16s %12.3f %12.1f %12.1f %14.1f %12.2f' % (
+                name,
+                _getMedian(render_duration_list) * 1000,
+                1 / _getMedian(frame_duration_list),
+                sum(x for _, x, _ in refresh_list) / len(refresh_list),
+                refresh_duration * 1000,
+                1 / refresh_duration,
+            ))
+    finally:
+        display_worker.close()
+    if golden_error_list:
+        print('Golden image check failed: %s' % (
+            ', '.join(golden_error_list),
+        ))
+        sys.exit(1)
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measure the cost of OpenPGP card operations.',
+    )
+    parser.add_argument(
+        '--verbose',
+        default='critical',
+        choices=['critical', 'error', 'warning', 'info', 'debug'],
+        help='Set verbosity level (default: %(default)s). Errors are expected '
+        'while waiting for background key generation.',
+    )
+    addConstrainedArgumentList(parser)
+    subparser_set = parser.add_subparsers(required=True)
+    apdu_parser = subparser_set.add_parser(
+        'apdu',
+        help='Compare read-only commands run with and without a transaction.',
+    )
+    apdu_parser.add_argument(
+        '--count',
+        type=int,
+        default=2000,
+        help='Number of times each command is run (default: %(default)s).',
+    )
+    apdu_parser.set_defaults(func=benchmarkAPDU)
+    farm_parser = subparser_set.add_parser(
+        'farm',
+        help='Measure card farm density and throughput.',
+    )
+    farm_parser.add_argument(
+        '--cards',
+        type=int,
+        default=200,
+        help='Number of cards to create (default: %(default)s).',
+    )
+    farm_parser.add_argument(
+        '--apdu-count',
+        type=int,
+        default=20000,
+        help='Number of commands to run (default: %(default)s).',
+    )
+    farm_parser.add_argument(
+        '--shard-count',
+        type=int,
+        default=1,
+        help='Number of farm processes for the socket test (default: '
+        '%(default)s).',
+    )
+    farm_parser.set_defaults(func=benchmarkFarm)
+    scenario_parser = subparser_set.add_parser(
+        'scenario',
+        help='Run scripted host sessions, reporting latency percentiles and '
+        'checking card answers. Exits with status 1 on any unexpected answer.',
+    )
+    scenario_parser.add_argument(
+        '--scenario',
+        action='append',
+        choices=list(loopback.SCENARIO_DICT),
+        help='Scenario to run, can be repeated (default: all).',
+    )
+    scenario_parser.add_argument(
+        '--iterations',
+        type=int,
+        default=50,
+        help='Number of times each scenario is run (default: %(default)s).',
+    )
+    scenario_parser.add_argument(
+        '--random-password',
+        action='store_true',
+        help='Use the random PIN variant of the application.',
+    )
+    scenario_parser.set_defaults(func=benchmarkScenario)
+    replay_parser = subparser_set.add_parser(
+        'replay',
+        help='Replay an APDU trace (see --trace option of card emulators) on '
+        'a fresh card, comparing command durations.',
+    )
+    replay_parser.add_argument(
+        'trace',
+        help='Trace file to replay.',
+    )
+    replay_parser.add_argument(
+        '--reader',
+        type=int,
+        default=0,
+        help='Index of the traced reader to replay (default: %(default)s).',
+    )
+    replay_parser.add_argument(
+        '--seed',
+        type=int,
+        default=0,
+        help='Seed for the data replacing unrecorded command data, for '
+        'reproducible replays (default: %(default)s).',
+    )
+    replay_parser.add_argument(
+        '--random-password',
+        action='store_true',
+        help='Use the random PIN variant of the application.',
+    )
+    replay_parser.add_argument(
+        '--output',
+        help='Trace file to record the replay into, for example to replay it '
+        'again with another version.',
+    )
+    replay_parser.add_argument(
+        '--output-size',
+        type=int,
+        default=65536,
+        help='Number of APDUs the output trace file holds '
+        '(default: %(default)s).',
+    )
+    replay_parser.set_defaults(func=benchmarkReplay)
+    crypto_parser = subparser_set.add_parser(
+        'crypto',
+        help='Measure key generation, key import and private key operation '
+        'for each supported algorithm attributes combination, as CSV on '
+        'standard output.',
+    )
+    crypto_parser.add_argument(
+        '--role',
+        action='append',
+        choices=list(cryptomatrix.ROLE_NAME_DICT.values()),
+        help='Key role to measure, can be repeated (default: all).',
+    )
+    crypto_parser.add_argument(
+        '--algorithm',
+        action='append',
+        help='Only measure combinations whose description contains this '
+        'string, case-insensitive, for example "RSA-2048" or "x25519". Can '
+        'be repeated (default: all).',
+    )
+    crypto_parser.add_argument(
+        '--keygen-count',
+        type=int,
+        default=3,
+        help='Number of keys to generate per combination (default: '
+        '%(default)s).',
+    )
+    crypto_parser.add_argument(
+        '--count',
+        type=int,
+        default=20,
+        help='Number of imports and private key operations per combination '
+        '(default: %(default)s).',
+    )
+    crypto_parser.set_defaults(func=benchmarkCrypto)
+    calibrate_parser = subparser_set.add_parser(
+        'calibrate',
+        help='Measure key generation and private key operation durations '
+        'of each supported algorithm, producing a file for the '
+        '--algorithm-calibration option of card emulators.',
+    )
+    calibrate_parser.add_argument(
+        'output',
+        help='Calibration file to create or replace.',
+    )
+    calibrate_parser.add_argument(
+        '--keygen-count',
+        type=int,
+        default=3,
+        help='Number of keys to generate per key type (default: '
+        '%(default)s).',
+    )
+    calibrate_parser.add_argument(
+        '--count',
+        type=int,
+        default=5,
+        help='Number of private key operations per combination (default: '
+        '%(default)s).',
+    )
+    calibrate_parser.set_defaults(func=benchmarkCalibrate)
+    memory_parser = subparser_set.add_parser(
+        'memory',
+        help='Run scripted host sessions with memory accounting, reporting '
+        'the memory each instruction retains and peaks at, and the memory '
+        'held by each subsystem afterwards.',
+    )
+    memory_parser.add_argument(
+        '--scenario',
+        action='append',
+        choices=list(loopback.SCENARIO_DICT),
+        help='Scenario to run, can be repeated (default: all).',
+    )
+    memory_parser.add_argument(
+        '--iterations',
+        type=int,
+        default=20,
+        help='Number of times each scenario is run (default: %(default)s).',
+    )
+    memory_parser.add_argument(
+        '--random-password',
+        action='store_true',
+        help='Use the random PIN variant of the application.',
+    )
+    memory_parser.add_argument(
+        '--snapshot-interval',
+        type=int,
+        default=10,
+        help='Every how many APDUs of each instruction to find which '
+        'subsystems retain memory (default: %(default)s).',
+    )
+    memory_parser.add_argument(
+        '--frame-count',
+        type=int,
+        default=16,
+        help='Number of stack frames kept per allocation (default: '
+        '%(default)s).',
+    )
+    memory_parser.set_defaults(func=benchmarkMemory)
+    hotpath_parser = subparser_set.add_parser(
+        'hotpath',
+        help='Measure the operations whose latency matters on small boards: '
+        'key generation, RSA signature, ZODB commit and PIN table rendering. '
+        'With calibration factors and a board result, exits with status 1 '
+        'when the estimated board duration of any of them regressed.',
+    )
+    hotpath_parser.add_argument(
+        '--keygen-count',
+        type=int,
+        default=3,
+        help='Number of keys to generate (default: %(default)s).',
+    )
+    hotpath_parser.add_argument(
+        '--count',
+        type=int,
+        default=20,
+        help='Number of times other operations are run (default: '
+        '%(default)s).',
+    )
+    hotpath_parser.add_argument(
+        '--font',
+        help='Font file to render the PIN table with (default: the random '
+        'PIN display one).',
+    )
+    hotpath_parser.add_argument(
+        '--output',
+        help='File to save the result into, for --board-result when run on '
+        'the board.',
+    )
+    hotpath_parser.add_argument(
+        '--board-result',
+        help='Result (see --output) of a run on the actual board, without '
+        'constrained profile.',
+    )
+    hotpath_parser.add_argument(
+        '--save-factors',
+        help='File to save calibration factors into, computed from '
+        '--board-result and the current run. To be run under the '
+        'constrained profile future runs will use.',
+    )
+    hotpath_parser.add_argument(
+        '--factors',
+        help='Calibration factors (see --save-factors) to estimate board '
+        'durations with.',
+    )
+    hotpath_parser.add_argument(
+        '--tolerance',
+        type=float,
+        default=.2,
+        help='Acceptable relative increase of estimated board durations over '
+        '--board-result ones (default: %(default)s).',
+    )
+    hotpath_parser.set_defaults(func=benchmarkHotPath)
+    display_parser = subparser_set.add_parser(
+        'display',
+        help='Render and send random PIN display frames to an emulated '
+        'e-paper display, reporting rendering and transfer rates, bytes sent '
+        'and estimated refresh durations.',
+    )
+    display_parser.add_argument(
+        '--count',
+        type=int,
+        default=100,
+        help='Number of frames of each kind (default: %(default)s).',
+    )
+    display_parser.add_argument(
+        '--font',
+        help='Font file to render frames with (default: the random PIN '
+        'display one).',
+    )
+    display_parser.add_argument(
+        '--frame-path',
+        help='Write each displayed frame to an image file. "%%i" is replaced '
+        'by the frame number, and PNG is used if FRAME_PATH ends with ".png", '
+        'PBM otherwise.',
+    )
+    display_parser.add_argument(
+        '--golden',
+        metavar='DIRECTORY',
+        help='Compare the first frame of each kind with the PBM image of the '
+        'same name in DIRECTORY. On mismatch, save the frame next to the '
+        'golden image. Exit with status 1 on mismatch or missing image. '
+        'Golden images depend on the font and FreeType version.',
+    )
+    display_parser.add_argument(
+        '--record-golden',
+        action='store_true',
+        help='Save the first frame of each kind as the --golden images '
+        'instead of comparing them.',
+    )
+    display_parser.set_defaults(func=benchmarkDisplay)
+    args = parser.parse_args()
+    logging.basicConfig(
+        stream=sys.stderr,
+    )
+    logging.getLogger('smartcard').setLevel(
+        level=args.verbose.upper(),
+    )
+    with constrainedProfile(args) as profile:
+        args.constrained_profile = profile
+        args.func(args)
@@ -0,0 +1,431 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2018-2020  Vincent Pelletier <plr.vincent@gmail.com>
+#
+# This file is part of python-smartcard-app-openpgp.
+# python-smartcard-app-openpgp is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# python-smartcard-app-openpgp is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with python-smartcard-app-openpgp.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Card farm: many independent, in-memory OpenPGP cards in one process (or
+sharded over several processes), reachable over a socket.
+
+FOR TESTING ONLY: nothing is persistent, and cards share their private keys.
+
+Protocol: each message, in either direction, is a 4 bytes big-endian length
+followed by that many bytes of payload.
+Request payload: card id (4 bytes, big-endian), operation (1 byte), data.
+Response payload: status (1 byte, 0 for success), data (or error message).
+Operations:
+- OPERATION_POWER_ON: clear volatile state, return the answer-to-reset
+- OPERATION_POWER_OFF: clear volatile state
+- OPERATION_APDU: run data as an APDU, return the response APDU
+- OPERATION_RESET: discard the card, a blank one is created on next access
+With several shards, card id N is served by shard N modulo the shard count,
+whose address is derived from the base address (see getShardAddress).
+"""
+
+import argparse
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import socket
+import struct
+import sys
+import threading
+import ZODB.DB
+from smartcard import (
+    Card,
+    MASTER_FILE_IDENTIFIER,
+)
+from smartcard.app.openpgp import (
+    KeygenService,
+    OpenPGP,
+)
+from smartcard.app.openpgp.fastpath import ReadOnlyFastPathCard
+from smartcard.app.openpgp.metrics import registry as metrics_registry
+from smartcard.utils import transaction_manager
+
+logger = logging.getLogger(__name__)
+
+OPENPGP_FILE_IDENTIFIER = b'\x12\x34'
+FARM_MANUFACTURER = b'\xff\x00'
+
+OPERATION_POWER_ON = 0
+OPERATION_POWER_OFF = 1
+OPERATION_APDU = 2
+OPERATION_RESET = 3
+
+STATUS_SUCCESS = 0
+STATUS_ERROR = 1
+
+_LENGTH = struct.Struct('>I')
+_REQUEST_HEADER = struct.Struct('>IB')
+
+_key_pool_hit_counter, _key_pool_miss_counter = (
+    metrics_registry.counter(
+        'smartcard_openpgp_farm_key_pool_total',
+        'Keys handed out by the farm key pool, by whether an '
+        'already-generated key was reused',
+        result=result,
+    )
+    for result in ('hit', 'miss')
+)
+
+class KeyPoolKeygenService(KeygenService):
+    """
+    Only generates up to pool_size keys per distinct algorithm attributes,
+    then hands out already-generated keys again, round-robin.
+    """
+    def __init__(self, pool_size=4):
+        super().__init__()
+        self.pool_size = pool_size
+        self.__lock = threading.Lock()
+        # Algorithm objects are not hashable.
+        # [(attributes, key_list, key_cycle), ...]
+        self.__pool_list = []
+
+    def _newKey(self, attributes):
+        with self.__lock:
+            for pool_attributes, key_list, key_cycle in self.__pool_list:
+                if pool_attributes == attributes:
+                    break
+            else:
+                key_list = []
+                key_cycle = itertools.cycle(key_list)
+                self.__pool_list.append((attributes, key_list, key_cycle))
+            if len(key_list) >= self.pool_size:
+                _key_pool_hit_counter.inc()
+                return next(key_cycle)
+        _key_pool_miss_counter.inc()
+        private_key = super()._newKey(attributes)
+        with self.__lock:
+            key_list.append(private_key)
+        return private_key
+
+key_pool = KeyPoolKeygenService()
+
+class FarmOpenPGP(OpenPGP):
+    """
+    OpenPGP application getting its private keys from the key pool shared by
+    all cards of the farm.
+    """
+    _keygen_service = key_pool
+
+class CardFarm:
+    """
+    Independent cards, each in its own in-memory database, created on first
+    access.
+    Must only be used from a single thread, as all cards share the
+    transaction manager Card.runAPDU uses.
+    """
+    def __init__(self, card_id_set=None, openpgp_class=FarmOpenPGP):
+        """
+        card_id_set (container of int, or None)
+            Identifiers of the cards this farm may create. None for any.
+        """
+        self.__card_id_set = card_id_set
+        self.__openpgp_class = openpgp_class
+        # card_id -> (db, connection, slot_card)
+        self.__card_dict = {}
+
+    def __len__(self):
+        return len(self.__card_dict)
+
+    def __getCard(self, card_id):
+        try:
+            return self.__card_dict[card_id][2]
+        except KeyError:
+            pass
+        if self.__card_id_set is not None and card_id not in self.__card_id_set:
+            raise KeyError('card %i is not served here' % (card_id, ))
+        db = ZODB.DB(None)
+        connection = db.open(transaction_manager=transaction_manager)
+        with transaction_manager:
+            card = connection.root.card = Card(
+                name='py-openpgp'.encode('ascii'),
+            )
+            openpgp = self.__openpgp_class(
+                identifier=OPENPGP_FILE_IDENTIFIER,
+                manufacturer=FARM_MANUFACTURER,
+                serial=card_id.to_bytes(4, 'big'),
+            )
+            openpgp.activateSelf()
+            card.createFile(
+                card.traverse((MASTER_FILE_IDENTIFIER, )),
+                openpgp,
+            )
+        slot_card = ReadOnlyFastPathCard(
+            card=card,
+            application=card.traverse(
+                (MASTER_FILE_IDENTIFIER, OPENPGP_FILE_IDENTIFIER),
+            ),
+        )
+        self.__card_dict[card_id] = (db, connection, slot_card)
+        return slot_card
+
+    def powerOn(self, card_id):
+        card = self.__getCard(card_id)
+        card.clearVolatile()
+        return card.getATR()
+
+    def powerOff(self, card_id):
+        self.__getCard(card_id).clearVolatile()
+
+    def runAPDU(self, card_id, command):
+        return self.__getCard(card_id).runAPDU(command)
+
+    def reset(self, card_id):
+        try:
+            db, connection, _ = self.__card_dict.pop(card_id)
+        except KeyError:
+            return
+        connection.close()
+        db.close()
+
+    def close(self):
+        for card_id in list(self.__card_dict):
+            self.reset(card_id)
+
+    def handleRequest(self, payload):
+        """
+        Decode and run a request payload, return the response payload.
+        """
+        try:
+            card_id, operation = _REQUEST_HEADER.unpack_from(payload)
+            data = bytearray(payload[_REQUEST_HEADER.size:])
+            if operation == OPERATION_APDU:
+                result = self.runAPDU(card_id, data)
+            elif operation == OPERATION_POWER_ON:
+                result = self.powerOn(card_id)
+            elif operation == OPERATION_POWER_OFF:
+                self.powerOff(card_id)
+                result = b''
+            elif operation == OPERATION_RESET:
+                self.reset(card_id)
+                result = b''
+            else:
+                raise ValueError('unknown operation %i' % (operation, ))
+        except Exception as exc: # pylint: disable=broad-except
+            logger.debug('Request failed', exc_info=1)
+            return bytes((STATUS_ERROR, )) + repr(exc).encode('utf-8')
+        return bytes((STATUS_SUCCESS, )) + bytes(result)
+
+def getShardAddress(address, shard, shard_count):
+    """
+    address (str or (host, port))
+        Base address: a UNIX socket path, or a TCP (host, port) tuple.
+    Returns the address of given shard: path suffixed with ".<shard>", or
+    port incremented by shard. Unchanged if there is a single shard.
+    """
+    if shard_count == 1:
+        return address
+    if isinstance(address, str):
+        return '%s.%i' % (address, shard)
+    host, port = address
+    return (host, port + shard)
+
+async def _serveConnection(farm, reader, writer):
+    try:
+        while True:
+            length, = _LENGTH.unpack(await reader.readexactly(_LENGTH.size))
+            response = farm.handleRequest(await reader.readexactly(length))
+            writer.write(_LENGTH.pack(len(response)) + response)
+            await writer.drain()
+    except asyncio.IncompleteReadError:
+        pass
+    finally:
+        writer.close()
+
+async def _serve(farm, address, onReady=None):
+    async def serveConnection(reader, writer):
+        await _serveConnection(farm, reader, writer)
+    if isinstance(address, str):
+        server = await asyncio.start_unix_server(serveConnection, path=address)
+    else:
+        host, port = address
+        server = await asyncio.start_server(
+            serveConnection,
+            host=host,
+            port=port,
+        )
+    async with server:
+        if onReady is not None:
+            onReady()
+        await server.serve_forever()
+
+def serve(address, shard=0, shard_count=1, key_pool_size=None, onReady=None):
+    """
+    Serve the cards of given shard on given address until interrupted.
+    key_pool_size (int, or None)
+        If not None, change the number of keys generated per key type.
+    onReady (callable, or None)
+        Called without arguments once the socket is listening.
+    """
+    if key_pool_size is not None:
+        key_pool.pool_size = key_pool_size
+    farm = CardFarm(
+        card_id_set=None if shard_count == 1 else range(
+            shard,
+            2 ** 32,
+            shard_count,
+        ),
+    )
+    try:
+        asyncio.run(_serve(farm, address, onReady=onReady))
+    finally:
+        farm.close()
+
+class FarmClient:
+    """
+    Synchronous client, routing each request to the shard serving its card.
+    """
+    def __init__(self, address, shard_count=1):
+        self.__socket_list = socket_list = []
+        for shard in range(shard_count):
+            shard_address = getShardAddress(address, shard, shard_count)
+            if isinstance(shard_address, str):
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            else:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.connect(shard_address)
+            socket_list.append(sock)
+
+    def close(self):
+        for sock in self.__socket_list:
+            sock.close()
+        self.__socket_list = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @staticmethod
+    def __recvExactly(sock, length):
+        result = bytearray()
+        while len(result) < length:
+            chunk = sock.recv(length - len(result))
+            if not chunk:
+                raise EOFError
+            result += chunk
+        return result
+
+    def request(self, card_id, operation, data=b''):
+        """
+        Run given operation on given card. Returns response data.
+        Raises ValueError if the farm reports an error.
+        """
+        sock = self.__socket_list[card_id % len(self.__socket_list)]
+        payload = _REQUEST_HEADER.pack(card_id, operation) + data
+        sock.sendall(_LENGTH.pack(len(payload)) + payload)
+        length, = _LENGTH.unpack(self.__recvExactly(sock, _LENGTH.size))
+        response = self.__recvExactly(sock, length)
+        if response[0] != STATUS_SUCCESS:
+            raise ValueError(response[1:].decode('utf-8', 'replace'))
+        return bytes(response[1:])
+
+    def powerOn(self, card_id):
+        return self.request(card_id, OPERATION_POWER_ON)
+
+    def powerOff(self, card_id):
+        self.request(card_id, OPERATION_POWER_OFF)
+
+    def runAPDU(self, card_id, command):
+        return self.request(card_id, OPERATION_APDU, bytes(command))
+
+    def reset(self, card_id):
+        self.request(card_id, OPERATION_RESET)
+
+def parseAddress(value):
+    """
+    Argument type: UNIX socket path if value contains a "/", otherwise
+    [host:]port .
+    """
+    if '/' in value:
+        return value
+    host, _, port = value.rpartition(':')
+    return (host or '127.0.0.1', int(port))
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Serve many in-memory OpenPGP cards over a socket, for '
+        'testing purposes. Cards share their private keys: DO NOT use them '
+        'for anything else.',
+    )
+    parser.add_argument(
+        '--address',
+        type=parseAddress,
+        required=True,
+        help='UNIX socket path (must contain a "/"), or [host:]port to '
+        'listen on. With several shards, shard N listens on the path suffixed '
+        'with ".N", or on port + N.',
+    )
+    parser.add_argument(
+        '--shard-count',
+        type=int,
+        default=1,
+        help='Number of processes to spread cards over (default: '
+        '%(default)s). Card N is served by shard N modulo this value.',
+    )
+    parser.add_argument(
+        '--key-pool-size',
+        type=int,
+        default=4,
+        help='Number of private keys to generate per key type, to then be '
+        'reused by all cards (default: %(default)s).',
+    )
+    parser.add_argument(
+        '--verbose',
+        default='warning',
+        choices=['critical', 'error', 'warning', 'info', 'debug'],
+        help='Set verbosity level (default: %(default)s).',
+    )
+    args = parser.parse_args()
+    logging.basicConfig(
+        stream=sys.stderr,
+    )
+    logging.getLogger('smartcard').setLevel(
+        level=args.verbose.upper(),
+    )
+    if args.shard_count == 1:
+        serve(args.address, key_pool_size=args.key_pool_size)
+        return
+    process_list = [
+        multiprocessing.Process(
+            target=serve,
+            kwargs={
+                'address': getShardAddress(
+                    args.address,
+                    shard,
+                    args.shard_count,
+                ),
+                'shard': shard,
+                'shard_count': args.shard_count,
+                'key_pool_size': args.key_pool_size,
+            },
+            name='farm-shard-%i' % (shard, ),
+        )
+        for shard in range(args.shard_count)
+    ]
+    for process in process_list:
+        process.start()
+    try:
+        for process in process_list:
+            process.join()
+    except KeyboardInterrupt:
+        for process in process_list:
+            process.terminate()
+            process.join()
@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2018-2020  Vincent Pelletier <plr.vincent@gmail.com>
+#
+# This file is part of python-smartcard-app-openpgp.
+# python-smartcard-app-openpgp is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# python-smartcard-app-openpgp is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with python-smartcard-app-openpgp.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Display output from a dedicated thread, so the USB path never waits on the
+panel.
+"""
+
+import logging
+import threading
+import time
+from smartcard.app.openpgp.events import (
+    EVENT_DISPLAY_REFRESH_END,
+    EVENT_DISPLAY_REFRESH_START,
+    event_ring,
+)
+from smartcard.app.openpgp.metrics import registry as metrics_registry
+from .framebuffer import Framebuffer
+from .waveshare_epaper import (
+    REFRESH_FULL,
+    REFRESH_PARTIAL,
+    RefreshPolicy,
+)
+
+logger = logging.getLogger(__name__)
+
+_display_update_duration_dict = {
+    (wait, mode): metrics_registry.histogram(
+        'smartcard_openpgp_display_update_duration_seconds',
+        'Time taken to send the framebuffer to the display, and to wait for '
+        'the refresh to complete if requested',
+        wait=str(wait).lower(),
+        mode=mode_name,
+    )
+    for wait in (False, True)
+    for mode, mode_name in (
+        (REFRESH_FULL, 'full'),
+        (REFRESH_PARTIAL, 'partial'),
+    )
+}
+_display_lut_load_duration = metrics_registry.histogram(
+    'smartcard_openpgp_display_lut_load_duration_seconds',
+    'Time taken to load the waveform LUT when changing refresh mode',
+)
+_display_transfer_byte_counter_dict = {
+    partial: metrics_registry.counter(
+        'smartcard_openpgp_display_transfer_bytes_total',
+        'Image bytes sent to the display',
+        partial=str(partial).lower(),
+    )
+    for partial in (False, True)
+}
+_display_coalesced_frame_counter = metrics_registry.counter(
+    'smartcard_openpgp_display_coalesced_frames_total',
+    'Frames replaced by a newer one before being sent to the display',
+)
+
+def _getRectUnion(rect_a, rect_b):
+    """
+    Return the smallest (x_min, x_max, y_min, y_max) rectangle containing both
+    given ones, max being excluded. Empty rectangles are ignored.
+    """
+    if rect_a[0] == rect_a[1]:
+        return rect_b
+    if rect_b[0] == rect_b[1]:
+        return rect_a
+    return (
+        min(rect_a[0], rect_b[0]),
+        max(rect_a[1], rect_b[1]),
+        min(rect_a[2], rect_b[2]),
+        max(rect_a[3], rect_b[3]),
+    )
+
+class DisplayWorker:
+    """
+    Owns the display (and the SPI and GPIO handles it opens): only the worker
+    thread talks to it.
+    Frames are submitted without blocking. When several are submitted while
+    the panel is busy, only the newest one is sent.
+    """
+    def __init__(
+        self,
+        display,
+        refresh_policy=None,
+        partial_update_max_ratio=.75,
+    ):
+        """
+        display (WaveShareEPaper)
+            Not entered yet: the worker thread enters and exits it.
+        refresh_policy (RefreshPolicy, or None)
+            None to use a default RefreshPolicy.
+        partial_update_max_ratio (float)
+            Above this fraction of the screen, send the whole frame instead of
+            only its changed region.
+        """
+        self.__display = display
+        if refresh_policy is None:
+            refresh_policy = RefreshPolicy()
+        self.__refresh_policy = refresh_policy
+        self.__partial_update_max_ratio = partial_update_max_ratio
+        # Same geometry as the framebuffers submitting frames, to extract
+        # changed regions from frames.
+        self.__framebuffer = Framebuffer(
+            width=display.height,
+            height=display.width,
+        )
+        self.__condition = threading.Condition()
+        # (frame, dirty rect, full, wait), or None
+        self.__pending = None
+        self.__busy = False
+        self.__closing = False
+        self.__thread = None
+        self.__ready = threading.Event()
+        self.__error = None
+        self.__previous_dirty_rect = (0, 0, 0, 0)
+
+    def start(self):
+        """
+        Start the worker thread, and wait for it to open the display.
+        """
+        self.__thread = thread = threading.Thread(
+            target=self.__run,
+            name='display',
+            daemon=True,
+        )
+        thread.start()
+        self.__ready.wait()
+        if self.__error is not None:
+            self.__thread.join()
+            self.__thread = None
+            raise self.__error
+
+    def submit(self, frame, dirty_rect, full=False, wait=False):
+        """
+        Queue a frame for display, replacing any not yet sent.
+        frame (bytes)
+            Framebuffer content, ex: from Framebuffer.saveLayer.
+        dirty_rect (tuple)
+            Region changed since the previous frame, ex: from
+            Framebuffer.popDirtyRect.
+        full (bool)
+            Whether a full refresh is needed, see RefreshPolicy.getMode.
+        wait (bool)
+            Whether the worker must wait for the refresh to complete before
+            looking at the next frame.
+        """
+        with self.__condition:
+            pending = self.__pending
+            if pending is not None:
+                _display_coalesced_frame_counter.inc()
+                _, pending_dirty_rect, pending_full, pending_wait = pending
+                dirty_rect = _getRectUnion(dirty_rect, pending_dirty_rect)
+                full = full or pending_full
+                wait = wait or pending_wait
+            self.__pending = (frame, dirty_rect, full, wait)
+            self.__condition.notify_all()
+
+    def flush(self):
+        """
+        Wait until submitted frames are sent.
+        """
+        with self.__condition:
+            while (
+                self.__pending is not None or self.__busy
+            ) and self.__thread is not None:
+                self.__condition.wait()
+
+    def close(self):
+        """
+        Send any pending frame, stop the worker and close the display.
+        """
+        if self.__thread is not None:
+            with self.__condition:
+                self.__closing = True
+                self.__condition.notify_all()
+            self.__thread.join()
+            self.__thread = None
+
+    def __run(self):
+        display = self.__display
+        condition = self.__condition
+        try:
+            display.__enter__()
+        except Exception as exc: # pylint: disable=broad-except
+            self.__error = exc
+            self.__ready.set()
+            return
+        try:
+            self.__ready.set()
+            while True:
+                with condition:
+                    while self.__pending is None and not self.__closing:
+                        condition.wait()
+                    pending = self.__pending
+                    if pending is None:
+                        break
+                    self.__pending = None
+                    self.__busy = True
+                try:
+                    self.__show(*pending)
+                except Exception: # pylint: disable=broad-except
+                    logger.exception('Failed to update display')
+                finally:
+                    with condition:
+                        self.__busy = False
+                        condition.notify_all()
+            # Let the last refresh complete before putting the panel to sleep.
+            display.wait()
+        finally:
+            display.__exit__(None, None, None)
+            with condition:
+                # Release any flush caller.
+                self.__thread = None
+                condition.notify_all()
+
+    def __show(self, frame, dirty_rect, full, wait):
+        event_ring.record(EVENT_DISPLAY_REFRESH_START, wait)
+        start = time.perf_counter()
+        display = self.__display
+        fb = self.__framebuffer
+        fb.restoreLayer(frame)
+        row_count = (fb.height + 7) >> 3
+        mode = self.__refresh_policy.getMode(
+            (dirty_rect[1] - dirty_rect[0]) * (dirty_rect[3] - dirty_rect[2]) /
+            (fb.width * row_count),
+            full=full,
+        )
+        # Vendor examples write frames twice for partial updates, as the
+        # controller seems to alternate between 2 RAM banks: also send what
+        # changed for the previous refresh, so no bank holds stale pixels.
+        x_min, x_max, y_min, y_max = _getRectUnion(
+            dirty_rect,
+            self.__previous_dirty_rect,
+        )
+        self.__previous_dirty_rect = dirty_rect
+        if x_min < x_max:
+            # Framebuffer columns are display lines, in reverse order, and
+            # framebuffer byte rows are display line bytes.
+            windowed = (
+                (x_max - x_min) * (y_max - y_min) <=
+                fb.width * row_count * self.__partial_update_max_ratio
+            )
+            if windowed:
+                image = fb.getRect(x_min, x_max, y_min, y_max)
+                display.setWindow(
+                    y_min << 3,
+                    display.height - x_max,
+                    (y_max << 3) - 1,
+                    display.height - 1 - x_min,
+                )
+                display.blit(image=image, x=y_min << 3, y=0)
+            else:
+                image = frame
+                display.setWindow(0, 0, display.width - 1, display.height - 1)
+                display.blit(image=image, x=0, y=0)
+            _display_transfer_byte_counter_dict[windowed].inc(len(image))
+        if mode is not display.refresh_mode:
+            # Let any ongoing refresh complete first, so it is not accounted
+            # as LUT load time.
+            display.wait()
+            lut_start = time.perf_counter()
+            display.setRefreshMode(mode)
+            _display_lut_load_duration.observe(time.perf_counter() - lut_start)
+        display.swap(wait=wait)
+        _display_update_duration_dict[(wait, mode)].observe(
+            time.perf_counter() - start,
+        )
+        event_ring.record(EVENT_DISPLAY_REFRESH_END)
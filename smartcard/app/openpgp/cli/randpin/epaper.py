@@ -16,13 +16,12 @@
 # along with python-smartcard-app-openpgp.  If not, see <http://www.gnu.org/licenses/>.
 
 from collections import deque
+import contextlib
 import errno
 import fcntl
 import functools
-import itertools
 import logging
 import os
-import random
 import select
 import sys
 import time
@@ -49,8 +48,43 @@ from smartcard.app.openpgp import (
     OpenPGPRandomPassword,
     PINQueueConnection,
 )
+from smartcard.app.openpgp.cryptomatrix import (
+    addCalibrationArgumentList,
+    setupAlgorithmPolicy,
+)
+from smartcard.app.openpgp.events import (
+    EventCard,
+    addEventArgumentList,
+    getEventDumper,
+)
+from smartcard.app.openpgp.fastpath import ReadOnlyFastPathCard
+from smartcard.app.openpgp.memory import (
+    MemoryAccountingCard,
+    addMemoryArgumentList,
+    getMemoryMonitor,
+)
+from smartcard.app.openpgp.metrics import (
+    MetricsCard,
+    addMetricsArgumentList,
+    getMetricsExporter,
+)
+from smartcard.app.openpgp.profiling import (
+    ProfilingCard,
+    addProfilerArgumentList,
+    getAPDUProfiler,
+)
 from smartcard.utils import transaction_manager
-from .framebuffer import Framebuffer
+from .display import DisplayWorker
+from .headless import HeadlessEPaper
+from .screen import (
+    DEFAULT_FONT_PATH,
+    DISPLAY_COLUMN_NAME,
+    DISPLAY_ROW_NAME,
+    MESSAGE_EXITED,
+    MESSAGE_LOW_BATTERY,
+    MESSAGE_READY_UNPLUGGED,
+    PinDisplayScreen,
+)
 from .waveshare_epaper import WaveShareEPaper
 
 logger = logging.getLogger(__name__)
@@ -164,28 +198,7 @@ class _Login1ManagerIdleInhibitor:
 # When card application exits: Display a power-down message
 # When not enumerated/plugged: Display a "connect to host" message
 
-DISPLAY_ROW_NAME = ('A', 'B', 'C', 'D')
-DISPLAY_COLUMN_NAME = ('1', '2', '3')
-
 class ICCDFunctionWithRandomPinDisplay(ICCDFunction):
-    _column_width = 75
-    _line_height = 21
-    _line_height_with_margin = _line_height + 3
-    _column_name_height = 18
-    _column_name_x_offset = 28
-    _row_name_width = 16
-    _column_x_offset = 25
-    _column_name_to_x = {
-        '1': 0 * _column_width + _column_x_offset,
-        '2': 1 * _column_width + _column_x_offset,
-        '3': 2 * _column_width + _column_x_offset,
-    }
-    _row_name_to_y = {
-        'A': 1 * _line_height_with_margin,
-        'B': 2 * _line_height_with_margin,
-        'C': 3 * _line_height_with_margin,
-        'D': 4 * _line_height_with_margin,
-    }
     _can_generate = False
     __connection = None
     __db = None
@@ -194,13 +207,15 @@ class ICCDFunctionWithRandomPinDisplay(ICCDFunction):
     __OPENPGP_FILE_IDENTIFIER = b'\x12\x34'
     __PIN_GENERATION_DELAY = 30
     __next_pin_generation = 0
+    # Let the new table refresh and the host react before rendering the next
+    # table.
+    __PIN_PRERENDER_DELAY = 1
+    __next_pin_prerender = 0
+    __BATTERY_CHECK_DELAY = 60
 
     __battery_capacity_path = '/sys/class/power_supply/battery/capacity'
-    __battery_x = 218
-    __battery_y = 4
-    __battery_width = 32
-    __battery_height = 11
-    __battery_last_state = (None, None)
+    # Charging state the idle inhibitor was last updated for.
+    __battery_charging = None
     __idle_inhibitor = None
 
     def __init__(
@@ -211,30 +226,43 @@ class ICCDFunctionWithRandomPinDisplay(ICCDFunction):
         fontface,
         slot_count=1,
         gpiochip=None,
+        metrics_exporter=None,
+        event_dumper=None,
+        profiler=None,
+        memory_monitor=None,
     ):
         super().__init__(path=path, slot_count=slot_count)
+        self.__profiler = profiler
+        self.__memory_monitor = memory_monitor
+        self.__metrics_exporter = metrics_exporter
+        self.__event_dumper = event_dumper
         self.__zodb_path = zodb_path
-        self.__display = display
-        self.__fontface = fontface
-        self.__framebuffer = Framebuffer( # XXX: use PIL instead of custom framebuffer ?
+        # Only the worker thread talks to the display, so USB event handling
+        # never waits for the panel.
+        self.__display_worker = DisplayWorker(display=display)
+        self.__screen = PinDisplayScreen(
             # Note: framebuffer and display disagree on what is height and
             # width, but are otherwise happy.
             width=display.height,
             height=display.width,
+            fontface=fontface,
         )
         # Each item is a mapping from cell ids to contained PIN for the whole
         # generated table. Cell ids are a row name followed by a column name.
         self.__pin_queue = deque([], 2)
-        # Probe GPIO pin 4 state before opening it.
-        battery_gpio_info = gpiochip.getLineInfo(4)
-        self.__has_battery = has_battery = (
-            os.path.exists(self.__battery_capacity_path) and
-            battery_gpio_info['flags'] & GPIO_V2_LINE_FLAG.INPUT and
-            not battery_gpio_info['flags'] & GPIO_V2_LINE_FLAG.USED
-        )
-        self.__exit_message_x = 85
-        self.__exit_message_y = 45
-        self.__exit_message = 'Exited'
+        if gpiochip is None:
+            # No GPIO access (ex: headless display): assume no battery.
+            has_battery = False
+        else:
+            # Probe GPIO pin 4 state before opening it.
+            battery_gpio_info = gpiochip.getLineInfo(4)
+            has_battery = (
+                os.path.exists(self.__battery_capacity_path) and
+                battery_gpio_info['flags'] & GPIO_V2_LINE_FLAG.INPUT and
+                not battery_gpio_info['flags'] & GPIO_V2_LINE_FLAG.USED
+            )
+        self.__has_battery = has_battery
+        self.__exit_message = MESSAGE_EXITED
         if has_battery:
             self.__battery_gpio = battery_gpio = gpiochip.openLines(
                 line_list=[4],
@@ -253,46 +281,32 @@ class ICCDFunctionWithRandomPinDisplay(ICCDFunction):
                 fcntl.fcntl(battery_gpio, fcntl.F_GETFL) | os.O_NONBLOCK,
             )
             self.__idle_inhibitor = _Login1ManagerIdleInhibitor()
+        # Render static layers in advance.
+        self.__screen.drawMessage(*self.__exit_message)
 
-    def updateDisplay(self, wait=True):
-        display = self.__display
-        display.blit(
-            image=self.__framebuffer.pixelbuffer,
-            x=0,
-            y=0,
-        )
-        display.swap(wait=wait)
-
-    def _blank(self, color):
-        # Battery need a redraw
-        self.__battery_last_state = (None, None)
-        self.__framebuffer.blank(color=color)
-
-    def printAt(
-        self,
-        x,
-        y,
-        text,
-        width=None,
-        color=Framebuffer.COLOR_XOR,
-    ):
-        self.__framebuffer.printLineAt(
-            self.__fontface,
-            x=x,
-            y=y,
-            text=text,
-            width=width,
-            height=self._line_height,
-            color=color,
+    def updateDisplay(self, wait=True, full=False):
+        """
+        Submit the framebuffer content to the display worker.
+        wait (bool)
+            Whether to return only once the display refresh is complete.
+            Otherwise, return immediately.
+        full (bool)
+            Whether to refresh the whole panel even if little changed, to
+            clear ghosting. Otherwise, the refresh policy decides.
+        """
+        frame, dirty_rect = self.__screen.popFrame()
+        display_worker = self.__display_worker
+        display_worker.submit(
+            frame=frame,
+            dirty_rect=dirty_rect,
+            full=full,
+            wait=wait,
         )
+        if wait:
+            display_worker.flush()
 
     def displayReadyUnplugged(self):
-        self._blank(color=Framebuffer.COLOR_OFF)
-        self.printAt(
-            x=35,
-            y=45,
-            text="Ready, unplugged",
-        )
+        self.__screen.drawMessage(*MESSAGE_READY_UNPLUGGED)
         self.displayBattery()
         self.updateDisplay(wait=False)
 
@@ -312,10 +326,7 @@ class ICCDFunctionWithRandomPinDisplay(ICCDFunction):
             if capacity < threshold:
                 break
         charging = self.__battery_gpio.value
-        state = (level, charging)
-        if state == self.__battery_last_state:
-            return False
-        if charging != self.__battery_last_state[1]:
+        if charging != self.__battery_charging:
             # Note: using charging status as a surogate for connection to USB
             # host: UDCs typically detect disconnect when vbus goes low, but on
             # my reference board (raspberry pi zero) vbus is bridged to system
@@ -329,258 +340,21 @@ class ICCDFunctionWithRandomPinDisplay(ICCDFunction):
                 self.__idle_inhibitor.inhibit()
             else:
                 self.__idle_inhibitor.allow()
-        self.__battery_last_state = state
-        fb = self.__framebuffer
-        battery_middle, battery_middle_remainder = divmod(self.__battery_height, 2)
-        fb.rect( # battery bump
-            self.__battery_x,
-            self.__battery_y + battery_middle - 2,
-            self.__battery_x + 2,
-            self.__battery_y + battery_middle + 2 + battery_middle_remainder,
-            color=fb.COLOR_ON,
-            fill=True,
-        )
-        fb.rect( # battery body and draw area
-            self.__battery_x + 2,
-            self.__battery_y,
-            self.__battery_x - 2 + self.__battery_width,
-            self.__battery_y + self.__battery_height,
-            color=fb.COLOR_ON,
-            fill=True,
-        )
+            self.__battery_charging = charging
         if not charging and level == 0:
-            self.__exit_message_x = 60
-            self.__exit_message_y = 45
-            self.__exit_message = "Low battery"
+            self.__exit_message = MESSAGE_LOW_BATTERY
             raise SystemShutdown
-        bar_width = (self.__battery_width - 4) // 4
-        for index in range(4):
-            fb.rect(
-                self.__battery_x + 2 + index       * bar_width + 1,
-                self.__battery_y + 1,
-                self.__battery_x + 2 + (index + 1) * bar_width - 1,
-                self.__battery_y - 1 + self.__battery_height,
-                color=fb.COLOR_OFF,
-                fill=level > (4 - index),
-            )
-        if charging:
-            # Draw the lightning bolt as two filled triangles
-            left_x = self.__battery_x + 4
-            left_y = self.__battery_y + 6
-            right_x = self.__battery_x + self.__battery_width - 4
-            right_y = self.__battery_y + 6
-            middle_x = left_x + (right_x - left_x) // 2
-            middle_top = self.__battery_y + 2
-            middle_half_width = 4
-            line = fb.line
-            for offset in range(middle_half_width + 1):
-                line(
-                    left_x, left_y,
-                    middle_x, middle_top + offset,
-                    color=Framebuffer.COLOR_ON,
-                )
-            for offset in range(middle_half_width):
-                line(
-                    middle_x, middle_top + middle_half_width + offset,
-                    right_x, right_y,
-                    color=Framebuffer.COLOR_ON,
-                )
-            # top left outline
-            line(
-                left_x, left_y,
-                middle_x, middle_top,
-                color=Framebuffer.COLOR_OFF,
-            )
-            # center left outline
-            line(
-                left_x, left_y,
-                middle_x - 1, middle_top + middle_half_width,
-                color=Framebuffer.COLOR_OFF,
-            )
-            # bottom left outline
-            line(
-                middle_x - 1, middle_top + middle_half_width,
-                middle_x, middle_top + middle_half_width + middle_half_width,
-                color=Framebuffer.COLOR_OFF,
-            )
-            # top right outline
-            line(
-                middle_x, middle_top,
-                middle_x + 1, middle_top + middle_half_width,
-                color=Framebuffer.COLOR_OFF,
-            )
-            # center right outline
-            line(
-                middle_x + 1, middle_top + middle_half_width,
-                right_x, right_y,
-                color=Framebuffer.COLOR_OFF,
-            )
-            # bottom right outline
-            line(
-                middle_x, middle_top + middle_half_width + middle_half_width,
-                right_x, right_y,
-                color=Framebuffer.COLOR_OFF,
-            )
-        return True
+        return self.__screen.drawBattery(level=level, charging=charging)
 
     def __generatePinTable(self, tries_left, force=False):
         if not self._can_generate and not force:
             return
-        fb = self.__framebuffer
-        self._blank(color=fb.COLOR_ON)
-        # Column headers background
-        fb.rect(
-            0, 0,
-            self._row_name_width, fb.height - 1,
-            color=fb.COLOR_OFF,
-            fill=True,
-        )
-        fb.rect(
-            self._row_name_width, 0,
-            fb.width - 1, self._column_name_height,
-            color=fb.COLOR_OFF,
-            fill=True,
-        )
-        # Rounded corners
-        fb.rect(
-            self._row_name_width + 1, self._column_name_height + 1,
-            self._row_name_width + 1 + 8, self._column_name_height + 1 + 8,
-            color=fb.COLOR_OFF,
-            fill=True,
-        )
-        fb.circle(
-            self._row_name_width + 1 + 8, self._column_name_height + 1 + 8,
-            8,
-            color=fb.COLOR_ON,
-            fill=True,
-        )
-        fb.rect(
-            fb.width - 1 - 8, self._column_name_height + 1,
-            fb.width - 1, self._column_name_height + 1 + 8,
-            color=fb.COLOR_OFF,
-            fill=True,
-        )
-        fb.circle(
-            fb.width - 1 - 8, self._column_name_height + 1 + 8,
-            8,
-            color=fb.COLOR_ON,
-            fill=True,
-        )
-        fb.rect(
-            self._row_name_width + 1, fb.height - 1 - 8,
-            self._row_name_width + 1 + 8, fb.height - 1,
-            color=fb.COLOR_OFF,
-            fill=True,
-        )
-        fb.circle(
-            self._row_name_width + 1 + 8, fb.height - 1 - 8,
-            8,
-            color=fb.COLOR_ON,
-            fill=True,
-        )
-        fb.rect(
-            fb.width - 1 - 8, fb.height - 1 - 8,
-            fb.width - 1, fb.height - 1,
-            color=fb.COLOR_OFF,
-            fill=True,
-        )
-        fb.circle(
-            fb.width - 1 - 8, fb.height - 1 - 8,
-            8,
-            color=fb.COLOR_ON,
-            fill=True,
-        )
-        # Column headers captions
-        for caption, x in self._column_name_to_x.items():
-            self.printAt(
-                x + self._column_name_x_offset, 0,
-                caption,
-                width=15,
-                color=Framebuffer.COLOR_ON,
-            )
-        for caption, y in self._row_name_to_y.items():
-            self.printAt(
-                3, y,
-                caption,
-                width=15,
-                color=Framebuffer.COLOR_ON,
-            )
-        # 3-tries background
-        fb.circle(
-            8, 8, 8,
-            color=Framebuffer.COLOR_ON,
-            fill=True,
-        )
-        fb.circle(
-            34, 8, 8,
-            color=Framebuffer.COLOR_ON,
-            fill=True,
-        )
-        fb.rect(
-            8, 0,
-            34, 16,
-            color=Framebuffer.COLOR_ON,
-            fill=True,
-        )
-        for index, center_x in ((0, 8), (1, 21), (2, 34)):
-            if tries_left <= index:
-                # Try failed: cross
-                fb.line(
-                    center_x - 4, 4,
-                    center_x + 4, 12,
-                    color=Framebuffer.COLOR_OFF,
-                )
-                fb.line(
-                    center_x - 3, 4,
-                    center_x + 4, 11,
-                    color=Framebuffer.COLOR_OFF,
-                )
-                fb.line(
-                    center_x - 4, 5,
-                    center_x + 3, 12,
-                    color=Framebuffer.COLOR_OFF,
-                )
-                fb.line(
-                    center_x + 4, 4,
-                    center_x - 4, 12,
-                    color=Framebuffer.COLOR_OFF,
-                )
-                fb.line(
-                    center_x + 3, 4,
-                    center_x - 4, 11,
-                    color=Framebuffer.COLOR_OFF,
-                )
-                fb.line(
-                    center_x + 4, 5,
-                    center_x - 3, 12,
-                    color=Framebuffer.COLOR_OFF,
-                )
-            else:
-                # Try still available: circle
-                fb.circle(
-                    center_x, 8, 5,
-                    color=Framebuffer.COLOR_OFF,
-                    fill=False,
-                )
-        # Generate random PINs and display them
-        pin_dict = {}
-        for row_name, column_name in itertools.product(
-            DISPLAY_ROW_NAME,
-            DISPLAY_COLUMN_NAME,
-        ):
-            pin_dict[
-                row_name + column_name
-            ] = value = '%06i' % random.randint(0, 999999)
-            self.printAt(
-                self._column_name_to_x[column_name],
-                self._row_name_to_y[row_name],
-                value,
-                width=self._column_width,
-                color=Framebuffer.COLOR_OFF,
-            )
+        pin_dict = self.__screen.drawPinTable(tries_left=tries_left)
         self.displayBattery()
-        self.updateDisplay(wait=False)
+        # PINs must not be misread because of ghosting.
+        self.updateDisplay(wait=False, full=True)
         self.__pin_queue.append(pin_dict)
+        self.__next_pin_prerender = time.time() + self.__PIN_PRERENDER_DELAY
 
     def __enter__(self):
         try:
@@ -594,6 +368,7 @@ class ICCDFunctionWithRandomPinDisplay(ICCDFunction):
     def __enter(self):
         if self.__has_battery:
             self.__idle_inhibitor.open()
+        self.__display_worker.start()
         self.displayReadyUnplugged()
         logger.info('Initialising the database...')
         # Note: access __pin_queue outside of DB declaration to get the
@@ -640,11 +415,6 @@ class ICCDFunctionWithRandomPinDisplay(ICCDFunction):
         else:
             logger.info('Card data found, using it.')
         self.__card = card
-        logger.info('Inserting the OpenPGP card into slot 0...')
-        # TODO: some way of removing/inserting multiple cards ?
-        # Ex: one card per thread with a threaded tranaction manager, and some
-        # UI on the gadget to let the user select the card to plug.
-        self.slot_list[0].insert(card)
         # XXX: Do slow operations now, to avoid timeouts later. Especially, the
         # DWC2 accepts receiving transfer requests while USB bus is active, but
         # rejects them at any other time - including when USB bus is suspended
@@ -653,26 +423,66 @@ class ICCDFunctionWithRandomPinDisplay(ICCDFunction):
         # delay expires.
         logger.debug('Loading OpenPGP from database...')
         with transaction_manager:
-            self.__card.traverse(
+            self.__openpgp = openpgp = card.traverse(
                 path=(MASTER_FILE_IDENTIFIER, self.__OPENPGP_FILE_IDENTIFIER),
-            ).getPIN1TriesLeft()
+            )
+            openpgp.getPIN1TriesLeft()
+        logger.info('Inserting the OpenPGP card into slot 0...')
+        # TODO: some way of removing/inserting multiple cards ?
+        # Ex: one card per thread with a threaded tranaction manager, and some
+        # UI on the gadget to let the user select the card to plug.
+        slot_card = ReadOnlyFastPathCard(
+            card=card,
+            application=openpgp,
+        )
+        if self.__metrics_exporter is not None:
+            slot_card = MetricsCard(
+                card=slot_card,
+                getStorageState=self.__getStorageState,
+            )
+            self.__metrics_exporter.start()
+        if self.__event_dumper is not None:
+            slot_card = EventCard(card=slot_card)
+            self.__event_dumper.start()
+        if self.__profiler is not None:
+            slot_card = ProfilingCard(card=slot_card, profiler=self.__profiler)
+            self.__profiler.start()
+        if self.__memory_monitor is not None:
+            slot_card = MemoryAccountingCard(
+                card=slot_card,
+                monitor=self.__memory_monitor,
+            )
+            self.__memory_monitor.addDatabaseGetter(self.__getDatabase)
+            self.__memory_monitor.start()
+        self.slot_list[0].insert(slot_card)
         logger.debug('Waiting for screen to be ready...')
-        self.__display.wait()
+        self.__display_worker.flush()
+
+    def __getDatabase(self):
+        return self.__db
+
+    def __getStorageState(self):
+        storage = self.__db.storage
+        return storage.lastTransaction(), storage.getSize()
 
     def __unenter(self):
+        if self.__metrics_exporter is not None:
+            self.__metrics_exporter.close()
+        if self.__event_dumper is not None:
+            self.__event_dumper.close()
+        if self.__profiler is not None:
+            self.__profiler.close()
+        if self.__memory_monitor is not None:
+            self.__memory_monitor.close()
         if self.__connection is not None:
             self.__connection.close()
             self.__connection = None
         if self.__db is not None:
             self.__db.close()
             self.__db = None
-        self._blank(color=Framebuffer.COLOR_OFF)
-        self.printAt(
-            x=self.__exit_message_x,
-            y=self.__exit_message_y,
-            text=self.__exit_message,
-        )
-        self.updateDisplay()
+        self.__screen.drawMessage(*self.__exit_message)
+        self.updateDisplay(wait=False)
+        self.__display_worker.close()
         if self.__has_battery:
             self.__idle_inhibitor.close()
 
@@ -692,47 +502,84 @@ class ICCDFunctionWithRandomPinDisplay(ICCDFunction):
         event_dict = {
             self.eventfd.fileno(): (select.EPOLLIN, self.processEvents),
         }
-        timeout_handler_list = []
-        epoll_timeout = None
+        next_battery_check = None
         if self.__has_battery:
             event_dict[self.__battery_gpio.fileno()] = (
                 select.POLLIN | select.POLLPRI,
                 self._onBatteryEvent,
             )
-            # Check battery level every minute
-            epoll_timeout = 60
-            timeout_handler_list.append(self._onBatteryEvent)
+            next_battery_check = time.time() + self.__BATTERY_CHECK_DELAY
         with select.epoll() as epoll:
             for fd, (event_mask, _) in event_dict.items():
                 epoll.register(fd, event_mask)
             poll = epoll.poll
             while self._open:
+                deadline_list = [
+                    x
+                    for x in (
+                        next_battery_check,
+                        self.__getPinTableDeadline(),
+                    )
+                    if x is not None
+                ]
                 try:
-                    event_list = poll(epoll_timeout)
+                    event_list = poll(
+                        max(0, min(deadline_list) - time.time())
+                        if deadline_list else
+                        None
+                    )
                 except OSError as exc:
                     if exc.errno != errno.EINTR:
                         raise
                 else:
-                    if event_list:
-                        for event_fd, _ in event_list:
-                            _, event_handler = event_dict[event_fd]
-                            event_handler()
-                    else:
-                        for event_handler in timeout_handler_list:
-                            event_handler()
+                    for event_fd, _ in event_list:
+                        _, event_handler = event_dict[event_fd]
+                        event_handler()
+                now = time.time()
+                if next_battery_check is not None and next_battery_check <= now:
+                    next_battery_check = now + self.__BATTERY_CHECK_DELAY
+                    self._onBatteryEvent()
+                deadline = self.__getPinTableDeadline()
+                if deadline is not None and deadline <= now:
+                    self.__onPinTableTimer()
+
+    def __getPinTableDeadline(self):
+        """
+        Return when the PIN table timer is next due, or None.
+        """
+        if not self._can_generate:
+            return None
+        if not self.__screen.has_next_pin_table:
+            return min(self.__next_pin_prerender, self.__next_pin_generation)
+        return self.__next_pin_generation
+
+    def __onPinTableTimer(self):
+        now = time.time()
+        try:
+            if self.__next_pin_generation <= now:
+                self.__rotatePinTable(now)
+            elif not self.__screen.has_next_pin_table:
+                # Idle: prepare the next table so rotation only has to send it.
+                self.__screen.prerenderPinTable()
+        except Exception: # pylint: disable=broad-except
+            # Keep serving the card: the current table stays valid, and the
+            # timer retries later.
+            logger.exception('Failed to update the PIN table')
+            self.__next_pin_prerender = now + self.__PIN_PRERENDER_DELAY
+
+    def __rotatePinTable(self, now):
+        self.__next_pin_generation = now + self.__PIN_GENERATION_DELAY
+        with transaction_manager:
+            tries_left = self.__openpgp.getPIN1TriesLeft()
+        self.__generatePinTable(
+            tries_left=tries_left,
+        )
 
     def processEvents(self):
         super().processEvents()
         now = time.time()
         if self.__next_pin_generation <= now or not self.__pin_queue:
-            self.__next_pin_generation = now + self.__PIN_GENERATION_DELAY
-            with transaction_manager:
-                tries_left = self.__card.traverse(
-                    path=(MASTER_FILE_IDENTIFIER, self.__OPENPGP_FILE_IDENTIFIER),
-                ).getPIN1TriesLeft()
-            self.__generatePinTable(
-                tries_left=tries_left,
-            )
+            self.__rotatePinTable(now)
 
     def onUnbind(self):
         self.displayReadyUnplugged()
@@ -763,6 +610,19 @@ def main():
         '--serial',
         help='String to use as USB device serial number',
     )
+    parser.add_argument(
+        '--headless-display',
+        metavar='PATH',
+        help='Do not drive the e-paper display, write each displayed frame to '
+        'an image file instead. "%%i" is replaced by the frame number, and '
+        'PNG is used if PATH ends with ".png", PBM otherwise. Ex: '
+        '"/tmp/frame-%%04i.png".',
+    )
+    addMetricsArgumentList(parser)
+    addEventArgumentList(parser)
+    addProfilerArgumentList(parser)
+    addCalibrationArgumentList(parser)
+    addMemoryArgumentList(parser)
     parser.add_argument(
         '--verbose',
         default='warning',
@@ -783,8 +643,17 @@ def main():
     logger.setLevel(
         level=args.verbose.upper(),
     )
-    display = WaveShareEPaper()
-    gpiochip = GPIOChip('/dev/gpiochip0', 'w+b')
+    setupAlgorithmPolicy(args)
+    if args.headless_display is None:
+        display = WaveShareEPaper()
+        gpiochip = GPIOChip('/dev/gpiochip0', 'w+b')
+    else:
+        display = HeadlessEPaper(
+            frame_path=args.headless_display,
+            realtime=True,
+        )
+        # Meant for machines without the GPIO chip: no battery monitoring.
+        gpiochip = None
     gadget = GadgetSubprocessManager(
         args=args,
         config_list=[
@@ -796,10 +665,14 @@ def main():
                             ICCDFunctionWithRandomPinDisplay,
                             display=display,
                             # TODO: argument, auto-detection of default...
-                            fontface=freetype.Face('/usr/share/fonts/truetype/noto/NotoMono-Regular.ttf'),
+                            fontface=freetype.Face(DEFAULT_FONT_PATH),
                             slot_count=1,
                             zodb_path=os.path.abspath(args.filestorage),
                             gpiochip=gpiochip,
+                            metrics_exporter=getMetricsExporter(args),
+                            event_dumper=getEventDumper(args),
+                            profiler=getAPDUProfiler(args),
+                            memory_monitor=getMemoryMonitor(args),
                         ),
                     ),
                 ],
@@ -821,7 +694,10 @@ def main():
             },
         },
     )
-    with display, gpiochip, gadget:
+    with contextlib.ExitStack() as exit_stack:
+        if gpiochip is not None:
+            exit_stack.enter_context(gpiochip)
+        exit_stack.enter_context(gadget)
         gadget.waitForever()
     # CCID function may request special actions to do after exiting. For example
     # it may request a shutdown when it detects the battery is discharging below
@@ -18,10 +18,167 @@
 # TODO: get rid of this. There has to be a nicer framebuffer implementation
 # somewhere. Maybe PIL (aka pillow) ?
 
-import itertools
+import weakref
 import freetype
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
-class Framebuffer:
+# Masks of the pixels from given bit (MSb being the topmost pixel) to the
+# bottom, and from the top to given bit, of a column byte.
+_HEAD_MASK_LIST = [0xff >> x for x in range(8)]
+_TAIL_MASK_LIST = [(0xff << (7 - x)) & 0xff for x in range(8)]
+_INVERT_TABLE = bytes(x ^ 0xff for x in range(256))
+
+class Glyph:
+    """
+    A rendered monochrome glyph, with its bitmap converted to the framebuffer
+    layout: one integer per column, topmost pixel in the most significant bit.
+    """
+    __slots__ = (
+        'advance',
+        'left',
+        'top',
+        'width',
+        'rows',
+        '_column_list',
+        '_strip_dict',
+        '_plane',
+    )
+
+    def __init__(self, glyph):
+        """
+        glyph (freetype.GlyphSlot)
+            Glyph slot, just loaded with FT_LOAD_RENDER and
+            FT_LOAD_MONOCHROME.
+        """
+        bitmap = glyph.bitmap
+        self.advance = glyph.advance.x // 64
+        self.left = glyph.bitmap_left
+        self.top = glyph.bitmap_top
+        self.width = width = bitmap.width
+        self.rows = rows = bitmap.rows
+        pitch = bitmap.pitch
+        buf = bitmap.buffer
+        column_list = []
+        for column in range(width):
+            byte_offset = column >> 3
+            bit = 7 - (column & 0x7)
+            value = 0
+            for row in range(rows):
+                value = (value << 1) | (
+                    (buf[row * pitch + byte_offset] >> bit) & 1
+                )
+            column_list.append(value)
+        self._column_list = column_list
+        self._strip_dict = {}
+        self._plane = None
+
+    def getStrip(self, shift, crop_top=0, crop_bottom=0):
+        """
+        Return (byte count, column list) to paint this glyph with its first
+        non-cropped row at bit <shift> (0 being the MSb) of a framebuffer
+        byte. Each column is an integer spanning byte count bytes, big endian.
+        """
+        key = (shift, crop_top, crop_bottom)
+        try:
+            return self._strip_dict[key]
+        except KeyError:
+            pass
+        rows = self.rows - crop_top - crop_bottom
+        if rows <= 0:
+            result = (0, [])
+        else:
+            byte_count = (shift + rows + 7) >> 3
+            padding = (byte_count << 3) - shift - rows
+            mask = (1 << rows) - 1
+            result = (
+                byte_count,
+                [
+                    ((value >> crop_bottom) & mask) << padding
+                    for value in self._column_list
+                ],
+            )
+        self._strip_dict[key] = result
+        return result
+
+    def getPlane(self):
+        """
+        Return this glyph as a NumPy boolean array indexed by [column, row].
+        """
+        plane = self._plane
+        if plane is None:
+            rows = self.rows
+            plane = numpy.zeros((self.width, rows), dtype=bool)
+            for column, value in enumerate(self._column_list):
+                plane[column] = [
+                    (value >> bit) & 1
+                    for bit in range(rows - 1, -1, -1)
+                ]
+            self._plane = plane
+        return plane
+
+class GlyphCache:
+    """
+    Glyphs and kerning, per font face and pixel size, so rendering text does
+    not involve freetype once all used glyphs have been rendered.
+    """
+    def __init__(self):
+        # face -> (pixel size, char) -> Glyph
+        self.__glyph_dict = weakref.WeakKeyDictionary()
+        # face -> (pixel size, left char, right char) -> kerning in pixels
+        self.__kerning_dict = weakref.WeakKeyDictionary()
+
+    def getGlyph(self, face, size, char):
+        try:
+            return self.__glyph_dict[face][(size, char)]
+        except KeyError:
+            pass
+        face.set_pixel_sizes(0, size)
+        face.load_char(
+            char,
+            freetype.FT_LOAD_RENDER |
+            freetype.FT_LOAD_MONOCHROME |
+            freetype.FT_LOAD_TARGET_MONO,
+        )
+        result = self.__glyph_dict.setdefault(face, {})[(size, char)] = Glyph(
+            face.glyph,
+        )
+        return result
+
+    def getKerning(self, face, size, left, right):
+        if left is None or not face.has_kerning:
+            return 0
+        key = (size, left, right)
+        try:
+            return self.__kerning_dict[face][key]
+        except KeyError:
+            pass
+        face.set_pixel_sizes(0, size)
+        result = self.__kerning_dict.setdefault(face, {})[key] = (
+            face.get_kerning(left, right).x // 64
+        )
+        return result
+
+    def preload(self, face, size, text):
+        """
+        Render every char of text, and prepare their unclipped strips for
+        every vertical alignment: an atlas for text rendered repeatedly (ex:
+        digits).
+        """
+        for char in text:
+            glyph = self.getGlyph(face, size, char)
+            for shift in range(8):
+                glyph.getStrip(shift)
+
+glyph_cache = GlyphCache()
+
+class BytearrayFramebuffer:
+    """
+    1bpp framebuffer in the display layout: column after column, each column
+    being a whole number of bytes, topmost pixel in the most significant bit.
+    """
     COLOR_OFF = 0
     COLOR_ON = 1
     COLOR_XOR = -1
@@ -35,9 +192,9 @@ class Framebuffer:
         self._buf = bytearray(width * self._height)
         self._buf_view = memoryview(self._buf)
         self._dirty_x_min = 0
-        self._dirty_x_max = width
+        self._dirty_x_max = width - 1
         self._dirty_y_min = 0
-        self._dirty_y_max = height
+        self._dirty_y_max = self._height - 1
 
     @property
     def width(self):
@@ -53,43 +210,92 @@ class Framebuffer:
 
     def _iterBuf(self, x, y, width, height):
         buf_view = self._buf_view
-        offset = y * self._width + x
-        for _ in range(height):
-            yield buf_view[offset:offset + width]
-            offset += self._width
+        offset = x * self._height + y
+        for _ in range(width):
+            yield buf_view[offset:offset + height]
+            offset += self._height
 
-    def getDirtyRect(self):
+    def getRect(self, x_min, x_max, y_min, y_max):
+        """
+        Return the content of columns x_min to x_max and of byte rows (8
+        pixels each) y_min to y_max, max being excluded, column after
+        column.
+        """
+        height = self._height
+        if y_min == 0 and y_max == height:
+            return bytes(self._buf_view[x_min * height:x_max * height])
+        return b''.join(self._iterBuf(
+            x_min,
+            y_min,
+            x_max - x_min,
+            y_max - y_min,
+        ))
+
+    def popDirtyRect(self):
+        """
+        Return the region modified since the previous call, as
+        (x_min, x_max, y_min, y_max), see getRect. Empty if min == max.
+        """
         width = self._width
         height = self._height
         x_min = max(0, self._dirty_x_min)
-        x_max = min(width, self._dirty_x_max) + 1
-        dirty_width = x_max - x_min
-        if dirty_width <= 0:
-            return (0, 0, 0, 0, b'')
+        x_max = min(width, self._dirty_x_max + 1)
         y_min = max(0, self._dirty_y_min)
-        y_max = min(height, self._dirty_y_max) + 1
-        dirty_height = y_max - y_min
-        if dirty_width == width:
-            if dirty_height == height:
-                view = self._buf_view
-            else:
-                view = self._buf_view[y_min * width:y_max * width]
-        else:
-            view = itertools.chain.from_iterable(
-                self._iterBuf(x_min, y_min, dirty_width, dirty_height)
-            )
+        y_max = min(height, self._dirty_y_max + 1)
         self._dirty_x_min = width
         self._dirty_y_min = height
-        self._dirty_x_max = self._dirty_y_max = 0
+        self._dirty_x_max = self._dirty_y_max = -1
+        if x_min >= x_max or y_min >= y_max:
+            return (0, 0, 0, 0)
         # Note: xmax and ymax are *after* the last line/column
-        return (x_min, x_max, y_min, y_max, view)
+        return (x_min, x_max, y_min, y_max)
+
+    def getDirtyRect(self):
+        """
+        Return the region modified since the previous call, as
+        (x_min, x_max, y_min, y_max, data), see getRect.
+        """
+        x_min, x_max, y_min, y_max = rect = self.popDirtyRect()
+        if x_min == x_max:
+            return rect + (b'', )
+        return rect + (self.getRect(x_min, x_max, y_min, y_max), )
 
     def _dirty(self, x, y):
+        # y is a byte row.
         self._dirty_x_min = min(x, self._dirty_x_min)
         self._dirty_x_max = max(x, self._dirty_x_max)
         self._dirty_y_min = min(y, self._dirty_y_min)
         self._dirty_y_max = max(y, self._dirty_y_max)
 
+    def _dirtyRect(self, left, top, right, bottom):
+        """
+        Clip pixels from (left, top) to (right, bottom), both included, to the
+        screen, and mark the result as modified.
+        Returns the clipped (left, top, right, bottom), or None if nothing is
+        on-screen.
+        """
+        left = max(0, left)
+        top = max(0, top)
+        right = min(self._width - 1, right)
+        bottom = min(self._pixel_height - 1, bottom)
+        if left > right or top > bottom:
+            return None
+        self._dirty(left, top >> 3)
+        self._dirty(right, bottom >> 3)
+        return left, top, right, bottom
+
+    @staticmethod
+    def _getImageLineCount(data, line_length, packed):
+        """
+        Return the number of lines, including any partial last one, of
+        image data, see blitRowImage and blitColumnImage.
+        """
+        if packed:
+            stride = line_length
+        else:
+            stride = ((line_length + 7) >> 3) << 3
+        return -(-len(data) * 8 // stride)
+
     @classmethod
     def _maskWord(cls, buf, offset, word, color):
         assert offset >= 0
@@ -118,19 +324,114 @@ class Framebuffer:
     def getPixel(self, x, y):
         width = self._width
         if 0 <= x < width and 0 <= y < self._pixel_height:
-            return (self._buf[(y >> 3) * width + x + 1] >> (y & 0x7)) & 1
+            return (
+                self._buf[x * self._height + (y >> 3)] >> (7 - (y & 0x7))
+            ) & 1
         return None
 
     def blank(self, color=COLOR_OFF):
         if color not in (self.COLOR_OFF, self.COLOR_ON):
             raise ValueError
         self._dirty(0, 0)
-        self._dirty(self._width, self._height)
-        if color:
-            color = 0xff
+        self._dirty(self._width - 1, self._height - 1)
+        buf = self._buf
+        buf[:] = (b'\xff' if color else b'\x00') * len(buf)
+
+    def saveLayer(self):
+        """
+        Return a copy of the whole screen, for restoreLayer.
+        """
+        return bytes(self._buf)
+
+    def restoreLayer(self, layer):
+        """
+        Replace the whole screen with a saveLayer return value.
+        """
+        self._dirty(0, 0)
+        self._dirty(self._width - 1, self._height - 1)
+        self._buf[:] = layer
+
+    def _getMaskPair(self, mask, color):
+        """
+        Return (and, xor) so that (word & and) ^ xor paints the bits set in
+        mask in given color.
+        """
+        if color == self.COLOR_ON:
+            return mask ^ 0xff, mask
+        if color == self.COLOR_XOR:
+            return 0xff, mask
+        if color == self.COLOR_OFF:
+            return mask ^ 0xff, 0
+        raise ValueError
+
+    def _fillColumns(self, left, right, top, bottom, color):
+        """
+        Paint pixels from (left, top) to (right, bottom), both included and
+        on-screen, as one span per column: partial head and tail bytes are
+        masked, whole bytes in-between are assigned as a slice.
+        """
+        height = self._height
         buf = self._buf
-        for index in range(self._width * self._height):
-            buf[index] = color
+        first = top >> 3
+        last = bottom >> 3
+        head = _HEAD_MASK_LIST[top & 0x7]
+        tail = _TAIL_MASK_LIST[bottom & 0x7]
+        if color == self.COLOR_XOR:
+            fill = None
+        elif color == self.COLOR_ON:
+            fill = b'\xff'
+        elif color == self.COLOR_OFF:
+            fill = b'\x00'
+        else:
+            raise ValueError
+        if head == tail == 0xff and first == 0 and last == height - 1:
+            # Whole columns are contiguous: a single span.
+            start = left * height
+            stop = (right + 1) * height
+            if fill is None:
+                buf[start:stop] = buf[start:stop].translate(_INVERT_TABLE)
+            else:
+                buf[start:stop] = fill * (stop - start)
+            return
+        if first == last:
+            head &= tail
+        head_and, head_xor = self._getMaskPair(head, color)
+        tail_and, tail_xor = self._getMaskPair(tail, color)
+        middle_length = last - first - 1
+        if fill is not None and middle_length > 0:
+            fill *= middle_length
+        for offset in range(
+            left * height + first,
+            right * height + first + 1,
+            height,
+        ):
+            buf[offset] = (buf[offset] & head_and) ^ head_xor
+            if first != last:
+                tail_offset = offset + last - first
+                if middle_length:
+                    if fill is None:
+                        buf[offset + 1:tail_offset] = buf[
+                            offset + 1:tail_offset
+                        ].translate(_INVERT_TABLE)
+                    else:
+                        buf[offset + 1:tail_offset] = fill
+                buf[tail_offset] = (buf[tail_offset] & tail_and) ^ tail_xor
+
+    def _fillRect(self, ax, ay, bx, by, color):
+        """
+        Paint pixels from (ax, ay) to (bx, by), both included, clipped to the
+        screen.
+        """
+        if ax > bx:
+            ax, bx = bx, ax
+        if ay > by:
+            ay, by = by, ay
+        ax = max(0, ax)
+        ay = max(0, ay)
+        bx = min(self._width - 1, bx)
+        by = min(self._pixel_height - 1, by)
+        if ax <= bx and ay <= by:
+            self._fillColumns(ax, bx, ay, by, color)
 
     def line(self, ax, ay, bx, by, color=COLOR_ON):
         # TODO: detect all-out-of-screen lines
@@ -139,90 +440,89 @@ class Framebuffer:
         self._line(ax, ay, bx, by, color)
 
     def _line(self, ax, ay, bx, by, color):
-        height = self._height
+        if ax == bx or ay == by:
+            self._fillRect(ax, ay, bx, by, color)
+            return
+        if by < ay:
+            ax, ay, bx, by = bx, by, ax, ay
         delta_x = bx - ax
         delta_y = by - ay
-        if delta_x == delta_y == 0:
-            self._putPixel(ax, ay, color)
-            return
-        inc_x = height if delta_x > 0 else -height
-        if delta_y < 0:
-            delta_y = -delta_y
-            ax = bx
-            ay = by
-            inc_x = -inc_x
-        # XXX: should find the intersections between the line and buffer borders
-        # to remove tests on every iteration.
-        abs_delta_x = abs(delta_x)
-        abs_delta_y = delta_y
-        bit = 7 - (ay & 0x7)
-        offset = (ay >> 3) + ax * height
+        step_x = 1 if delta_x > 0 else -1
+        delta_x *= step_x
+        width = self._width
+        pixel_height = self._pixel_height
+        height = self._height
         buf = self._buf
         maskWord = self._maskWord
-        err = 0
-        if abs_delta_y >= abs_delta_x:
-            err_delta = abs_delta_x / abs_delta_y
-            word = 0
-            offset_inc = 0
-            for _ in range(abs_delta_y + 1):
-                word |= 1 << bit
-                bit -= 1
-                if bit == -1:
-                    offset_inc = 1
-                    bit = 7
-                err += err_delta
-                if err > 0.5:
-                    ax += inc_x
-                    offset_inc += inc_x
-                    err -= 1
-                if offset_inc:
-                    maskWord(buf, offset, word, color)
-                    offset += offset_inc
-                    offset_inc = 0
-                    word = 0
-            if word:
-                maskWord(buf, offset, word, color)
+        # Bresenham, with the error scaled by 2 * the major delta so it stays
+        # integer.
+        error = 0
+        if delta_y >= delta_x:
+            # Paint vertical runs, as column spans.
+            run_start = ay
+            for y in range(ay, by + 1):
+                error += 2 * delta_x
+                if error > delta_y or y == by:
+                    if 0 <= ax < width:
+                        top = max(0, run_start)
+                        bottom = min(pixel_height - 1, y)
+                        if top >> 3 == bottom >> 3:
+                            if top <= bottom:
+                                maskWord(
+                                    buf,
+                                    ax * height + (top >> 3),
+                                    _HEAD_MASK_LIST[top & 0x7] &
+                                    _TAIL_MASK_LIST[bottom & 0x7],
+                                    color,
+                                )
+                        elif top < bottom:
+                            self._fillColumns(ax, ax, top, bottom, color)
+                    ax += step_x
+                    error -= 2 * delta_y
+                    run_start = y + 1
         else:
-            err_delta = abs_delta_y / abs_delta_x
-            for _ in range(abs_delta_x + 1):
-                maskWord(buf, offset, 1 << bit, color)
-                ax += inc_x
-                offset += inc_x
-                err += err_delta
-                if err > 0.5:
-                    bit -= 1
-                    if bit == -1:
+            # Column-major: horizontal runs are not contiguous, paint pixels.
+            on_screen = (
+                0 <= min(ax, bx) and max(ax, bx) < width and
+                0 <= ay and by < pixel_height
+            )
+            getMaskPair = self._getMaskPair
+            word_and, word_xor = getMaskPair(1 << (7 - (ay & 0x7)), color)
+            offset = ax * height + (ay >> 3)
+            step_offset = step_x * height
+            for x in range(ax, bx + step_x, step_x):
+                if on_screen or (0 <= x < width and 0 <= ay < pixel_height):
+                    buf[offset] = (buf[offset] & word_and) ^ word_xor
+                offset += step_offset
+                error += 2 * delta_y
+                if error > delta_x:
+                    ay += 1
+                    word_and, word_xor = getMaskPair(
+                        1 << (7 - (ay & 0x7)),
+                        color,
+                    )
+                    if not ay & 0x7:
                         offset += 1
-                        bit = 7
-                    err -= 1
+                    error -= 2 * delta_x
 
     def rect(self, ax, ay, bx, by, color=COLOR_ON, fill=False):
+        if ax > bx:
+            ax, bx = bx, ax
+        if ay > by:
+            ay, by = by, ay
         width = self._width - 1
         height = self._pixel_height - 1
         ax = min(width, max(0, ax))
         bx = min(width, max(0, bx))
         ay = min(height, max(0, ay))
         by = min(height, max(0, by))
-        self._dirty(ax, ay)
-        self._dirty(bx, by)
-        line = self._line
-        if fill:
-            delta_x = bx - ax
-            delta_y = by - ay
-            abs_delta_x = abs(delta_x)
-            abs_delta_y = abs(delta_y)
-            # Note: could be accelerated (after line is) by favoring y lines
-            if abs_delta_y >= abs_delta_x:
-                inc = 1 if delta_x > 0 else -1
-                for _ in range(abs_delta_x + 1):
-                    line(ax, ay, ax, by, color)
-                    ax += inc
-            else:
-                inc = 1 if delta_y > 0 else -1
-                for _ in range(abs_delta_y + 1):
-                    line(ax, ay, bx, ay, color)
-                    ay += inc
+        self._dirty(ax, ay >> 3)
+        self._dirty(bx, by >> 3)
+        if fill or ax == bx or ay == by:
+            # A flat outline is a single line, which must be painted once.
+            self._fillRect(ax, ay, bx, by, color)
         else:
+            line = self._line
             line(ax, ay, bx - 1, ay, color)
             line(bx, ay, bx, by - 1, color)
             line(bx, by, ax + 1, by, color)
@@ -230,19 +530,26 @@ class Framebuffer:
 
     def circle(self, x, y, r, color=COLOR_ON, fill=False):
         # TODO: skip off-screen rendering
-        self._dirty(x - r, y - r)
-        self._dirty(x + r, y + r)
+        self._dirty(x - r, (y - r) >> 3)
+        self._dirty(x + r, (y + r) >> 3)
         deltax = r
         deltay = 0
         err = 0
         if fill:
-            line = self._line
-            def draw(bx, by, color=color):
-                line(bx, y, bx, by, color)
+            # Column -> half height. Each column is then painted once, so
+            # pixels shared by octants are not painted repeatedly.
+            extent_dict = {}
+            def draw(bx, by):
+                extent = abs(by - y)
+                if extent_dict.get(bx, -1) < extent:
+                    extent_dict[bx] = extent
         else:
             putPixel = self._putPixel
-            def draw(bx, by, color=color):
-                putPixel(bx, by, color)
+            width = self._width
+            height = self._pixel_height
+            def draw(bx, by):
+                if 0 <= bx < width and 0 <= by < height:
+                    putPixel(bx, by, color)
         while deltax >= deltay:
             draw(x + deltax, y + deltay)
             draw(x + deltay, y + deltax)
@@ -258,6 +565,10 @@ class Framebuffer:
             if err > 0:
                 deltax -= 1
                 err -= 2 * deltax + 1
+        if fill:
+            fillRect = self._fillRect
+            for bx, extent in extent_dict.items():
+                fillRect(bx, y - extent, bx, y + extent, color)
 
     def blitRowImage(self, x, y, width, data, color=COLOR_ON, packed=False, big_endian=False):
         """
@@ -277,7 +588,15 @@ class Framebuffer:
         big_endian:
             When True image data MSbs are leftmost pixels.
         """
-        self._dirty(x, y)
+        clip = self._dirtyRect(
+            x,
+            y,
+            x + width - 1,
+            y + self._getImageLineCount(data, width, packed) - 1,
+        )
+        if clip is None:
+            return
+        left, top, right, bottom = clip
         putPixel = self._putPixel
         bit_shift = list(range(8))
         if big_endian:
@@ -285,7 +604,11 @@ class Framebuffer:
         dx = dy = 0
         for word in data:
             for bit in bit_shift:
-                if (word >> bit) & 1:
+                if (
+                    (word >> bit) & 1 and
+                    left <= x + dx <= right and
+                    top <= y + dy <= bottom
+                ):
                     putPixel(x + dx, y + dy, color)
                 dx += 1
                 if dx == width:
@@ -293,7 +616,6 @@ class Framebuffer:
                     dy += 1
                     if not packed:
                         break
-        self._dirty(x + width, y + dy)
 
     def blitColumnImage(self, x, y, height, data, color=COLOR_ON, packed=False, big_endian=False):
         """
@@ -313,7 +635,15 @@ class Framebuffer:
         big_endian:
             When True image data MSbs are topmost pixels.
         """
-        self._dirty(x, y)
+        clip = self._dirtyRect(
+            x,
+            y,
+            x + self._getImageLineCount(data, height, packed) - 1,
+            y + height - 1,
+        )
+        if clip is None:
+            return
+        left, top, right, bottom = clip
         putPixel = self._putPixel
         bit_shift = list(range(8))
         if big_endian:
@@ -321,7 +651,11 @@ class Framebuffer:
         dx = dy = 0
         for word in data:
             for bit in bit_shift:
-                if (word >> bit) & 1:
+                if (
+                    (word >> bit) & 1 and
+                    left <= x + dx <= right and
+                    top <= y + dy <= bottom
+                ):
                     putPixel(x + dx, y + dy, color)
                 dy += 1
                 if dy == height:
@@ -329,30 +663,57 @@ class Framebuffer:
                     dx += 1
                     if not packed:
                         break
-        self._dirty(x + dx, y + height)
 
-    @staticmethod
-    def _repackAndScissor(bitmap, crop_top=0, crop_bottom=0):
-        # freetype bitmaps may contain all-empty bytes at end of line, which
-        # are not handled by blitting, so repack when needed.
-        # Also, height not being guaranteed, crop top & bottom to not escape
-        # intended rendering rect.
-        pitch = (7 + bitmap.width) // 8
-        if pitch == bitmap.pitch:
-            result = list(bitmap.buffer)
-        else:
-            result = []
-            x = 0
-            for data in bitmap.buffer:
-                if x < pitch:
-                    result.append(data)
-                x += 1
-                x %= bitmap.pitch
-        if crop_top:
-            result = result[crop_top * pitch:]
-        if crop_bottom:
-            result = result[:-crop_bottom * pitch]
-        return result
+    def _blitGlyph(self, glyph, x, y, crop_top, crop_bottom, color):
+        """
+        Paint glyph with its top-left non-cropped pixel at (x, y).
+        """
+        pixel_height = self._pixel_height
+        rows = glyph.rows - crop_top - crop_bottom
+        if y < 0:
+            crop_top -= y
+            rows += y
+            y = 0
+        if y + rows > pixel_height:
+            crop_bottom += y + rows - pixel_height
+            rows = pixel_height - y
+        if rows <= 0:
+            return
+        self._dirty(x, y >> 3)
+        self._dirty(x + glyph.width, (y + rows - 1) >> 3)
+        byte_count, column_list = glyph.getStrip(
+            y & 0x7,
+            crop_top,
+            crop_bottom,
+        )
+        width = self._width
+        height = self._height
+        buf = self._buf
+        offset = x * height + (y >> 3)
+        for value in column_list:
+            if value and 0 <= x < width:
+                current = int.from_bytes(buf[offset:offset + byte_count], 'big')
+                if color == self.COLOR_ON:
+                    current |= value
+                elif color == self.COLOR_XOR:
+                    current ^= value
+                elif color == self.COLOR_OFF:
+                    current &= ~value
+                else:
+                    raise ValueError
+                buf[offset:offset + byte_count] = current.to_bytes(
+                    byte_count,
+                    'big',
+                )
+            x += 1
+            offset += height
+
+    def preloadLine(self, face, text, height=12):
+        """
+        Prepare the glyphs of <text> for printLineAt calls with the same
+        <face> and <height>.
+        """
+        glyph_cache.preload(face, height - 2, text)
 
     def printLineAt(self, face, x, y, text, width=None, height=12, color=COLOR_ON):
         """
@@ -365,45 +726,36 @@ class Framebuffer:
         if width is None:
             width = self._width - x
         baseline = int(height * 4 / 5)
-        blitRowImage = self.blitRowImage
-        face.set_pixel_sizes(0, height - 2)
+        size = height - 2
+        getGlyph = glyph_cache.getGlyph
+        getKerning = glyph_cache.getKerning
+        blitGlyph = self._blitGlyph
         previous_char = None
         rendered = 0
         for char in text:
             if char == u'\n':
                 rendered += 1
                 break
-            face.load_char(
-                char,
-                freetype.FT_LOAD_RENDER |
-                freetype.FT_LOAD_MONOCHROME |
-                freetype.FT_LOAD_TARGET_MONO,
-            )
-            glyph = face.glyph
-            bitmap = glyph.bitmap
+            glyph = getGlyph(face, size, char)
             char_width = max(
-                glyph.advance.x // 64,
-                glyph.bitmap_left + bitmap.width,
-            ) + face.get_kerning(previous_char, char).x // 64
+                glyph.advance,
+                glyph.left + glyph.width,
+            ) + getKerning(face, size, previous_char, char)
             width -= char_width
             if width < 0:
                 if not rendered:
                     raise ValueError('Too narrow for first char')
                 break
-            y_offset = baseline - glyph.bitmap_top
+            y_offset = baseline - glyph.top
             crop_top = -min(0, y_offset)
             y_offset = max(0, y_offset)
-            blitRowImage(
-                x + glyph.bitmap_left,
+            blitGlyph(
+                glyph,
+                x + glyph.left,
                 y + y_offset,
-                bitmap.width,
-                self._repackAndScissor(
-                    bitmap,
-                    crop_top,
-                    max(0, (y_offset + bitmap.rows) - height),
-                ),
-                color=color,
-                big_endian=True,
+                crop_top,
+                max(0, (y_offset + glyph.rows) - height),
+                color,
             )
             x += char_width
             previous_char = char
@@ -431,3 +783,267 @@ class Framebuffer:
             text = text[printed:]
             y += line_height
         return total_printed
+
+class NumPyFramebuffer(BytearrayFramebuffer):
+    """
+    Same as BytearrayFramebuffer, but keeping pixels unpacked in a NumPy
+    boolean array, so drawing is done with array operations instead of
+    per-byte Python code. Pixels are only packed into the display layout on
+    output.
+    """
+    def __init__(self, width, height):
+        super().__init__(width, height)
+        del self._buf, self._buf_view
+        # Indexed by [x, y], including the padding rows of the last byte of
+        # each column.
+        self._plane = numpy.zeros((width, self._height << 3), dtype=bool)
+
+    @property
+    def pixelbuffer(self):
+        return bytearray(self.saveLayer())
+
+    def getRect(self, x_min, x_max, y_min, y_max):
+        return numpy.packbits(
+            self._plane[x_min:x_max, y_min << 3:y_max << 3],
+            axis=1,
+        ).tobytes()
+
+    def _paint(self, region, color, mask=None):
+        """
+        Paint the pixels of region (an array view) set in mask, or all of them.
+        """
+        if color == self.COLOR_ON:
+            if mask is None:
+                region[...] = True
+            else:
+                region |= mask
+        elif color == self.COLOR_XOR:
+            if mask is None:
+                numpy.logical_not(region, out=region)
+            else:
+                region ^= mask
+        elif color == self.COLOR_OFF:
+            if mask is None:
+                region[...] = False
+            else:
+                region &= ~mask
+        else:
+            raise ValueError
+
+    def _putPixel(self, x, y, color):
+        plane = self._plane
+        if color == self.COLOR_ON:
+            plane[x, y] = True
+        elif color == self.COLOR_XOR:
+            plane[x, y] = not plane[x, y]
+        elif color == self.COLOR_OFF:
+            plane[x, y] = False
+        else:
+            raise ValueError
+
+    def getPixel(self, x, y):
+        if 0 <= x < self._width and 0 <= y < self._pixel_height:
+            return int(self._plane[x, y])
+        return None
+
+    def blank(self, color=BytearrayFramebuffer.COLOR_OFF):
+        if color not in (self.COLOR_OFF, self.COLOR_ON):
+            raise ValueError
+        self._dirty(0, 0)
+        self._dirty(self._width - 1, self._height - 1)
+        self._plane[...] = bool(color)
+
+    def saveLayer(self):
+        return numpy.packbits(self._plane, axis=1).tobytes()
+
+    def restoreLayer(self, layer):
+        self._dirty(0, 0)
+        self._dirty(self._width - 1, self._height - 1)
+        self._plane[...] = numpy.unpackbits(
+            numpy.frombuffer(layer, dtype=numpy.uint8),
+        ).reshape(self._plane.shape)
+
+    def _fillColumns(self, left, right, top, bottom, color):
+        self._paint(self._plane[left:right + 1, top:bottom + 1], color)
+
+    def _line(self, ax, ay, bx, by, color):
+        if ax == bx or ay == by:
+            self._fillRect(ax, ay, bx, by, color)
+            return
+        # Same pixels as BytearrayFramebuffer._line: the position on the minor
+        # axis is the number of Bresenham error corrections so far.
+        if by < ay:
+            ax, ay, bx, by = bx, by, ax, ay
+        delta_x = bx - ax
+        delta_y = by - ay
+        step_x = 1 if delta_x > 0 else -1
+        delta_x *= step_x
+        if delta_y >= delta_x:
+            y_array = numpy.arange(delta_y + 1)
+            x_array = ax + step_x * -(
+                (delta_y - 2 * delta_x * y_array) // (2 * delta_y)
+            )
+            y_array += ay
+        else:
+            x_array = numpy.arange(delta_x + 1)
+            y_array = ay - (
+                (delta_x - 2 * delta_y * x_array) // (2 * delta_x)
+            )
+            x_array = ax + step_x * x_array
+        self._paintPoints(x_array, y_array, color)
+
+    def _paintPoints(self, x_array, y_array, color):
+        """
+        Paint given pixels, ignoring off-screen ones. XOR is applied once
+        per occurrence.
+        """
+        on_screen = (
+            (x_array >= 0) & (x_array < self._width) &
+            (y_array >= 0) & (y_array < self._pixel_height)
+        )
+        index = (x_array[on_screen], y_array[on_screen])
+        if color == self.COLOR_ON:
+            self._plane[index] = True
+        elif color == self.COLOR_XOR:
+            numpy.logical_xor.at(self._plane, index, True)
+        elif color == self.COLOR_OFF:
+            self._plane[index] = False
+        else:
+            raise ValueError
+
+    def circle(self, x, y, r, color=BytearrayFramebuffer.COLOR_ON, fill=False):
+        self._dirty(x - r, (y - r) >> 3)
+        self._dirty(x + r, (y + r) >> 3)
+        # Octant points from the same midpoint algorithm as
+        # BytearrayFramebuffer.circle, then painted at once.
+        deltax = r
+        deltay = 0
+        err = 0
+        point_list = []
+        while deltax >= deltay:
+            point_list.append((deltax, deltay))
+            if err <= 0:
+                deltay += 1
+                err += 2 * deltay + 1
+            if err > 0:
+                deltax -= 1
+                err -= 2 * deltax + 1
+        if not point_list:
+            return
+        deltax_array, deltay_array = numpy.array(point_list).T
+        if fill:
+            # Half height of each column, relative to x - r.
+            extent_array = numpy.full(2 * r + 1, -1)
+            for column, extent in (
+                (deltax_array, deltay_array),
+                (deltay_array, deltax_array),
+            ):
+                for sign in (1, -1):
+                    numpy.maximum.at(extent_array, r + sign * column, extent)
+            left = max(0, x - r)
+            right = min(self._width, x + r + 1)
+            top = max(0, y - r)
+            bottom = min(self._pixel_height, y + r + 1)
+            if left >= right or top >= bottom:
+                return
+            self._paint(
+                self._plane[left:right, top:bottom],
+                color,
+                numpy.abs(numpy.arange(top, bottom) - y)[numpy.newaxis, :] <=
+                extent_array[left - x + r:right - x + r, numpy.newaxis],
+            )
+        else:
+            self._paintPoints(
+                x + numpy.concatenate((
+                    deltax_array, deltay_array, -deltay_array, -deltax_array,
+                    -deltax_array, -deltay_array, deltay_array, deltax_array,
+                )),
+                y + numpy.concatenate((
+                    deltay_array, deltax_array, deltax_array, deltay_array,
+                    -deltay_array, -deltax_array, -deltax_array, -deltay_array,
+                )),
+                color,
+            )
+
+    def _getImageBitArray(self, data, line_length, packed, big_endian):
+        """
+        Return image data as a 2D boolean array, one line of line_length
+        pixels per row (including any partial last line), see blitRowImage
+        and blitColumnImage.
+        """
+        bit_array = numpy.unpackbits(
+            numpy.frombuffer(bytes(data), dtype=numpy.uint8),
+            bitorder='big' if big_endian else 'little',
+        ).view(bool)
+        if packed:
+            stride = line_length
+        else:
+            stride = ((line_length + 7) >> 3) << 3
+        remainder = len(bit_array) % stride
+        if remainder:
+            bit_array = numpy.concatenate((
+                bit_array,
+                numpy.zeros(stride - remainder, dtype=bool),
+            ))
+        # When not packed, trailing bits of each line are ignored.
+        return bit_array.reshape(-1, stride)[:, :line_length]
+
+    def _blitBitArray(self, x, y, bit_array, color):
+        """
+        Paint pixels set in bit_array (indexed by [x, y]) with top-left corner
+        at (x, y), clipped to the screen.
+        """
+        left = max(0, x)
+        top = max(0, y)
+        right = min(self._width, x + bit_array.shape[0])
+        bottom = min(self._pixel_height, y + bit_array.shape[1])
+        if left < right and top < bottom:
+            self._paint(
+                self._plane[left:right, top:bottom],
+                color,
+                bit_array[left - x:right - x, top - y:bottom - y],
+            )
+
+    def blitRowImage(self, x, y, width, data, color=BytearrayFramebuffer.COLOR_ON, packed=False, big_endian=False):
+        bit_array = self._getImageBitArray(data, width, packed, big_endian)
+        if self._dirtyRect(
+            x,
+            y,
+            x + width - 1,
+            y + bit_array.shape[0] - 1,
+        ) is not None:
+            self._blitBitArray(x, y, bit_array.T, color)
+
+    def blitColumnImage(self, x, y, height, data, color=BytearrayFramebuffer.COLOR_ON, packed=False, big_endian=False):
+        bit_array = self._getImageBitArray(data, height, packed, big_endian)
+        if self._dirtyRect(
+            x,
+            y,
+            x + bit_array.shape[0] - 1,
+            y + height - 1,
+        ) is not None:
+            self._blitBitArray(x, y, bit_array, color)
+
+    def _blitGlyph(self, glyph, x, y, crop_top, crop_bottom, color):
+        pixel_height = self._pixel_height
+        rows = glyph.rows - crop_top - crop_bottom
+        if y < 0:
+            crop_top -= y
+            rows += y
+            y = 0
+        if y + rows > pixel_height:
+            crop_bottom += y + rows - pixel_height
+            rows = pixel_height - y
+        if rows <= 0:
+            return
+        self._dirty(x, y >> 3)
+        self._dirty(x + glyph.width, (y + rows - 1) >> 3)
+        self._blitBitArray(
+            x,
+            y,
+            glyph.getPlane()[:, crop_top:crop_top + rows],
+            color,
+        )
+
+# Pick the fastest available implementation.
+Framebuffer = BytearrayFramebuffer if numpy is None else NumPyFramebuffer
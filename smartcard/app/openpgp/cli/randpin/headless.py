@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2018-2020  Vincent Pelletier <plr.vincent@gmail.com>
+#
+# This file is part of python-smartcard-app-openpgp.
+# python-smartcard-app-openpgp is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# python-smartcard-app-openpgp is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with python-smartcard-app-openpgp.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Display driver without display: emulates the e-Paper controller RAM, and
+writes displayed frames to image files.
+"""
+
+import struct
+import time
+import zlib
+from .waveshare_epaper import (
+    REFRESH_FULL,
+    REFRESH_PARTIAL,
+    WaveShareEPaper,
+)
+
+def getImageRowList(frame, width, height):
+    """
+    Convert a frame in framebuffer layout (column-major, most significant bit
+    first, see Framebuffer.pixelbuffer) into a list of rows, each an int with
+    the leftmost pixel in its most significant bit.
+    width (int)
+        Framebuffer width, in pixels.
+    height (int)
+        Framebuffer height, in pixels.
+    """
+    column_length = (height + 7) >> 3
+    padding = column_length * 8 - height
+    row_list = [0] * height
+    for x in range(width):
+        column = int.from_bytes(
+            frame[x * column_length:(x + 1) * column_length],
+            'big',
+        ) >> padding
+        for y in range(height - 1, -1, -1):
+            row_list[y] = (row_list[y] << 1) | (column & 1)
+            column >>= 1
+    return row_list
+
+def getPBM(row_list, width):
+    """
+    Return rows, as returned by getImageRowList, as a binary PBM image.
+    Set bits are white, as on the display.
+    """
+    row_length = (width + 7) >> 3
+    shift = row_length * 8 - width
+    mask = (1 << width) - 1
+    return b'P4\n%i %i\n' % (width, len(row_list)) + b''.join(
+        # In PBM, set bits are black.
+        (((~row) & mask) << shift).to_bytes(row_length, 'big')
+        for row in row_list
+    )
+
+def _getPNGChunk(chunk_type, data):
+    return (
+        struct.pack('>I', len(data)) +
+        chunk_type +
+        data +
+        struct.pack('>I', zlib.crc32(chunk_type + data))
+    )
+
+def getPNG(row_list, width):
+    """
+    Return rows, as returned by getImageRowList, as a 1-bit greyscale PNG
+    image. Set bits are white, as on the display.
+    """
+    row_length = (width + 7) >> 3
+    shift = row_length * 8 - width
+    return (
+        b'\x89PNG\r\n\x1a\n' +
+        _getPNGChunk(
+            b'IHDR',
+            struct.pack('>IIBBBBB', width, len(row_list), 1, 0, 0, 0, 0),
+        ) +
+        _getPNGChunk(b'IDAT', zlib.compress(b''.join(
+            # Filter type 0: none
+            b'\x00' + (row << shift).to_bytes(row_length, 'big')
+            for row in row_list
+        ))) +
+        _getPNGChunk(b'IEND', b'')
+    )
+
+class HeadlessEPaper:
+    """
+    Drop-in replacement for WaveShareEPaper, for machines without the display.
+    Emulates the controller RAM, counts the bytes the real driver would send
+    over SPI and estimates how long they and refreshes would take.
+    """
+    # Approximate durations, in seconds.
+    _REFRESH_DURATION_DICT = {
+        REFRESH_FULL: 2.,
+        REFRESH_PARTIAL: .3,
+    }
+
+    def __init__(
+        self,
+        frame_path=None,
+        width=122,
+        height=250,
+        spi_frequency=4000000,
+        realtime=False,
+    ):
+        """
+        frame_path (str, None)
+            If not None, path of the image file each refresh writes, with "%i"
+            replaced by the refresh number. Written as PNG if it ends with
+            ".png", PBM otherwise.
+        width (int)
+            Panel width, in pixels. Default: same as WaveShareEPaper.
+        height (int)
+            Panel height, in gates. Default: same as WaveShareEPaper.
+        spi_frequency (int)
+            SPI clock, in Hz, to estimate transfer durations.
+        realtime (bool)
+            Whether wait() actually waits for simulated refreshes to complete.
+        """
+        self._width = width
+        self._height = height
+        self._line_length = (width + 7) >> 3
+        self.__frame_path = frame_path
+        self.__spi_frequency = spi_frequency
+        self.__realtime = realtime
+        self.__ram = bytearray(b'\xff' * (self._line_length * height))
+        self.__frame = None
+        self._window_xmin = 0
+        self._window_xmax = width - 1
+        self._window_ymin = 0
+        self._window_ymax = height - 1
+        self.__cursor_x = 0
+        self.__cursor_y = 0
+        self._refresh_mode = None
+        self.__simulated_time = 0.
+        self.__busy_until = 0.
+        self.__realtime_busy_until = 0.
+        self.__spi_byte_count = 0
+        self.__refresh_list = []
+        self.__refresh_spi_byte_count = 0
+        self.__refresh_start = 0.
+
+    @property
+    def width(self):
+        return self._width
+
+    @property
+    def bytewidth(self):
+        return self._line_length
+
+    @property
+    def height(self):
+        return self._height
+
+    @property
+    def refresh_mode(self):
+        return self._refresh_mode
+
+    @property
+    def spi_byte_count(self):
+        """
+        Number of bytes the real driver would have sent over SPI.
+        """
+        return self.__spi_byte_count
+
+    @property
+    def simulated_duration(self):
+        """
+        Estimated time spent sending data and waiting for refreshes, in seconds.
+        """
+        return self.__simulated_time
+
+    @property
+    def refresh_list(self):
+        """
+        One (refresh mode, SPI byte count, estimated duration in seconds)
+        entry per refresh, counting from the previous refresh.
+        """
+        return self.__refresh_list
+
+    def __enter__(self):
+        self._refresh_mode = None
+        self.setWindow(0, 0, self._width - 1, self._height - 1)
+        self.setRefreshMode(REFRESH_FULL)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.__command(1) # _SLEEP
+
+    def __command(self, data_length):
+        # Command byte, then its parameters.
+        byte_count = 1 + data_length
+        self.__spi_byte_count += byte_count
+        self.__refresh_spi_byte_count += byte_count
+        self.__simulated_time += byte_count * 8 / self.__spi_frequency
+
+    def wait(self, state=0, timeout=10): # pylint: disable=unused-argument
+        self.__simulated_time = max(self.__simulated_time, self.__busy_until)
+        if self.__realtime:
+            delay = self.__realtime_busy_until - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+    def swap(self, wait=True):
+        self.__command(1) # _DISPLAY_UPDATE_CONTROL_2
+        self.__command(0) # _MASTER_ACTIVATION
+        duration = self._REFRESH_DURATION_DICT[self._refresh_mode]
+        self.__busy_until = self.__simulated_time + duration
+        self.__realtime_busy_until = time.monotonic() + duration
+        self.__refresh_list.append((
+            self._refresh_mode,
+            self.__refresh_spi_byte_count,
+            self.__busy_until - self.__refresh_start,
+        ))
+        self.__refresh_spi_byte_count = 0
+        self.__refresh_start = self.__busy_until
+        self.__frame = None
+        frame_path = self.__frame_path
+        if frame_path is not None:
+            path = frame_path % (len(self.__refresh_list), )
+            with open(path, 'wb') as frame_file:
+                frame_file.write((
+                    getPNG
+                    if path.lower().endswith('.png') else
+                    getPBM
+                )(
+                    getImageRowList(self.getFrame(), self._height, self._width),
+                    self._height,
+                ))
+        if wait:
+            self.wait()
+
+    def setRefreshMode(self, mode):
+        """
+        Load the waveform LUT for given refresh mode, used by following
+        swaps. Returns whether the LUT had to be loaded.
+        """
+        if mode is self._refresh_mode:
+            return False
+        self.wait()
+        # pylint: disable=protected-access
+        self.__command(len(WaveShareEPaper._LUT_DICT[mode]))
+        # pylint: enable=protected-access
+        self._refresh_mode = mode
+        return True
+
+    def setWindow(self, x_start, y_start, x_end, y_end):
+        self.wait()
+        self._window_ymin = y_start
+        self._window_ymax = y_end
+        self._window_xmin = x_start
+        self._window_xmax = x_end
+        self.__command(2) # _SET_RAM_X_WINDOW
+        self.__command(4) # _SET_RAM_Y_WINDOW
+
+    def setCursor(self, x, y):
+        self.wait()
+        self.__cursor_x = x >> 3
+        self.__cursor_y = y
+        self.__command(1) # _SET_RAM_X_COUNTER
+        self.__command(2) # _SET_RAM_Y_COUNTER
+
+    def blit(self, image, x, y):
+        self.wait()
+        if y > (self._window_ymax - self._window_ymin):
+            raise ValueError('out of window')
+        self.setCursor(x, self._window_ymax - y)
+        self.__writeRAM(image)
+
+    def clear(self):
+        self.wait()
+        line_data = b'\xff' * (
+            (self._window_xmax >> 3) - (self._window_xmin >> 3) + 1
+        )
+        self.setCursor(0, self._window_ymax)
+        self.__writeRAM(
+            line_data * (self._window_ymax - self._window_ymin + 1),
+        )
+        self.swap()
+
+    def __writeRAM(self, data):
+        # As configured by WaveShareEPaper: X increments first, then Y
+        # decrements, both wrapping within the window.
+        self.__command(len(data))
+        self.__frame = None
+        ram = self.__ram
+        line_length = self._line_length
+        x_start = self._window_xmin >> 3
+        x_end = self._window_xmax >> 3
+        y_start = self._window_ymin
+        y_end = self._window_ymax
+        x = self.__cursor_x
+        y = self.__cursor_y
+        offset = 0
+        remaining = len(data)
+        while remaining:
+            length = min(remaining, x_end + 1 - x)
+            address = y * line_length + x
+            ram[address:address + length] = data[offset:offset + length]
+            offset += length
+            remaining -= length
+            x += length
+            if x > x_end:
+                x = x_start
+                y -= 1
+                if y < y_start:
+                    y = y_end
+        self.__cursor_x = x
+        self.__cursor_y = y
+
+    def getFrame(self):
+        """
+        Return the controller RAM content in framebuffer layout, as sent by
+        ICCDFunctionWithRandomPinDisplay: framebuffer columns are display
+        lines, in reverse order.
+        """
+        frame = self.__frame
+        if frame is None:
+            ram = self.__ram
+            line_length = self._line_length
+            self.__frame = frame = b''.join(
+                ram[y * line_length:(y + 1) * line_length]
+                for y in range(self._height - 1, -1, -1)
+            )
+        return frame
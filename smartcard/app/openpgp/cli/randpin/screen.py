@@ -0,0 +1,460 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2018-2020  Vincent Pelletier <plr.vincent@gmail.com>
+#
+# This file is part of python-smartcard-app-openpgp.
+# python-smartcard-app-openpgp is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# python-smartcard-app-openpgp is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with python-smartcard-app-openpgp.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Rendering of the random PIN display screens, independently from the card and
+from the display.
+"""
+
+import functools
+import itertools
+import random
+from .framebuffer import Framebuffer
+
+DEFAULT_FONT_PATH = '/usr/share/fonts/truetype/noto/NotoMono-Regular.ttf'
+
+DISPLAY_ROW_NAME = ('A', 'B', 'C', 'D')
+DISPLAY_COLUMN_NAME = ('1', '2', '3')
+
+# (x, y, text), for PinDisplayScreen.drawMessage
+MESSAGE_READY_UNPLUGGED = (35, 45, 'Ready, unplugged')
+MESSAGE_EXITED = (85, 45, 'Exited')
+MESSAGE_LOW_BATTERY = (60, 45, 'Low battery')
+
+class PinDisplayScreen:
+    """
+    Draws the PIN table, battery level and message screens in a framebuffer.
+    Static parts are rendered once, and kept as layers. The next PIN table
+    can be rendered ahead of time, in a back framebuffer.
+    """
+    _column_width = 75
+    _line_height = 21
+    _line_height_with_margin = _line_height + 3
+    _column_name_height = 18
+    _column_name_x_offset = 28
+    _row_name_width = 16
+    _column_x_offset = 25
+    _column_name_to_x = {
+        '1': 0 * _column_width + _column_x_offset,
+        '2': 1 * _column_width + _column_x_offset,
+        '3': 2 * _column_width + _column_x_offset,
+    }
+    _row_name_to_y = {
+        'A': 1 * _line_height_with_margin,
+        'B': 2 * _line_height_with_margin,
+        'C': 3 * _line_height_with_margin,
+        'D': 4 * _line_height_with_margin,
+    }
+    __battery_x = 218
+    __battery_y = 4
+    __battery_width = 32
+    __battery_height = 11
+    __battery_last_state = (None, None)
+    # PINs of the table pre-rendered in the back framebuffer, if any.
+    __next_pin_dict = None
+
+    def __init__(self, width, height, fontface):
+        """
+        width (int)
+        height (int)
+            Framebuffer geometry. Note: framebuffer and display disagree on
+            what is height and width, but are otherwise happy.
+        fontface (freetype.Face)
+        """
+        self.__fontface = fontface
+        self.__framebuffer = Framebuffer( # XXX: use PIL instead of custom framebuffer ?
+            width=width,
+            height=height,
+        )
+        # The next PIN table is rendered here ahead of time, and swapped with
+        # the displayed framebuffer when it is due.
+        self.__back_framebuffer = Framebuffer(
+            width=width,
+            height=height,
+        )
+        # Rendered on every PIN table refresh.
+        self.__framebuffer.preloadLine(
+            fontface,
+            '0123456789' + ''.join(DISPLAY_ROW_NAME + DISPLAY_COLUMN_NAME),
+            height=self._line_height,
+        )
+        # Pre-rendered static layers, so refreshes only draw what changes.
+        self.__layer_dict = {}
+        # Render static layers in advance.
+        self._drawLayer('pin table', self.__drawPinTableBackground)
+
+    @property
+    def framebuffer(self):
+        """
+        The framebuffer holding the screen to display.
+        """
+        return self.__framebuffer
+
+    @property
+    def has_next_pin_table(self):
+        """
+        Whether the next PIN table is already rendered.
+        """
+        return self.__next_pin_dict is not None
+
+    def popFrame(self):
+        """
+        Return the framebuffer content and the region changed since the
+        previous call, as expected by DisplayWorker.submit.
+        """
+        fb = self.__framebuffer
+        return fb.saveLayer(), fb.popDirtyRect()
+
+    def _blank(self, color):
+        # Battery need a redraw
+        self.__battery_last_state = (None, None)
+        self.__framebuffer.blank(color=color)
+
+    def _drawLayer(self, key, draw):
+        """
+        Copy the static layer identified by key to the framebuffer, rendering
+        it by calling draw first if it is not cached yet.
+        """
+        fb = self.__framebuffer
+        try:
+            layer = self.__layer_dict[key]
+        except KeyError:
+            draw()
+            self.__layer_dict[key] = fb.saveLayer()
+        else:
+            # Battery need a redraw
+            self.__battery_last_state = (None, None)
+            fb.restoreLayer(layer)
+
+    def __drawMessage(self, x, y, text):
+        self._blank(color=Framebuffer.COLOR_OFF)
+        self.printAt(x=x, y=y, text=text)
+
+    def drawMessage(self, x, y, text):
+        """
+        Draw a message screen, see MESSAGE_* constants.
+        """
+        self._drawLayer(
+            ('message', x, y, text),
+            functools.partial(self.__drawMessage, x, y, text),
+        )
+
+    def printAt(
+        self,
+        x,
+        y,
+        text,
+        width=None,
+        color=Framebuffer.COLOR_XOR,
+        framebuffer=None,
+    ):
+        if framebuffer is None:
+            framebuffer = self.__framebuffer
+        framebuffer.printLineAt(
+            self.__fontface,
+            x=x,
+            y=y,
+            text=text,
+            width=width,
+            height=self._line_height,
+            color=color,
+        )
+
+    def drawBattery(self, level, charging):
+        """
+        Draw the battery gauge, unless it is already drawn in this state.
+        level (int)
+            0 for empty, 1 to 5 for 0 to 4 bars.
+        charging (bool)
+            Whether to draw a lightning bolt over the gauge.
+        Returns whether anything was drawn.
+        """
+        state = (level, charging)
+        if state == self.__battery_last_state:
+            return False
+        self.__battery_last_state = state
+        fb = self.__framebuffer
+        battery_middle, battery_middle_remainder = divmod(self.__battery_height, 2)
+        fb.rect( # battery bump
+            self.__battery_x,
+            self.__battery_y + battery_middle - 2,
+            self.__battery_x + 2,
+            self.__battery_y + battery_middle + 2 + battery_middle_remainder,
+            color=fb.COLOR_ON,
+            fill=True,
+        )
+        fb.rect( # battery body and draw area
+            self.__battery_x + 2,
+            self.__battery_y,
+            self.__battery_x - 2 + self.__battery_width,
+            self.__battery_y + self.__battery_height,
+            color=fb.COLOR_ON,
+            fill=True,
+        )
+        bar_width = (self.__battery_width - 4) // 4
+        for index in range(4):
+            fb.rect(
+                self.__battery_x + 2 + index       * bar_width + 1,
+                self.__battery_y + 1,
+                self.__battery_x + 2 + (index + 1) * bar_width - 1,
+                self.__battery_y - 1 + self.__battery_height,
+                color=fb.COLOR_OFF,
+                fill=level > (4 - index),
+            )
+        if charging:
+            # Draw the lightning bolt as two filled triangles
+            left_x = self.__battery_x + 4
+            left_y = self.__battery_y + 6
+            right_x = self.__battery_x + self.__battery_width - 4
+            right_y = self.__battery_y + 6
+            middle_x = left_x + (right_x - left_x) // 2
+            middle_top = self.__battery_y + 2
+            middle_half_width = 4
+            line = fb.line
+            for offset in range(middle_half_width + 1):
+                line(
+                    left_x, left_y,
+                    middle_x, middle_top + offset,
+                    color=Framebuffer.COLOR_ON,
+                )
+            for offset in range(middle_half_width):
+                line(
+                    middle_x, middle_top + middle_half_width + offset,
+                    right_x, right_y,
+                    color=Framebuffer.COLOR_ON,
+                )
+            # top left outline
+            line(
+                left_x, left_y,
+                middle_x, middle_top,
+                color=Framebuffer.COLOR_OFF,
+            )
+            # center left outline
+            line(
+                left_x, left_y,
+                middle_x - 1, middle_top + middle_half_width,
+                color=Framebuffer.COLOR_OFF,
+            )
+            # bottom left outline
+            line(
+                middle_x - 1, middle_top + middle_half_width,
+                middle_x, middle_top + middle_half_width + middle_half_width,
+                color=Framebuffer.COLOR_OFF,
+            )
+            # top right outline
+            line(
+                middle_x, middle_top,
+                middle_x + 1, middle_top + middle_half_width,
+                color=Framebuffer.COLOR_OFF,
+            )
+            # center right outline
+            line(
+                middle_x + 1, middle_top + middle_half_width,
+                right_x, right_y,
+                color=Framebuffer.COLOR_OFF,
+            )
+            # bottom right outline
+            line(
+                middle_x, middle_top + middle_half_width + middle_half_width,
+                right_x, right_y,
+                color=Framebuffer.COLOR_OFF,
+            )
+        return True
+
+    def __drawPinTableBackground(self):
+        fb = self.__framebuffer
+        self._blank(color=fb.COLOR_ON)
+        # Column headers background
+        fb.rect(
+            0, 0,
+            self._row_name_width, fb.height - 1,
+            color=fb.COLOR_OFF,
+            fill=True,
+        )
+        fb.rect(
+            self._row_name_width, 0,
+            fb.width - 1, self._column_name_height,
+            color=fb.COLOR_OFF,
+            fill=True,
+        )
+        # Rounded corners
+        fb.rect(
+            self._row_name_width + 1, self._column_name_height + 1,
+            self._row_name_width + 1 + 8, self._column_name_height + 1 + 8,
+            color=fb.COLOR_OFF,
+            fill=True,
+        )
+        fb.circle(
+            self._row_name_width + 1 + 8, self._column_name_height + 1 + 8,
+            8,
+            color=fb.COLOR_ON,
+            fill=True,
+        )
+        fb.rect(
+            fb.width - 1 - 8, self._column_name_height + 1,
+            fb.width - 1, self._column_name_height + 1 + 8,
+            color=fb.COLOR_OFF,
+            fill=True,
+        )
+        fb.circle(
+            fb.width - 1 - 8, self._column_name_height + 1 + 8,
+            8,
+            color=fb.COLOR_ON,
+            fill=True,
+        )
+        fb.rect(
+            self._row_name_width + 1, fb.height - 1 - 8,
+            self._row_name_width + 1 + 8, fb.height - 1,
+            color=fb.COLOR_OFF,
+            fill=True,
+        )
+        fb.circle(
+            self._row_name_width + 1 + 8, fb.height - 1 - 8,
+            8,
+            color=fb.COLOR_ON,
+            fill=True,
+        )
+        fb.rect(
+            fb.width - 1 - 8, fb.height - 1 - 8,
+            fb.width - 1, fb.height - 1,
+            color=fb.COLOR_OFF,
+            fill=True,
+        )
+        fb.circle(
+            fb.width - 1 - 8, fb.height - 1 - 8,
+            8,
+            color=fb.COLOR_ON,
+            fill=True,
+        )
+        # Column headers captions
+        for caption, x in self._column_name_to_x.items():
+            self.printAt(
+                x + self._column_name_x_offset, 0,
+                caption,
+                width=15,
+                color=Framebuffer.COLOR_ON,
+            )
+        for caption, y in self._row_name_to_y.items():
+            self.printAt(
+                3, y,
+                caption,
+                width=15,
+                color=Framebuffer.COLOR_ON,
+            )
+        # 3-tries background
+        fb.circle(
+            8, 8, 8,
+            color=Framebuffer.COLOR_ON,
+            fill=True,
+        )
+        fb.circle(
+            34, 8, 8,
+            color=Framebuffer.COLOR_ON,
+            fill=True,
+        )
+        fb.rect(
+            8, 0,
+            34, 16,
+            color=Framebuffer.COLOR_ON,
+            fill=True,
+        )
+
+    def prerenderPinTable(self):
+        """
+        Generate the next PINs and render them in the back framebuffer.
+        """
+        fb = self.__back_framebuffer
+        # Pre-rendered in __init__
+        fb.restoreLayer(self.__layer_dict['pin table'])
+        pin_dict = {}
+        for row_name, column_name in itertools.product(
+            DISPLAY_ROW_NAME,
+            DISPLAY_COLUMN_NAME,
+        ):
+            pin_dict[
+                row_name + column_name
+            ] = value = '%06i' % random.randint(0, 999999)
+            self.printAt(
+                self._column_name_to_x[column_name],
+                self._row_name_to_y[row_name],
+                value,
+                width=self._column_width,
+                color=Framebuffer.COLOR_OFF,
+                framebuffer=fb,
+            )
+        self.__next_pin_dict = pin_dict
+
+    def drawPinTable(self, tries_left):
+        """
+        Make the next PIN table, rendering it first if needed, the current
+        screen, and draw the PIN tries left on it.
+        Returns the new table, as a mapping from cell ids (a row name followed
+        by a column name) to PIN.
+        """
+        if self.__next_pin_dict is None:
+            self.prerenderPinTable()
+        pin_dict = self.__next_pin_dict
+        self.__next_pin_dict = None
+        self.__framebuffer, self.__back_framebuffer = (
+            self.__back_framebuffer,
+            self.__framebuffer,
+        )
+        fb = self.__framebuffer
+        # Battery need a redraw
+        self.__battery_last_state = (None, None)
+        # Tries left may change until the table is displayed.
+        for index, center_x in ((0, 8), (1, 21), (2, 34)):
+            if tries_left <= index:
+                # Try failed: cross
+                fb.line(
+                    center_x - 4, 4,
+                    center_x + 4, 12,
+                    color=Framebuffer.COLOR_OFF,
+                )
+                fb.line(
+                    center_x - 3, 4,
+                    center_x + 4, 11,
+                    color=Framebuffer.COLOR_OFF,
+                )
+                fb.line(
+                    center_x - 4, 5,
+                    center_x + 3, 12,
+                    color=Framebuffer.COLOR_OFF,
+                )
+                fb.line(
+                    center_x + 4, 4,
+                    center_x - 4, 12,
+                    color=Framebuffer.COLOR_OFF,
+                )
+                fb.line(
+                    center_x + 3, 4,
+                    center_x - 4, 11,
+                    color=Framebuffer.COLOR_OFF,
+                )
+                fb.line(
+                    center_x + 4, 5,
+                    center_x - 3, 12,
+                    color=Framebuffer.COLOR_OFF,
+                )
+            else:
+                # Try still available: circle
+                fb.circle(
+                    center_x, 8, 5,
+                    color=Framebuffer.COLOR_OFF,
+                    fill=False,
+                )
+        return pin_dict
@@ -22,6 +22,7 @@ pins hard-coded).
 
 https://www.waveshare.com/wiki/2.13inch_e-Paper_HAT
 """
+import ctypes
 import fcntl
 import os
 import select
@@ -30,6 +31,87 @@ from gpiochip2 import (
     GPIO_V2_LINE_FLAG,
     GPIOChip,
 )
+from ioctl_opt import IOW
+from smartcard.utils import NamedSingleton
+
+# From linux/spi/spidev.h
+class spi_ioc_transfer(ctypes.Structure):
+    _fields_ = (
+        ('tx_buf', ctypes.c_uint64),
+        ('rx_buf', ctypes.c_uint64),
+        ('len', ctypes.c_uint32),
+        ('speed_hz', ctypes.c_uint32),
+        ('delay_usecs', ctypes.c_uint16),
+        ('bits_per_word', ctypes.c_uint8),
+        ('cs_change', ctypes.c_uint8),
+        ('tx_nbits', ctypes.c_uint8),
+        ('rx_nbits', ctypes.c_uint8),
+        ('word_delay_usecs', ctypes.c_uint8),
+        ('pad', ctypes.c_uint8),
+    )
+
+SPI_IOC_MAGIC = ord('k')
+# The ioctl number encodes the argument size on 14 bits.
+SPI_IOC_MESSAGE_MAX_TRANSFER_COUNT = ((1 << 14) - 1) // ctypes.sizeof(
+    spi_ioc_transfer,
+)
+def SPI_IOC_MESSAGE(count):
+    return IOW(SPI_IOC_MAGIC, 0, spi_ioc_transfer * count)
+
+# Whole panel is driven: slow, clears ghosting.
+REFRESH_FULL = NamedSingleton('REFRESH_FULL')
+# Only changed pixels are driven: fast, leaves ghosting behind.
+REFRESH_PARTIAL = NamedSingleton('REFRESH_PARTIAL')
+
+class RefreshPolicy:
+    """
+    Decides when partial refreshes must give way to a full refresh, by
+    estimating the ghosting they accumulate.
+    """
+    def __init__(
+        self,
+        max_area_ratio=.5,
+        max_partial_count=20,
+        max_ghosting=2.,
+    ):
+        """
+        max_area_ratio (float)
+            Largest fraction of the screen a partial refresh may change.
+        max_partial_count (int)
+            Number of consecutive partial refreshes after which a full
+            refresh is done.
+        max_ghosting (float)
+            Sum of the fractions of the screen changed by partial refreshes
+            after which a full refresh is done, ex: 2 for the whole screen
+            changing twice.
+        """
+        self.__max_area_ratio = max_area_ratio
+        self.__max_partial_count = max_partial_count
+        self.__max_ghosting = max_ghosting
+        self.__partial_count = 0
+        self.__ghosting = 0.
+
+    def getMode(self, area_ratio, full=False):
+        """
+        Return the mode of a refresh changing given fraction of the screen,
+        and account for it.
+        full (bool)
+            Whether the caller wants a full refresh (ex: content which must
+            be crisp).
+        """
+        ghosting = self.__ghosting + area_ratio
+        if (
+            full or
+            area_ratio > self.__max_area_ratio or
+            self.__partial_count >= self.__max_partial_count or
+            ghosting > self.__max_ghosting
+        ):
+            self.__partial_count = 0
+            self.__ghosting = 0.
+            return REFRESH_FULL
+        self.__partial_count += 1
+        self.__ghosting = ghosting
+        return REFRESH_PARTIAL
 
 class WaveShareEPaper:
     """
@@ -40,7 +122,11 @@ class WaveShareEPaper:
     _reset_file = None
     _busy_file = None
     _dc_file = None
+    _dc_value = None
     _spi_file = None
+    # spidev rejects messages larger than this, in bytes.
+    _spi_bufsiz = 4096
+    _spi_bufsiz_path = '/sys/module/spidev/parameters/bufsiz'
     _gpio_list = (
         (
             17,
@@ -77,6 +163,7 @@ class WaveShareEPaper:
     _window_ymax = None
     _window_xmin = None
     _window_xmax = None
+    _refresh_mode = None
     _DRIVER_OUTPUT_CONTROL = b'\x01'
     _SLEEP = b'\x10'
     _SLEEP_WAKE = b'\x00' # Reset seems require to wake from sleep
@@ -139,6 +226,36 @@ class WaveShareEPaper:
         0x0b,
     ))
     assert len(_LUT_CUSTOM) == 32, len(_LUT_CUSTOM)
+    # Same waveform as _LUT_PARTIAL_UPDATE (unchanged pixels are not driven,
+    # changed pixels are driven once for 15 cycles), but in the same 32 bytes
+    # format as _LUT_CUSTOM: the vendor table is 2 bytes shorter, and would
+    # leave its last 2 bytes as set by the previously loaded LUT.
+    _LUT_CUSTOM_PARTIAL = bytes((
+        0b00_01_10_00,
+        0x00,
+        0x00,
+        0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00,
+
+        0x00, 0x00, 0x00, 0x00, 0x00, 0x00, # constant
+
+        0b000_01111,
+        0b000_00001,
+        0x00,
+        0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00,
+
+        0x00, 0x00, 0x00, # constant
+
+        # Same as _LUT_CUSTOM, so only the waveform changes with the mode.
+        0x06,
+        0x19,
+        0x0b,
+    ))
+    _LUT_DICT = {
+        REFRESH_FULL: _LUT_CUSTOM,
+        REFRESH_PARTIAL: _LUT_CUSTOM_PARTIAL,
+    }
+    # Each LUT must overwrite the whole previously loaded one.
+    assert len(set(len(x) for x in _LUT_DICT.values())) == 1, _LUT_DICT
     _SET_DUMMY_LINE_PERIOD = b'\x3a'
     _SET_GATE_TIME = b'\x3b'
     _BORDER_WAVEFORM_CONTROL = b'\x3c'
@@ -194,6 +311,12 @@ class WaveShareEPaper:
                         consumer=(prefix + file_attr).encode('ascii'),
                         default_dict={0: default_value},
                     ))
+            self._dc_value = False
+            try:
+                with open(self._spi_bufsiz_path, 'rb') as bufsiz_file:
+                    self._spi_bufsiz = int(bufsiz_file.read())
+            except OSError:
+                pass
             fcntl.fcntl(
                 self._busy_file,
                 fcntl.F_SETFL,
@@ -226,7 +349,8 @@ class WaveShareEPaper:
                 ).to_bytes(1, 'little'),
             )
             self.setWindow(0, 0, self._width - 1, y_max)
-            self._command(self._WRITE_LUT_REGISTER, self._LUT_CUSTOM)
+            self._refresh_mode = None
+            self.setRefreshMode(REFRESH_FULL)
         except:
             self.__unenter()
             raise
@@ -247,12 +371,72 @@ class WaveShareEPaper:
                 gpio_file.close()
                 setattr(self, file_attr, None)
 
-    def _command(self, command, data=b''):
-        self._dc_file &= 0
-        self._spi_file.write(command)
-        if data:
-            self._dc_file |= 1
-            self._spi_file.write(data)
+    def _command(self, command, *data_list):
+        """
+        Send command, followed by its parameters given as any number of
+        bytes-like objects.
+        """
+        self._setDC(False)
+        self._transfer((command, ))
+        data_list = [x for x in data_list if x]
+        if data_list:
+            self._setDC(True)
+            self._transfer(data_list)
+
+    def _setDC(self, value):
+        # Only toggle the line when needed: each change is an ioctl.
+        if value != self._dc_value:
+            if value:
+                self._dc_file |= 1
+            else:
+                self._dc_file &= 0
+            self._dc_value = value
+
+    def _transfer(self, data_list):
+        """
+        Send given bytes-like objects over SPI without concatenating them,
+        in as few SPI_IOC_MESSAGE ioctls as spidev buffer size allows.
+        """
+        bufsiz = self._spi_bufsiz
+        spi_fileno = self._spi_file.fileno()
+        # Referenced until sent, as transfers point into them.
+        data_list = [bytes(x) for x in data_list]
+        transfer_list = []
+        message_length = 0
+        for data in data_list:
+            address = ctypes.cast(
+                ctypes.c_char_p(data),
+                ctypes.c_void_p,
+            ).value
+            offset = 0
+            remaining = len(data)
+            while remaining:
+                length = min(remaining, bufsiz - message_length)
+                transfer_list.append(spi_ioc_transfer(
+                    tx_buf=address + offset,
+                    len=length,
+                ))
+                offset += length
+                remaining -= length
+                message_length += length
+                if (
+                    message_length == bufsiz or
+                    len(transfer_list) == SPI_IOC_MESSAGE_MAX_TRANSFER_COUNT
+                ):
+                    self.__sendMessage(spi_fileno, transfer_list)
+                    transfer_list = []
+                    message_length = 0
+        if transfer_list:
+            self.__sendMessage(spi_fileno, transfer_list)
+
+    @staticmethod
+    def __sendMessage(spi_fileno, transfer_list):
+        transfer_count = len(transfer_list)
+        fcntl.ioctl(
+            spi_fileno,
+            SPI_IOC_MESSAGE(transfer_count),
+            (spi_ioc_transfer * transfer_count)(*transfer_list),
+        )
 
     def wait(self, state=0, timeout=10):
         self._busy_file.read() # discard result
@@ -292,6 +476,22 @@ class WaveShareEPaper:
         if wait:
             self.wait()
 
+    @property
+    def refresh_mode(self):
+        return self._refresh_mode
+
+    def setRefreshMode(self, mode):
+        """
+        Load the waveform LUT for given refresh mode, used by following
+        swaps. Returns whether the LUT had to be loaded.
+        """
+        if mode is self._refresh_mode:
+            return False
+        self.wait()
+        self._command(self._WRITE_LUT_REGISTER, self._LUT_DICT[mode])
+        self._refresh_mode = mode
+        return True
+
     def setWindow(self, x_start, y_start, x_end, y_end):
         self.wait()
         self._window_ymin = y_start
@@ -315,8 +515,12 @@ class WaveShareEPaper:
 
     def clear(self):
         self.wait()
-        line_data = b'\xff' * (self._window_xmax - self._window_xmin + 1)
+        line_data = b'\xff' * (
+            (self._window_xmax >> 3) - (self._window_xmin >> 3) + 1
+        )
         self.setCursor(0, self._window_ymax)
-        for _ in range(self._window_ymax):
-            self._command(self._WRITE_RAM, line_data)
+        self._command(
+            self._WRITE_RAM,
+            *[line_data] * (self._window_ymax - self._window_ymin + 1)
+        )
         self.swap()
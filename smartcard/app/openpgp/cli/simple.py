@@ -15,36 +15,116 @@
 # You should have received a copy of the GNU General Public License
 # along with python-smartcard-app-openpgp.  If not, see <http://www.gnu.org/licenses/>.
 
+import errno
 import functools
 import logging
 import os
+import select
 import sys
+import threading
 from functionfs.gadget import (
     GadgetSubprocessManager,
     ConfigFunctionFFSSubprocess,
 )
-import ZODB.DB
-import ZODB.FileStorage
 from f_ccid import ICCDFunction
-from smartcard import (
-    Card,
-    MASTER_FILE_IDENTIFIER,
+from smartcard.app.openpgp.cryptomatrix import (
+    addCalibrationArgumentList,
+    setupAlgorithmPolicy,
+)
+from smartcard.app.openpgp.events import (
+    EventCard,
+    addEventArgumentList,
+    getEventDumper,
+)
+from smartcard.app.openpgp.lazy import LazyCard
+from smartcard.app.openpgp.memory import (
+    MemoryAccountingCard,
+    addMemoryArgumentList,
+    getMemoryMonitor,
+)
+from smartcard.app.openpgp.metrics import (
+    MetricsCard,
+    addMetricsArgumentList,
+    getMetricsExporter,
+)
+from smartcard.app.openpgp.profiling import (
+    ProfilingCard,
+    addProfilerArgumentList,
+    getAPDUProfiler,
+)
+from smartcard.app.openpgp.trace import (
+    TraceRecorder,
+    TracingCard,
 )
-from smartcard.app.openpgp import OpenPGP
-from smartcard.utils import transaction_manager
 
 logger = logging.getLogger(__name__)
 
 class ICCDFunctionWithZODB(ICCDFunction):
-    # Any 2-bytes value is fine, this is not what is used to
-    # select the application.
-    __OPENPGP_FILE_IDENTIFIER = b'\x12\x34'
-    __connection = None
-    __db = None
+    """
+    A reader with one slot per FileStorage, each with a card inserted.
+    """
+    __load_thread = None
 
-    def __init__(self, path, zodb_path, slot_count=1):
-        super().__init__(path=path, slot_count=slot_count)
-        self.__zodb_path = zodb_path
+    def __init__(
+        self,
+        path,
+        zodb_path_list,
+        snapshot_path_list=None,
+        idle_unload_delay=None,
+        trace_path=None,
+        trace_capacity=65536,
+        metrics_exporter=None,
+        event_dumper=None,
+        profiler=None,
+        memory_monitor=None,
+    ):
+        """
+        zodb_path_list (list of str)
+            FileStorage paths, one per slot.
+        snapshot_path_list (list of str, or None)
+            Warm-start snapshot paths, one per slot.
+        idle_unload_delay (float, or None)
+            How long, in seconds, to keep a card loaded after the host powers
+            off its slot. None to never unload cards. An unloaded card gets
+            loaded again when its slot is next used, which may delay the
+            host's commands.
+        trace_path (str, or None)
+            APDU trace ring file path. None to not trace.
+        trace_capacity (int)
+            Number of records in the APDU trace ring file.
+        metrics_exporter (MetricsExporter, or None)
+            If provided, APDU metrics are collected, and the exporter is
+            started along with the function.
+        event_dumper (EventDumper, or None)
+            If provided, events are recorded, and the dumper is started along
+            with the function.
+        profiler (APDUProfiler, or None)
+            If provided, APDUs can be profiled on demand, and the profiler is
+            started along with the function.
+        memory_monitor (MemoryMonitor, or None)
+            If provided, memory is accounted and/or capped, and the monitor
+            is started along with the function.
+        """
+        super().__init__(path=path, slot_count=len(zodb_path_list))
+        if snapshot_path_list is None:
+            snapshot_path_list = [None] * len(zodb_path_list)
+        elif len(snapshot_path_list) != len(zodb_path_list):
+            raise ValueError('Expected one snapshot path per FileStorage')
+        self.__lazy_card_list = [
+            LazyCard(zodb_path=zodb_path, snapshot_path=snapshot_path)
+            for zodb_path, snapshot_path in zip(
+                zodb_path_list,
+                snapshot_path_list,
+            )
+        ]
+        self.__idle_unload_delay = idle_unload_delay
+        self.__trace_path = trace_path
+        self.__trace_capacity = trace_capacity
+        self.__recorder = None
+        self.__metrics_exporter = metrics_exporter
+        self.__event_dumper = event_dumper
+        self.__profiler = profiler
+        self.__memory_monitor = memory_monitor
 
     def __enter__(self):
         try:
@@ -56,71 +136,150 @@ class ICCDFunctionWithZODB(ICCDFunction):
             raise
 
     def __enter(self):
-        logger.info('Initialising the database...')
-        self.__db = db = ZODB.DB(
-            storage=ZODB.FileStorage.FileStorage(
-                file_name=self.__zodb_path,
-            ),
-            pool_size=1,
-        )
-        logger.info('Opening a connection to the database...')
-        self.__connection = connection = db.open(
-            transaction_manager=transaction_manager,
-        )
-        root = connection.root
-        try:
-            card = root.card
-        except AttributeError:
-            logger.info(
-                'Database does not contain a card, building an new one...',
+        if self.__metrics_exporter is not None:
+            self.__metrics_exporter.start()
+        if self.__event_dumper is not None:
+            self.__event_dumper.start()
+        if self.__profiler is not None:
+            self.__profiler.start()
+        if self.__memory_monitor is not None:
+            for lazy_card in self.__lazy_card_list:
+                self.__memory_monitor.addDatabaseGetter(lazy_card.getDatabase)
+            self.__memory_monitor.start()
+        if self.__trace_path is not None:
+            self.__recorder = TraceRecorder(
+                path=self.__trace_path,
+                capacity=self.__trace_capacity,
             )
-            with transaction_manager:
-                card = root.card = Card(
-                    name='py-openpgp'.encode('ascii'),
+        for index, (slot, lazy_card) in enumerate(zip(
+            self.slot_list,
+            self.__lazy_card_list,
+        )):
+            logger.info('Inserting %r into slot %i...', lazy_card, index)
+            slot_card = lazy_card
+            if self.__metrics_exporter is not None:
+                slot_card = MetricsCard(
+                    card=slot_card,
+                    getStorageState=lazy_card.getStorageState,
                 )
-                openpgp = OpenPGP(
-                    identifier=self.__OPENPGP_FILE_IDENTIFIER,
+            if self.__event_dumper is not None:
+                slot_card = EventCard(card=slot_card)
+            if self.__profiler is not None:
+                slot_card = ProfilingCard(
+                    card=slot_card,
+                    profiler=self.__profiler,
                 )
-                openpgp.activateSelf()
-                card.createFile(
-                    card.traverse((MASTER_FILE_IDENTIFIER, )),
-                    openpgp,
+            if self.__memory_monitor is not None:
+                slot_card = MemoryAccountingCard(
+                    card=slot_card,
+                    monitor=self.__memory_monitor,
                 )
-        else:
-            logger.info('Card data found, using it.')
-        self.__card = card
-        logger.info('Inserting the OpenPGP card into slot 0...')
-        # TODO: some way of removing/inserting multiple cards ?
-        # Ex: one card per thread with a threaded tranaction manager, and some
-        # UI on the gadget to let the user select the card to plug.
-        self.slot_list[0].insert(card)
-        # XXX: Do slow operations now, to avoid timeouts later. Especially, the
-        # DWC2 accepts receiving transfer requests while USB bus is active, but
-        # rejects them at any other time - including when USB bus is suspended
-        # by host. This means than once the UDC is bound to the gadget, we are
-        # in a race against the HCD to submit our transfers before the USB idle
-        # delay expires.
-        logger.debug('Loading OpenPGP from database...')
-        with transaction_manager:
-            self.__card.traverse(
-                path=(MASTER_FILE_IDENTIFIER, self.__OPENPGP_FILE_IDENTIFIER),
+            if self.__recorder is not None:
+                slot_card = TracingCard(
+                    card=slot_card,
+                    recorder=self.__recorder,
+                    reader=index,
+                )
+            slot.insert(slot_card)
+        self.__loadCards()
+
+    def __loadCards(self):
+        # XXX: Loading is slow, and the DWC2 accepts receiving transfer
+        # requests while USB bus is active, but rejects them at any other time
+        # - including when USB bus is suspended by host. So load cards before
+        # the host can talk to them, or while they answer from their warm-start
+        # snapshot.
+        lazy_card_list = self.__lazy_card_list
+        if all([lazy_card.open() for lazy_card in lazy_card_list]):
+            logger.info('Loading cards in the background...')
+            self.__load_thread = load_thread = threading.Thread(
+                target=self.__loadCardsInBackground,
+                args=([
+                    (lazy_card, lazy_card.serveSnapshot())
+                    for lazy_card in lazy_card_list
+                ], ),
+                name='card-loader',
+                daemon=True,
             )
+            load_thread.start()
+        else:
+            # At least one card would be usable while others load, and cards
+            # share the transaction manager: load them all now.
+            for lazy_card in lazy_card_list:
+                lazy_card.load()
+
+    @staticmethod
+    def __loadCardsInBackground(card_list):
+        # Loaded cards are only given to the slots once all are loaded, so
+        # until then the main thread only serves snapshots and this thread has
+        # exclusive use of the transaction manager.
+        result_list = []
+        for lazy_card, _ in card_list:
+            try:
+                result_list.append((lazy_card.loadCard(), None))
+            except Exception as exc: # pylint: disable=broad-except
+                logger.exception('Failed to load %r', lazy_card)
+                result_list.append((None, exc))
+        logger.info('Cards loaded, switching away from snapshots.')
+        for (_, warm_start_card), (card, exc) in zip(card_list, result_list):
+            if exc is None:
+                warm_start_card.setCard(card)
+            else:
+                warm_start_card.setLoadError(exc)
 
     def __unenter(self):
-        if self.__connection is not None:
-            self.__connection.close()
-            self.__connection = None
-        if self.__db is not None:
-            self.__db.close()
-            self.__db = None
+        load_thread = self.__load_thread
+        if load_thread is not None:
+            load_thread.join()
+            self.__load_thread = None
+        for lazy_card in self.__lazy_card_list:
+            lazy_card.unload()
+        if self.__recorder is not None:
+            self.__recorder.close()
+            self.__recorder = None
+        if self.__metrics_exporter is not None:
+            self.__metrics_exporter.close()
+        if self.__event_dumper is not None:
+            self.__event_dumper.close()
+        if self.__profiler is not None:
+            self.__profiler.close()
+        if self.__memory_monitor is not None:
+            self.__memory_monitor.close()
 
     def __exit__(self, exc_type, exc_value, traceback):
         self.__unenter()
         return super().__exit__(exc_type, exc_value, traceback)
 
+    def unloadIdleCards(self):
+        """
+        Unload cards whose slot has been powered off for long enough.
+        """
+        idle_unload_delay = self.__idle_unload_delay
+        if idle_unload_delay is None:
+            return
+        load_thread = self.__load_thread
+        if load_thread is not None and load_thread.is_alive():
+            return
+        for lazy_card in self.__lazy_card_list:
+            lazy_card.unloadIfIdle(idle_unload_delay)
+
     def processEventsForever(self):
         logger.info('All ready, serving until keyboard interrupt')
-        super().processEventsForever()
+        idle_unload_delay = self.__idle_unload_delay
+        with select.epoll(1) as epoll:
+            epoll.register(self.eventfd, select.EPOLLIN)
+            poll = epoll.poll
+            processEvents = self.processEvents
+            while self._open:
+                try:
+                    event_list = poll(idle_unload_delay)
+                except OSError as exc:
+                    if exc.errno != errno.EINTR:
+                        raise
+                else:
+                    if event_list:
+                        processEvents()
+                    self.unloadIdleCards()
 
 def main():
     parser = GadgetSubprocessManager.getArgumentParser(
@@ -130,8 +289,44 @@ def main():
     parser.add_argument(
         '--filestorage',
         required=True,
-        help='Path to a ZODB FileStorage file, for smartcard persistence.',
+        action='append',
+        help='Path to a ZODB FileStorage file, for smartcard persistence. '
+        'Repeat to emulate one card per FileStorage, each in its own slot.',
+    )
+    parser.add_argument(
+        '--warm-start-snapshot',
+        action='append',
+        help='Path to a file in which to keep the responses to the commands '
+        'hosts issue on card insertion. If it matches the FileStorage '
+        'content, they get served without loading the card. If used, repeat '
+        'once per --filestorage, in the same order.',
+    )
+    parser.add_argument(
+        '--idle-unload-delay',
+        type=float,
+        default=0,
+        help='Number of seconds after which a card whose slot is powered off '
+        'gets unloaded from memory, to be loaded again when the host next '
+        'uses it. 0 to never unload (default: %(default)s).',
     )
+    parser.add_argument(
+        '--trace',
+        help='Path to a file in which to record the APDUs hosts send, with '
+        'their timing. PINs, key material and plaintext are not recorded. '
+        'See "smartcard-openpgp-benchmark replay".',
+    )
+    parser.add_argument(
+        '--trace-size',
+        type=int,
+        default=65536,
+        help='Number of APDUs the trace file holds, older ones being '
+        'overwritten (default: %(default)s).',
+    )
+    addMetricsArgumentList(parser)
+    addEventArgumentList(parser)
+    addProfilerArgumentList(parser)
+    addCalibrationArgumentList(parser)
+    addMemoryArgumentList(parser)
     parser.add_argument(
         '--serial',
         help='String to use as USB device serial number',
@@ -147,6 +342,14 @@ def main():
         'en/decryption operations.',
     )
     args = parser.parse_args()
+    if (
+        args.warm_start_snapshot is not None and
+        len(args.warm_start_snapshot) != len(args.filestorage)
+    ):
+        parser.error(
+            '--warm-start-snapshot must be repeated as many times as '
+            '--filestorage',
+        )
     logging.basicConfig(
         stream=sys.stderr,
     )
@@ -156,6 +359,7 @@ def main():
     logger.setLevel(
         level=args.verbose.upper(),
     )
+    setupAlgorithmPolicy(args)
     with (
         GadgetSubprocessManager(
             args=args,
@@ -167,8 +371,30 @@ def main():
                             ConfigFunctionFFSSubprocess,
                             getFunction=functools.partial(
                                 ICCDFunctionWithZODB,
-                                slot_count=1,
-                                zodb_path=os.path.abspath(args.filestorage),
+                                zodb_path_list=[
+                                    os.path.abspath(x)
+                                    for x in args.filestorage
+                                ],
+                                snapshot_path_list=(
+                                    None
+                                    if args.warm_start_snapshot is None else
+                                    [
+                                        os.path.abspath(x)
+                                        for x in args.warm_start_snapshot
+                                    ]
+                                ),
+                                idle_unload_delay=(
+                                    args.idle_unload_delay or None
+                                ),
+                                trace_path=(
+                                    None if args.trace is None else
+                                    os.path.abspath(args.trace)
+                                ),
+                                trace_capacity=args.trace_size,
+                                metrics_exporter=getMetricsExporter(args),
+                                event_dumper=getEventDumper(args),
+                                profiler=getAPDUProfiler(args),
+                                memory_monitor=getMemoryMonitor(args),
                             ),
                         ),
                     ],
@@ -40,6 +40,7 @@ from smartcard.app.openpgp.tag import (
     AlgorithmAttributesDecryption,
     AlgorithmAttributesAuthentication,
 )
+from smartcard.app.openpgp.fastpath import ReadOnlyFastPathCard
 from smartcard.utils import transaction_manager
 
 logger = logging.getLogger(__name__)
@@ -163,7 +164,12 @@ class ICCDFunctionWithZODB(ICCDFunction):
                 card.traverse((MASTER_FILE_IDENTIFIER, )),
                 openpgp,
             )
-        self.slot_list[0].insert(card)
+        self.slot_list[0].insert(ReadOnlyFastPathCard(
+            card=card,
+            application=card.traverse(
+                (MASTER_FILE_IDENTIFIER, self.__OPENPGP_FILE_IDENTIFIER),
+            ),
+        ))
 
     def __unenter(self):
         if self.__connection is not None:
@@ -0,0 +1,397 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2018-2020  Vincent Pelletier <plr.vincent@gmail.com>
+#
+# This file is part of python-smartcard-app-openpgp.
+# python-smartcard-app-openpgp is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# python-smartcard-app-openpgp is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with python-smartcard-app-openpgp.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Virtual reader front end: serve cards to a local pcscd through the vsmartcard
+vpcd driver, so that regular host software (GnuPG, OpenSC...) can use them
+without any USB hardware.
+
+vpcd protocol: each message, in either direction, is a 2 bytes big-endian
+length followed by that many bytes of payload. A 1-byte message from vpcd is
+a control code (VPCD_CONTROL_*), only VPCD_CONTROL_ATR getting an answer.
+Any longer message is a command APDU, answered with the response APDU.
+
+By default, vpcd listens and the card connects to it: reader N of vpcd
+listens on its base port + N. In vpcd's reversed mode, it is the card which
+listens, on the same ports.
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import struct
+import sys
+from smartcard.app.openpgp.cli.farm import parseAddress
+from smartcard.app.openpgp.cryptomatrix import (
+    addCalibrationArgumentList,
+    setupAlgorithmPolicy,
+)
+from smartcard.app.openpgp.events import (
+    EventCard,
+    addEventArgumentList,
+    getEventDumper,
+)
+from smartcard.app.openpgp.lazy import LazyCard
+from smartcard.app.openpgp.memory import (
+    MemoryAccountingCard,
+    addMemoryArgumentList,
+    getMemoryMonitor,
+)
+from smartcard.app.openpgp.metrics import (
+    MetricsCard,
+    addMetricsArgumentList,
+    getMetricsExporter,
+)
+from smartcard.app.openpgp.profiling import (
+    ProfilingCard,
+    addProfilerArgumentList,
+    getAPDUProfiler,
+)
+from smartcard.app.openpgp.trace import (
+    TraceRecorder,
+    TracingCard,
+)
+
+logger = logging.getLogger(__name__)
+
+VPCD_CONTROL_OFF = 0
+VPCD_CONTROL_ON = 1
+VPCD_CONTROL_RESET = 2
+VPCD_CONTROL_ATR = 4
+VPCD_DEFAULT_PORT = 35963
+
+# Seconds to wait before connecting again to vpcd, for example while
+# pcscd is restarting.
+RECONNECT_DELAY = 1
+
+_LENGTH = struct.Struct('>H')
+
+def getReaderAddress(address, reader):
+    """
+    address (str or (host, port))
+        Address of the first reader: a UNIX socket path, or a TCP (host, port)
+        tuple.
+    Returns the address of given reader: path suffixed with ".<reader>"
+    (except for the first reader), or port incremented by reader.
+    """
+    if isinstance(address, str):
+        return '%s.%i' % (address, reader) if reader else address
+    host, port = address
+    return (host, port + reader)
+
+async def runSession(card, reader, writer):
+    """
+    Handle vpcd messages for card until the connection gets closed.
+    """
+    try:
+        while True:
+            length, = _LENGTH.unpack(await reader.readexactly(_LENGTH.size))
+            request = await reader.readexactly(length)
+            if length == 1:
+                control, = request
+                if control == VPCD_CONTROL_ATR:
+                    response = card.getATR()
+                elif control in (
+                    VPCD_CONTROL_OFF,
+                    VPCD_CONTROL_ON,
+                    VPCD_CONTROL_RESET,
+                ):
+                    logger.debug('%r: control %i', card, control)
+                    card.clearVolatile()
+                    continue
+                else:
+                    logger.warning(
+                        '%r: ignoring unknown control %i',
+                        card,
+                        control,
+                    )
+                    continue
+            else:
+                response = card.runAPDU(bytearray(request))
+            writer.write(_LENGTH.pack(len(response)) + bytes(response))
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        # vpcd does not always power the card off before going away.
+        card.clearVolatile()
+        writer.close()
+
+async def _openConnection(address):
+    if isinstance(address, str):
+        return await asyncio.open_unix_connection(path=address)
+    host, port = address
+    return await asyncio.open_connection(host=host, port=port)
+
+async def connectCard(card, address):
+    """
+    Connect card to a vpcd reader, and serve it until cancelled. Connects
+    again when the connection is lost.
+    """
+    while True:
+        try:
+            reader, writer = await _openConnection(address)
+        except OSError as exc:
+            logger.debug('%r: cannot connect to %r: %s', card, address, exc)
+        else:
+            logger.info('%r: connected to %r', card, address)
+            await runSession(card, reader, writer)
+            logger.info('%r: disconnected from %r', card, address)
+        await asyncio.sleep(RECONNECT_DELAY)
+
+async def listenCard(card, address):
+    """
+    Accept connections from a vpcd reader in reversed mode, and serve card
+    until cancelled. Only one connection at a time is served: a card cannot
+    be in two readers.
+    """
+    session_list = []
+    async def serveConnection(reader, writer):
+        if session_list:
+            logger.warning('%r: already in use, rejecting connection', card)
+            writer.close()
+            return
+        session_list.append(writer)
+        logger.info('%r: reader connected', card)
+        try:
+            await runSession(card, reader, writer)
+        finally:
+            session_list.remove(writer)
+            logger.info('%r: reader disconnected', card)
+    if isinstance(address, str):
+        server = await asyncio.start_unix_server(serveConnection, path=address)
+    else:
+        host, port = address
+        server = await asyncio.start_server(
+            serveConnection,
+            host=host,
+            port=port,
+        )
+    async with server:
+        await server.serve_forever()
+
+async def unloadIdleCards(card_list, idle_unload_delay):
+    """
+    Periodically unload cards whose reader has been powered off for long
+    enough.
+    """
+    while True:
+        await asyncio.sleep(idle_unload_delay / 2)
+        for card in card_list:
+            card.unloadIfIdle(idle_unload_delay)
+
+async def serve(
+    card_list,
+    address,
+    listen=False,
+    idle_unload_delay=None,
+    recorder=None,
+    collect_metrics=False,
+    record_events=False,
+    profiler=None,
+    memory_monitor=None,
+):
+    """
+    Serve each card in card_list in its own reader, concurrently.
+    All cards are accessed from the event loop's thread only, as required
+    by LazyCard.
+    recorder (TraceRecorder, or None)
+        Where to trace APDUs, if at all.
+    collect_metrics (bool)
+        Whether to collect APDU metrics.
+    record_events (bool)
+        Whether to record APDU and power events in the event ring.
+    profiler (APDUProfiler, or None)
+        Profiler to run APDUs through, if any.
+    memory_monitor (MemoryMonitor, or None)
+        Memory monitor to run APDUs through, if any.
+    """
+    serveCard = listenCard if listen else connectCard
+    task_list = []
+    for reader, card in enumerate(card_list):
+        reader_card = card
+        if collect_metrics:
+            reader_card = MetricsCard(
+                card=reader_card,
+                getStorageState=card.getStorageState,
+            )
+        if record_events:
+            reader_card = EventCard(card=reader_card)
+        if profiler is not None:
+            reader_card = ProfilingCard(card=reader_card, profiler=profiler)
+        if memory_monitor is not None:
+            reader_card = MemoryAccountingCard(
+                card=reader_card,
+                monitor=memory_monitor,
+            )
+        if recorder is not None:
+            reader_card = TracingCard(
+                card=reader_card,
+                recorder=recorder,
+                reader=reader,
+            )
+        task_list.append(
+            serveCard(reader_card, getReaderAddress(address, reader)),
+        )
+    if idle_unload_delay is not None:
+        task_list.append(unloadIdleCards(card_list, idle_unload_delay))
+    await asyncio.gather(*task_list)
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Emulate a smartcard which contains an OpenPGP '
+        'application, inserted in a vsmartcard vpcd virtual reader.',
+    )
+    parser.add_argument(
+        '--filestorage',
+        required=True,
+        action='append',
+        help='Path to a ZODB FileStorage file, for smartcard persistence. '
+        'Repeat to emulate one card per FileStorage, each in its own reader.',
+    )
+    parser.add_argument(
+        '--warm-start-snapshot',
+        action='append',
+        help='Path to a file in which to keep the responses to the commands '
+        'hosts issue on card insertion. If used, repeat once per '
+        '--filestorage, in the same order.',
+    )
+    parser.add_argument(
+        '--address',
+        type=parseAddress,
+        default=('127.0.0.1', VPCD_DEFAULT_PORT),
+        help='[host:]port of the first vpcd reader, or UNIX socket path (must '
+        'contain a "/"). Card N uses port + N, or the path suffixed with ".N" '
+        '(default: %s).' % (VPCD_DEFAULT_PORT, ),
+    )
+    parser.add_argument(
+        '--listen',
+        action='store_true',
+        help='Listen on the address instead of connecting to it, for vpcd in '
+        'reversed mode.',
+    )
+    parser.add_argument(
+        '--idle-unload-delay',
+        type=float,
+        default=600,
+        help='Number of seconds after which a card whose reader is powered '
+        'off gets unloaded from memory. 0 to never unload '
+        '(default: %(default)s).',
+    )
+    parser.add_argument(
+        '--trace',
+        help='Path to a file in which to record the APDUs hosts send, with '
+        'their timing. PINs, key material and plaintext are not recorded. '
+        'See "smartcard-openpgp-benchmark replay".',
+    )
+    parser.add_argument(
+        '--trace-size',
+        type=int,
+        default=65536,
+        help='Number of APDUs the trace file holds, older ones being '
+        'overwritten (default: %(default)s).',
+    )
+    addMetricsArgumentList(parser)
+    addEventArgumentList(parser)
+    addProfilerArgumentList(parser)
+    addCalibrationArgumentList(parser)
+    addMemoryArgumentList(parser)
+    parser.add_argument(
+        '--verbose',
+        default='warning',
+        choices=['critical', 'error', 'warning', 'info', 'debug'],
+        help='Set verbosity level (default: %(default)s). '
+        'WARNING: "debug" level will display all APDU-level exchanges with '
+        'the host, which will include secret keys during import, PINs during '
+        'verification and modification, cipher- and clear-text for '
+        'en/decryption operations.',
+    )
+    args = parser.parse_args()
+    if (
+        args.warm_start_snapshot is not None and
+        len(args.warm_start_snapshot) != len(args.filestorage)
+    ):
+        parser.error(
+            '--warm-start-snapshot must be repeated as many times as '
+            '--filestorage',
+        )
+    logging.basicConfig(
+        stream=sys.stderr,
+    )
+    logging.getLogger('smartcard').setLevel(
+        level=args.verbose.upper(),
+    )
+    setupAlgorithmPolicy(args)
+    card_list = [
+        LazyCard(
+            zodb_path=os.path.abspath(zodb_path),
+            snapshot_path=(
+                None if snapshot_path is None else
+                os.path.abspath(snapshot_path)
+            ),
+        )
+        for zodb_path, snapshot_path in zip(
+            args.filestorage,
+            args.warm_start_snapshot or [None] * len(args.filestorage),
+        )
+    ]
+    recorder = (
+        None if args.trace is None else
+        TraceRecorder(path=args.trace, capacity=args.trace_size)
+    )
+    metrics_exporter = getMetricsExporter(args)
+    if metrics_exporter is not None:
+        metrics_exporter.start()
+    event_dumper = getEventDumper(args)
+    if event_dumper is not None:
+        event_dumper.start()
+    profiler = getAPDUProfiler(args)
+    if profiler is not None:
+        profiler.start()
+    memory_monitor = getMemoryMonitor(args)
+    if memory_monitor is not None:
+        for card in card_list:
+            memory_monitor.addDatabaseGetter(card.getDatabase)
+        memory_monitor.start()
+    try:
+        asyncio.run(serve(
+            card_list=card_list,
+            address=args.address,
+            listen=args.listen,
+            idle_unload_delay=args.idle_unload_delay or None,
+            recorder=recorder,
+            collect_metrics=metrics_exporter is not None,
+            record_events=event_dumper is not None,
+            profiler=profiler,
+            memory_monitor=memory_monitor,
+        ))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for card in card_list:
+            card.unload()
+        if recorder is not None:
+            recorder.close()
+        if metrics_exporter is not None:
+            metrics_exporter.close()
+        if event_dumper is not None:
+            event_dumper.close()
+        if profiler is not None:
+            profiler.close()
+        if memory_monitor is not None:
+            memory_monitor.close()
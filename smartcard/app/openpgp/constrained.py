@@ -0,0 +1,395 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2018-2020  Vincent Pelletier <plr.vincent@gmail.com>
+#
+# This file is part of python-smartcard-app-openpgp.
+# python-smartcard-app-openpgp is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# python-smartcard-app-openpgp is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with python-smartcard-app-openpgp.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Constrained execution profile, to approximate a small board (ex: ARMv6
+single-core) on a faster machine: single CPU affinity, cgroup CPU quota and
+fsync latency injection.
+
+Such profile does not make a fast CPU behave like a slow one: it only brings
+measurements in the same ballpark, and makes them reproducible across
+machines. Calibration factors, computed by comparing the same measurements
+done on the actual board and under the profile, bridge the remaining gap.
+"""
+
+import contextlib
+import importlib
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+# Starting points, to be refined with calibration factors.
+PROFILE_DICT = {
+    # Raspberry Pi Zero (W): single ARM1176 core.
+    'pi-zero': {
+        'single_cpu': True,
+        'cpu_quota': .25,
+        'fsync_latency': .01,
+    },
+}
+
+def restrictToSingleCPU():
+    """
+    Pin the current process to the first CPU it is allowed to run on.
+    Must be called before starting any thread or subprocess so they inherit
+    the affinity. Returns the CPU number.
+    """
+    cpu = min(os.sched_getaffinity(0))
+    os.sched_setaffinity(0, (cpu, ))
+    return cpu
+
+def _iterMountInfo():
+    with open('/proc/self/mountinfo', 'r', encoding='ascii') as mountinfo:
+        for line in mountinfo:
+            # See proc(5): optional fields are terminated by a lone "-".
+            head, tail = line.split(' - ', 1)
+            head_list = head.split()
+            fstype, _, super_options = tail.split()
+            yield (
+                head_list[3], # root
+                head_list[4], # mount point
+                fstype,
+                super_options.split(','),
+            )
+
+def _getCGroupDict():
+    """
+    Return a dict of hierarchy identifier: cgroup path of current process.
+    Hierarchy identifier is a frozenset of controller names (v1), or None (v2).
+    """
+    result = {}
+    with open('/proc/self/cgroup', 'r', encoding='ascii') as cgroup_file:
+        for line in cgroup_file:
+            hierarchy_id, controller_list, path = line.rstrip('\n').split(
+                ':',
+                2,
+            )
+            if hierarchy_id == '0':
+                result[None] = path
+            else:
+                result[frozenset(controller_list.split(','))] = path
+    return result
+
+def _getCPUCGroupPath():
+    """
+    Return (cgroup v2, absolute path of current process' cgroup in the
+    hierarchy holding the cpu controller).
+    """
+    cgroup_dict = _getCGroupDict()
+    for root, mount_point, fstype, super_option_list in _iterMountInfo():
+        if fstype == 'cgroup' and 'cpu' in super_option_list:
+            cgroup_v2 = False
+            path = cgroup_dict[frozenset(
+                x for x in super_option_list
+                if x not in ('rw', 'ro')
+            )]
+        elif fstype == 'cgroup2' and None in cgroup_dict:
+            with open(
+                os.path.join(mount_point, 'cgroup.controllers'),
+                'r',
+                encoding='ascii',
+            ) as controllers_file:
+                if 'cpu' not in controllers_file.read().split():
+                    continue
+            cgroup_v2 = True
+            path = cgroup_dict[None]
+        else:
+            continue
+        relative_path = os.path.relpath(path, root)
+        if relative_path.startswith('..'):
+            # Our cgroup is not visible from this mount.
+            continue
+        return cgroup_v2, os.path.normpath(
+            os.path.join(mount_point, relative_path),
+        )
+    raise ValueError('No cgroup hierarchy with the cpu controller found')
+
+def _writeCGroupFile(path, value):
+    with open(path, 'w', encoding='ascii') as cgroup_file:
+        cgroup_file.write(value)
+
+class CPUQuota:
+    """
+    Context manager moving the current process (and its future children)
+    into a new cgroup whose CPU bandwidth is limited to given fraction of one
+    CPU, and back on exit.
+    Requires write access to the cgroup hierarchy: when this is not available
+    (unprivileged, or cgroup v2 with a populated parent cgroup), run the
+    benchmark in a transient unit instead, for example:
+      systemd-run --user --scope -p CPUQuota=25% smartcard-openpgp-benchmark ...
+    """
+    def __init__(self, fraction, period=100000):
+        """
+        fraction (float)
+            Fraction of a CPU time the process may use, ex: .25 for a quarter
+            of a CPU.
+        period (int)
+            CFS bandwidth enforcement period, in microseconds.
+        """
+        if fraction <= 0:
+            raise ValueError('CPU quota must be positive')
+        self.__quota = max(1000, int(fraction * period))
+        self.__period = period
+        self.__path = None
+        self.__parent_path = None
+
+    def __enter__(self):
+        cgroup_v2, parent_path = _getCPUCGroupPath()
+        path = os.path.join(
+            parent_path,
+            'python-smartcard-constrained-%i' % (os.getpid(), ),
+        )
+        try:
+            os.mkdir(path)
+        except OSError as exc:
+            raise ValueError(
+                'Cannot create cgroup %r (%s), see %s.__doc__' % (
+                    path,
+                    exc,
+                    self.__class__.__name__,
+                ),
+            ) from exc
+        try:
+            if cgroup_v2:
+                _writeCGroupFile(
+                    os.path.join(path, 'cpu.max'),
+                    '%i %i' % (self.__quota, self.__period),
+                )
+            else:
+                _writeCGroupFile(
+                    os.path.join(path, 'cpu.cfs_period_us'),
+                    str(self.__period),
+                )
+                _writeCGroupFile(
+                    os.path.join(path, 'cpu.cfs_quota_us'),
+                    str(self.__quota),
+                )
+            _writeCGroupFile(
+                os.path.join(path, 'cgroup.procs'),
+                str(os.getpid()),
+            )
+        except OSError as exc:
+            os.rmdir(path)
+            raise ValueError(
+                'Cannot configure cgroup %r (%s), see %s.__doc__' % (
+                    path,
+                    exc,
+                    self.__class__.__name__,
+                ),
+            ) from exc
+        self.__path = path
+        self.__parent_path = parent_path
+        logger.info(
+            'CPU quota: %ius every %ius in %s',
+            self.__quota,
+            self.__period,
+            path,
+        )
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        path = self.__path
+        if path is not None:
+            self.__path = None
+            _writeCGroupFile(
+                os.path.join(self.__parent_path, 'cgroup.procs'),
+                str(os.getpid()),
+            )
+            try:
+                os.rmdir(path)
+            except OSError:
+                # Still populated by an exited-but-not-reaped child.
+                logger.warning('Could not remove cgroup %r', path)
+
+class FsyncLatency:
+    """
+    Context manager adding latency after every fsync ZODB FileStorage issues,
+    to approximate slow storage (ex: SD cards).
+    """
+    def __init__(self, latency):
+        """
+        latency (float)
+            Seconds to sleep after each fsync.
+        """
+        self.__latency = latency
+        self.__module = None
+        self.__original_fsync = None
+
+    def __enter__(self):
+        # Import here so the FileStorage module is loaded.
+        module = importlib.import_module('ZODB.FileStorage.FileStorage')
+        # FileStorage binds os.fsync at import time, so patch its global.
+        original_fsync = module.fsync
+        if original_fsync is None:
+            raise ValueError('FileStorage does not fsync on this platform')
+        latency = self.__latency
+        def fsync(fd):
+            original_fsync(fd)
+            time.sleep(latency)
+        self.__module = module
+        self.__original_fsync = original_fsync
+        module.fsync = fsync
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.__module is not None:
+            self.__module.fsync = self.__original_fsync
+            self.__module = None
+
+def addConstrainedArgumentList(parser):
+    """
+    Add the constrained profile options to given argparse parser.
+    """
+    group = parser.add_argument_group(
+        title='Constrained profile',
+        description='Approximate a slower board. Options override the values '
+        'from --profile.',
+    )
+    group.add_argument(
+        '--profile',
+        choices=list(PROFILE_DICT),
+        help='Predefined constrained profile.',
+    )
+    group.add_argument(
+        '--single-cpu',
+        action='store_true',
+        default=None,
+        help='Only run on one CPU.',
+    )
+    group.add_argument(
+        '--cpu-quota',
+        type=float,
+        help='Fraction of one CPU time the benchmark may use, ex: 0.25. '
+        'Requires write access to the cgroup hierarchy.',
+    )
+    group.add_argument(
+        '--fsync-latency',
+        type=float,
+        help='Seconds to add to every FileStorage fsync, ex: 0.01.',
+    )
+
+def getConstrainedProfile(args):
+    """
+    Return the effective profile, as a dict, from parsed arguments.
+    """
+    result = {
+        'single_cpu': False,
+        'cpu_quota': None,
+        'fsync_latency': None,
+    }
+    if args.profile is not None:
+        result.update(PROFILE_DICT[args.profile])
+    for key in result:
+        value = getattr(args, key)
+        if value is not None:
+            result[key] = value
+    return result
+
+def applyConstrainedProfile(profile, exit_stack):
+    """
+    Apply given profile to the current process, registering its undoing on
+    given contextlib.ExitStack.
+    """
+    if profile['single_cpu']:
+        logger.info('Restricted to CPU %i', restrictToSingleCPU())
+    if profile['cpu_quota'] is not None:
+        exit_stack.enter_context(CPUQuota(fraction=profile['cpu_quota']))
+    if profile['fsync_latency'] is not None:
+        exit_stack.enter_context(FsyncLatency(
+            latency=profile['fsync_latency'],
+        ))
+
+class CalibrationFactors:
+    """
+    Per-measurement ratios between durations on the actual board and under a
+    constrained profile, used to estimate board durations from measurements
+    done elsewhere.
+    """
+    def __init__(self, profile, factor_dict):
+        self.profile = profile
+        self.factor_dict = factor_dict
+
+    @classmethod
+    def fromResults(cls, board_result, constrained_result):
+        """
+        board_result (dict)
+            Result of a run on the actual board, without constrained profile.
+        constrained_result (dict)
+            Result of a run under the constrained profile.
+        Results are dicts with "profile" (dict) and "duration" (dict of
+        measurement name: seconds) keys.
+        """
+        board_duration_dict = board_result['duration']
+        return cls(
+            profile=constrained_result['profile'],
+            factor_dict={
+                name: board_duration_dict[name] / duration
+                for name, duration in constrained_result['duration'].items()
+                if name in board_duration_dict and duration
+            },
+        )
+
+    def estimate(self, result):
+        """
+        Return a dict of measurement name: estimated board duration, for the
+        measurements of given result for which a factor is known.
+        """
+        if result['profile'] != self.profile:
+            logger.warning(
+                'Calibration factors were computed with profile %r, '
+                'not %r: estimates will be off',
+                self.profile,
+                result['profile'],
+            )
+        factor_dict = self.factor_dict
+        return {
+            name: duration * factor_dict[name]
+            for name, duration in result['duration'].items()
+            if name in factor_dict
+        }
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r', encoding='utf-8') as factor_file:
+            data = json.load(factor_file)
+        return cls(profile=data['profile'], factor_dict=data['factor'])
+
+    def save(self, path):
+        with open(path, 'w', encoding='utf-8') as factor_file:
+            json.dump(
+                {
+                    'profile': self.profile,
+                    'factor': self.factor_dict,
+                },
+                factor_file,
+                indent=2,
+                sort_keys=True,
+            )
+
+@contextlib.contextmanager
+def constrainedProfile(args):
+    """
+    Context manager applying the constrained profile from parsed arguments,
+    yielding the effective profile.
+    """
+    profile = getConstrainedProfile(args)
+    with contextlib.ExitStack() as exit_stack:
+        applyConstrainedProfile(profile, exit_stack)
+        yield profile
@@ -0,0 +1,543 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2018-2020  Vincent Pelletier <plr.vincent@gmail.com>
+#
+# This file is part of python-smartcard-app-openpgp.
+# python-smartcard-app-openpgp is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# python-smartcard-app-openpgp is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with python-smartcard-app-openpgp.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Cost of key generation, key import and private key operations, for every
+algorithm attributes combination the card advertises, and algorithm
+calibration from these measures.
+
+Private key operations go through the card's command processing on a
+loopback card, so they are measured the way a host would trigger them.
+"""
+
+from collections import namedtuple
+import logging
+import os
+import time
+from cryptography.hazmat.primitives.asymmetric.ec import (
+    EllipticCurvePrivateKey,
+    generate_private_key as generate_private_ec_key,
+)
+from cryptography.hazmat.primitives.asymmetric.ed25519 import (
+    Ed25519PrivateKey,
+)
+from cryptography.hazmat.primitives.asymmetric.padding import PKCS1v15
+from cryptography.hazmat.primitives.asymmetric.rsa import RSAPrivateKey
+from cryptography.hazmat.primitives.asymmetric.x25519 import (
+    X25519PrivateKey,
+)
+from cryptography.hazmat.primitives import serialization
+from smartcard.asn1 import CodecBER
+from . import (
+    DEFAULT_PW3,
+    KEY_ROLE_AUTHENTICATE,
+    KEY_ROLE_DECRYPT,
+    KEY_ROLE_SIGN,
+    KEY_ROLE_TO_ATTRIBUTE_TAG_DICT,
+    ROLE_TO_SUPPORTED_ALGORITHM_INFORMATION_LIST_DICT,
+)
+from .calibration import (
+    AlgorithmCalibration,
+    algorithm_policy,
+    getKeySpec,
+)
+from .loopback import (
+    SELECT_OPENPGP,
+    STATUS_SUCCESS,
+    LoopbackCard,
+    _getExtendedHeaderList,
+    encodeAPDU,
+    encodeECDHCipher,
+    getDigestInfo,
+    getPercentile,
+)
+from .tag import (
+    AlgorithmAttributesBase,
+    CardholderPrivateKeyTemplate,
+)
+
+logger = logging.getLogger(__name__)
+
+ROLE_NAME_DICT = {
+    KEY_ROLE_SIGN: 'sign',
+    KEY_ROLE_DECRYPT: 'decrypt',
+    KEY_ROLE_AUTHENTICATE: 'authenticate',
+}
+ROLE_CONTROL_REFERENCE_DICT = {
+    KEY_ROLE_SIGN: b'\xb6',
+    KEY_ROLE_DECRYPT: b'\xb8',
+    KEY_ROLE_AUTHENTICATE: b'\xa4',
+}
+ROLE_ATTRIBUTES_TAG_DICT = {
+    KEY_ROLE_SIGN: 0xc1,
+    KEY_ROLE_DECRYPT: 0xc2,
+    KEY_ROLE_AUTHENTICATE: 0xc3,
+}
+ROLE_PW1_LEVEL_DICT = {
+    KEY_ROLE_SIGN: 0x81,
+    KEY_ROLE_DECRYPT: 0x82,
+    KEY_ROLE_AUTHENTICATE: 0x82,
+}
+OPERATION_KEYGEN = 'keygen'
+OPERATION_IMPORT = 'import'
+# The private key operation is named after the role.
+
+_RSA = AlgorithmAttributesBase.RSA
+_RSA_IMPORT_FORMAT_CAPTION_DICT = {
+    _RSA.IMPORT_FORMAT_STANDARD: 'standard',
+    _RSA.IMPORT_FORMAT_STANDARD_WITH_MODULUS: 'standard+modulus',
+    _RSA.IMPORT_FORMAT_CRT: 'crt',
+    _RSA.IMPORT_FORMAT_CRT_WITH_MODULUS: 'crt+modulus',
+}
+_CURVE_CAPTION_DICT = {
+    Ed25519PrivateKey: 'ed25519',
+    X25519PrivateKey: 'x25519',
+}
+
+MatrixEntry = namedtuple(
+    'MatrixEntry',
+    (
+        'role',
+        'attributes', # bytes, as in the algorithm attributes data objects
+        'caption',
+        'operation',
+        'duration_list', # seconds
+        'error', # None on success
+    ),
+)
+
+def iterAlgorithmAttributes(role_list=None):
+    """
+    Yield (role, attributes) for each supported combination.
+    role_list (list of roles, or None)
+        Roles to list. None for all.
+    """
+    for role, attributes_list in (
+        ROLE_TO_SUPPORTED_ALGORITHM_INFORMATION_LIST_DICT.items()
+    ):
+        if role_list is None or role in role_list:
+            for attributes in attributes_list:
+                yield role, attributes
+
+def describeAlgorithmAttributes(role, attributes):
+    """
+    Return a short human-readable description of algorithm attributes.
+    """
+    decoded = KEY_ROLE_TO_ATTRIBUTE_TAG_DICT[role].decode(
+        attributes,
+        codec=CodecBER,
+    )
+    algorithm = decoded['algorithm']
+    parameter_dict = decoded['parameter_dict']
+    if algorithm is _RSA:
+        return 'RSA-%i %s' % (
+            parameter_dict['modulus_bit_length'],
+            _RSA_IMPORT_FORMAT_CAPTION_DICT[parameter_dict['import_format']],
+        )
+    curve = parameter_dict['algo']
+    return '%s %s%s' % (
+        algorithm.__name__,
+        _CURVE_CAPTION_DICT.get(curve) or curve.name,
+        '+pubkey' if parameter_dict['with_public_key'] else '',
+    )
+
+def _encodeInteger(value, length):
+    return value.to_bytes(length, 'big')
+
+def getKeyComponentList(role, attributes, private_key):
+    """
+    Return the (tag class, value) list a host would send to import
+    private_key, in the format given algorithm attributes describe.
+    """
+    parameter_dict = KEY_ROLE_TO_ATTRIBUTE_TAG_DICT[role].decode(
+        attributes,
+        codec=CodecBER,
+    )['parameter_dict']
+    if isinstance(private_key, RSAPrivateKey):
+        private_numbers = private_key.private_numbers()
+        modulus_length = (parameter_dict['modulus_bit_length'] + 7) // 8
+        prime_length = modulus_length // 2
+        component_list = [
+            (
+                CardholderPrivateKeyTemplate.PublicExponent,
+                _encodeInteger(
+                    private_numbers.public_numbers.e,
+                    (parameter_dict['public_exponent_bit_length'] + 7) // 8,
+                ),
+            ),
+            (
+                CardholderPrivateKeyTemplate.Prime1,
+                _encodeInteger(private_numbers.p, prime_length),
+            ),
+            (
+                CardholderPrivateKeyTemplate.Prime2,
+                _encodeInteger(private_numbers.q, prime_length),
+            ),
+        ]
+        import_format = parameter_dict['import_format']
+        if import_format in (
+            _RSA.IMPORT_FORMAT_CRT,
+            _RSA.IMPORT_FORMAT_CRT_WITH_MODULUS,
+        ):
+            component_list.extend((
+                (
+                    CardholderPrivateKeyTemplate.PQ,
+                    _encodeInteger(private_numbers.iqmp, prime_length),
+                ),
+                (
+                    CardholderPrivateKeyTemplate.DP1,
+                    _encodeInteger(private_numbers.dmp1, prime_length),
+                ),
+                (
+                    CardholderPrivateKeyTemplate.DQ1,
+                    _encodeInteger(private_numbers.dmq1, prime_length),
+                ),
+            ))
+        if import_format in (
+            _RSA.IMPORT_FORMAT_STANDARD_WITH_MODULUS,
+            _RSA.IMPORT_FORMAT_CRT_WITH_MODULUS,
+        ):
+            component_list.append((
+                CardholderPrivateKeyTemplate.Modulus,
+                _encodeInteger(
+                    private_numbers.public_numbers.n,
+                    modulus_length,
+                ),
+            ))
+        return component_list
+    if isinstance(private_key, EllipticCurvePrivateKey):
+        private_value = _encodeInteger(
+            private_key.private_numbers().private_value,
+            (private_key.curve.key_size + 7) // 8,
+        )
+        public_value = private_key.public_key().public_bytes(
+            encoding=serialization.Encoding.X962,
+            format=serialization.PublicFormat.UncompressedPoint,
+        )
+    else:
+        private_value = private_key.private_bytes(
+            encoding=serialization.Encoding.Raw,
+            format=serialization.PrivateFormat.Raw,
+            encryption_algorithm=serialization.NoEncryption(),
+        )
+        public_value = private_key.public_key().public_bytes(
+            encoding=serialization.Encoding.Raw,
+            format=serialization.PublicFormat.Raw,
+        )
+    component_list = [
+        (CardholderPrivateKeyTemplate.CurvePrivateKey, private_value),
+    ]
+    if parameter_dict['with_public_key']:
+        component_list.append(
+            (CardholderPrivateKeyTemplate.CurvePublicKey, public_value),
+        )
+    return component_list
+
+def _generateEphemeralPublicKey(private_key):
+    """
+    Return the encoded public part of a new key pair for the key agreement
+    with private_key, as the host sends it.
+    """
+    if isinstance(private_key, EllipticCurvePrivateKey):
+        return generate_private_ec_key(
+            curve=private_key.curve,
+        ).public_key().public_bytes(
+            encoding=serialization.Encoding.X962,
+            format=serialization.PublicFormat.UncompressedPoint,
+        )
+    return X25519PrivateKey.generate().public_key().public_bytes(
+        encoding=serialization.Encoding.Raw,
+        format=serialization.PublicFormat.Raw,
+    )
+
+def getPrivateOperationCommand(role, private_key):
+    """
+    Return a command exercising private_key the way a host would for given
+    role: PSO:DECIPHER, PSO:COMPUTE DIGITAL SIGNATURE or INTERNAL
+    AUTHENTICATE.
+    """
+    if role is KEY_ROLE_DECRYPT:
+        if isinstance(private_key, RSAPrivateKey):
+            data = b'\x00' + private_key.public_key().encrypt(
+                plaintext=os.urandom(32),
+                padding=PKCS1v15(),
+            )
+        else:
+            data = encodeECDHCipher(_generateEphemeralPublicKey(private_key))
+        return encodeAPDU(0x00, 0x2a, 0x80, 0x86, data, le=0)
+    digest, digest_info = getDigestInfo(os.urandom(32))
+    data = digest_info if isinstance(private_key, RSAPrivateKey) else digest
+    if role is KEY_ROLE_SIGN:
+        return encodeAPDU(0x00, 0x2a, 0x9e, 0x9a, data, le=0)
+    return encodeAPDU(0x00, 0x88, 0x00, 0x00, data, le=0)
+
+class _CommandFailed(Exception):
+    pass
+
+def _transmit(loopback_card, command):
+    response = loopback_card.transmit(command)
+    if response[-2:] != STATUS_SUCCESS:
+        raise _CommandFailed('status %s' % (response[-2:].hex(), ))
+    return response[:-2]
+
+def _timeCall(duration_list, count, func, *args):
+    result = None
+    for _ in range(count):
+        start = time.perf_counter()
+        result = func(*args)
+        duration_list.append(time.perf_counter() - start)
+    return result
+
+def measureAlgorithmAttributes(
+    loopback_card,
+    role,
+    attributes,
+    keygen_count,
+    operation_count,
+    private_key=None,
+    import_count=None,
+):
+    """
+    Measure one algorithm attributes combination on loopback_card, whose
+    OpenPGP application must be selected with PW3 verified.
+    Leaves the measured key imported in the card.
+    Returns a list of MatrixEntry: key generation, key import (parsing the
+    components into a key object), and the private key operation.
+    private_key (private key, or None)
+        Key to use instead of generating one, key generation being then
+        absent from the result.
+    import_count (int, or None)
+        Number of key imports to measure, 0 for key import to be absent
+        from the result. None to use operation_count.
+    """
+    caption = describeAlgorithmAttributes(role, attributes)
+    algorithm = KEY_ROLE_TO_ATTRIBUTE_TAG_DICT[role].getAlgorithmObject(
+        attributes,
+        codec=CodecBER,
+    )
+    result = []
+    def append(operation, duration_list, error=None):
+        result.append(MatrixEntry(
+            role=role,
+            attributes=attributes,
+            caption=caption,
+            operation=operation,
+            duration_list=duration_list,
+            error=error,
+        ))
+    if private_key is None:
+        duration_list = []
+        private_key = _timeCall(duration_list, keygen_count, algorithm.newKey)
+        append(OPERATION_KEYGEN, duration_list)
+    component_list = getKeyComponentList(role, attributes, private_key)
+    if import_count is None:
+        import_count = operation_count
+    if import_count:
+        duration_list = []
+        try:
+            _timeCall(
+                duration_list,
+                import_count,
+                algorithm.importKey,
+                dict(component_list),
+            )
+        except Exception as exc: # pylint: disable=broad-except
+            append(OPERATION_IMPORT, duration_list, repr(exc))
+        else:
+            append(OPERATION_IMPORT, duration_list)
+    duration_list = []
+    control_reference = ROLE_CONTROL_REFERENCE_DICT[role]
+    try:
+        _transmit(loopback_card, encodeAPDU(
+            0x00, 0xda, 0x00, ROLE_ATTRIBUTES_TAG_DICT[role], attributes,
+        ))
+        _transmit(loopback_card, encodeAPDU(
+            0x00, 0xdb, 0x3f, 0xff,
+            _getExtendedHeaderList(
+                control_reference,
+                [
+                    ((0x80 | tag.identifier).to_bytes(1, 'big'), value)
+                    for tag, value in component_list
+                ],
+            ),
+        ))
+        level = ROLE_PW1_LEVEL_DICT[role]
+        for index in range(operation_count):
+            # PW1 for signature is by default only valid for one signature.
+            if level == 0x81 or not index:
+                _transmit(loopback_card, encodeAPDU(
+                    0x00, 0x20, 0x00, level, loopback_card.getPW1(),
+                ))
+            command = getPrivateOperationCommand(role, private_key)
+            start = time.perf_counter()
+            _transmit(loopback_card, command)
+            duration_list.append(time.perf_counter() - start)
+    except _CommandFailed as exc:
+        append(ROLE_NAME_DICT[role], duration_list, str(exc))
+    else:
+        append(ROLE_NAME_DICT[role], duration_list)
+    return result
+
+def _prepareCard(loopback_card):
+    loopback_card.powerOn()
+    _transmit(loopback_card, SELECT_OPENPGP)
+    _transmit(
+        loopback_card,
+        encodeAPDU(0x00, 0x20, 0x00, 0x83, DEFAULT_PW3),
+    )
+
+def iterMatrix(
+    loopback_card,
+    role_list=None,
+    caption_filter_list=None,
+    keygen_count=3,
+    operation_count=20,
+):
+    """
+    Measure all supported algorithm attributes combinations, yielding
+    MatrixEntry instances.
+    caption_filter_list (list of str, or None)
+        Only measure combinations whose description contains any of these
+        strings (case-insensitive). None to measure all.
+    """
+    if caption_filter_list is not None:
+        caption_filter_list = [x.lower() for x in caption_filter_list]
+    _prepareCard(loopback_card)
+    for role, attributes in iterAlgorithmAttributes(role_list):
+        if caption_filter_list is not None:
+            caption = describeAlgorithmAttributes(role, attributes).lower()
+            if not any(x in caption for x in caption_filter_list):
+                continue
+        for entry in measureAlgorithmAttributes(
+            loopback_card=loopback_card,
+            role=role,
+            attributes=attributes,
+            keygen_count=keygen_count,
+            operation_count=operation_count,
+        ):
+            yield entry
+
+def calibrate(keygen_count=3, operation_count=5):
+    """
+    Measure all supported algorithm attributes combinations, returning an
+    AlgorithmCalibration holding the 90th percentile of key generation and
+    private key operation durations.
+    Key generation is only measured once per key spec.
+    """
+    calibration = AlgorithmCalibration()
+    # key spec -> (keygen duration, private key)
+    key_dict = {}
+    with LoopbackCard() as loopback_card:
+        _prepareCard(loopback_card)
+        for role, attributes in iterAlgorithmAttributes():
+            tag = KEY_ROLE_TO_ATTRIBUTE_TAG_DICT[role]
+            key_spec = getKeySpec(tag, attributes)
+            try:
+                keygen_duration, private_key = key_dict[key_spec]
+            except KeyError:
+                logger.info(
+                    'Measuring key generation for %s...',
+                    describeAlgorithmAttributes(role, attributes),
+                )
+                duration_list = []
+                private_key = _timeCall(
+                    duration_list,
+                    keygen_count,
+                    tag.getAlgorithmObject(attributes, codec=CodecBER).newKey,
+                )
+                keygen_duration = getPercentile(sorted(duration_list), 90)
+                key_dict[key_spec] = (keygen_duration, private_key)
+            operation_duration = None
+            for entry in measureAlgorithmAttributes(
+                loopback_card=loopback_card,
+                role=role,
+                attributes=attributes,
+                keygen_count=0,
+                operation_count=operation_count,
+                private_key=private_key,
+                import_count=0,
+            ):
+                if entry.operation == ROLE_NAME_DICT[role] and not entry.error:
+                    operation_duration = getPercentile(
+                        sorted(entry.duration_list),
+                        90,
+                    )
+            calibration.set(
+                tag=tag,
+                attributes=attributes,
+                keygen_duration=keygen_duration,
+                operation_duration=operation_duration,
+            )
+    return calibration
+
+def addCalibrationArgumentList(parser):
+    """
+    Add algorithm calibration options to an argparse parser.
+    """
+    parser.add_argument(
+        '--algorithm-calibration',
+        help='Path to a file holding the measured cost of each algorithm on '
+        'this board, measured and created if missing. Algorithms exceeding '
+        'the latency budgets below are then not offered to hosts. See also '
+        '"smartcard-openpgp-benchmark calibrate".',
+    )
+    parser.add_argument(
+        '--keygen-budget',
+        type=float,
+        default=5,
+        help='Longest acceptable on-card key generation, in seconds. '
+        'gnupg gives up after 5s by default (default: %(default)s).',
+    )
+    parser.add_argument(
+        '--operation-budget',
+        type=float,
+        default=2,
+        help='Longest acceptable signature, decryption or authentication, in '
+        'seconds (default: %(default)s).',
+    )
+    parser.add_argument(
+        '--slow-keygen',
+        default='prefill',
+        choices=['prefill', 'reject'],
+        help='What to do with algorithms exceeding the keygen budget: only '
+        'offer them once a key was generated in advance, or never offer '
+        'them (default: %(default)s).',
+    )
+
+def setupAlgorithmPolicy(args):
+    """
+    Configure the algorithm policy from options added by
+    addCalibrationArgumentList, calibrating first if needed.
+    Must be called before any card gets loaded.
+    """
+    path = args.algorithm_calibration
+    if path is None:
+        return
+    calibration = AlgorithmCalibration.load(path)
+    if calibration is None:
+        logger.warning(
+            'No algorithm calibration found, measuring algorithms. This may '
+            'take a while...',
+        )
+        calibration = calibrate()
+        calibration.save(path)
+    algorithm_policy.configure(
+        calibration=calibration,
+        keygen_budget=args.keygen_budget,
+        operation_budget=args.operation_budget,
+        prefill=args.slow_keygen == 'prefill',
+    )
@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2018-2020  Vincent Pelletier <plr.vincent@gmail.com>
+#
+# This file is part of python-smartcard-app-openpgp.
+# python-smartcard-app-openpgp is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# python-smartcard-app-openpgp is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with python-smartcard-app-openpgp.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+In-memory ring buffer of structured events, cheap enough to be left
+enabled in production: each event is a timestamp, an event code and two
+integers, stored in preallocated arrays. Nothing gets formatted until the
+buffer is dumped, and no event carries secrets (APDU events only hold the
+instruction, parameters and status word).
+"""
+
+from array import array
+import logging
+import os
+import signal
+import time
+from smartcard import APDU_HEAD_LENGTH
+from smartcard.utils import transaction_manager
+
+logger = logging.getLogger(__name__)
+
+# Event codes, and the meaning of their two integer arguments.
+EVENT_APDU_START = 1 # instruction, p1p2
+EVENT_APDU_END = 2 # instruction, status word
+EVENT_POWER_ON = 3 # -, -
+EVENT_POWER_OFF = 4 # -, -
+EVENT_TRANSACTION_END = 5 # 1 if committed (0 if aborted), -
+EVENT_KEYGEN_START = 6 # key index, algorithm id
+EVENT_KEYGEN_END = 7 # key index, 1 if successful (0 otherwise)
+EVENT_DISPLAY_REFRESH_START = 8 # 1 if waiting for refresh completion, -
+EVENT_DISPLAY_REFRESH_END = 9 # -, -
+EVENT_NAME_DICT = {
+    EVENT_APDU_START: 'apdu_start',
+    EVENT_APDU_END: 'apdu_end',
+    EVENT_POWER_ON: 'power_on',
+    EVENT_POWER_OFF: 'power_off',
+    EVENT_TRANSACTION_END: 'transaction_end',
+    EVENT_KEYGEN_START: 'keygen_start',
+    EVENT_KEYGEN_END: 'keygen_end',
+    EVENT_DISPLAY_REFRESH_START: 'display_refresh_start',
+    EVENT_DISPLAY_REFRESH_END: 'display_refresh_end',
+}
+
+class EventRing:
+    """
+    Fixed-capacity event buffer, overwriting the oldest events once full.
+    Disabled (recording nothing) while its capacity is zero.
+    """
+    def __init__(self, capacity=0):
+        self.resize(capacity)
+
+    def resize(self, capacity):
+        """
+        Change capacity, discarding all events.
+        """
+        self._capacity = capacity
+        self._timestamp_array = array('q', bytes(8 * capacity))
+        self._code_array = array('B', bytes(capacity))
+        self._a_array = array('q', bytes(8 * capacity))
+        self._b_array = array('q', bytes(8 * capacity))
+        self._total = 0
+
+    @property
+    def enabled(self):
+        return self._capacity != 0
+
+    def record(self, code, a=0, b=0):
+        capacity = self._capacity
+        if capacity:
+            total = self._total
+            index = total % capacity
+            self._total = total + 1
+            self._timestamp_array[index] = time.monotonic_ns()
+            self._code_array[index] = code
+            self._a_array[index] = a
+            self._b_array[index] = b
+
+    def iterEvents(self):
+        """
+        Yield (monotonic timestamp in ns, code, a, b) tuples, oldest first.
+        """
+        capacity = self._capacity
+        total = self._total
+        if not capacity:
+            return
+        first = total - min(total, capacity)
+        for event_id in range(first, total):
+            index = event_id % capacity
+            yield (
+                self._timestamp_array[index],
+                self._code_array[index],
+                self._a_array[index],
+                self._b_array[index],
+            )
+
+    def dump(self, stream):
+        """
+        Write events to a text stream, one per line, oldest first, with
+        timestamps in seconds relative to the most recent event.
+        """
+        event_list = list(self.iterEvents())
+        if not event_list:
+            return
+        last_timestamp = event_list[-1][0]
+        for timestamp, code, a, b in event_list:
+            stream.write('%+.6f %s %x %x\n' % (
+                (timestamp - last_timestamp) / 1e9,
+                EVENT_NAME_DICT.get(code, code),
+                a,
+                b,
+            ))
+
+event_ring = EventRing()
+
+class _TransactionEventSynchronizer:
+    """
+    transaction.interfaces.ISynchronizer recording transaction ends.
+    """
+    def newTransaction(self, txn):
+        pass
+
+    def beforeCompletion(self, txn):
+        pass
+
+    def afterCompletion(self, txn):
+        event_ring.record(
+            EVENT_TRANSACTION_END,
+            txn.status == 'Committed',
+        )
+
+# Transaction managers only keep weak references to synchronizers.
+_transaction_event_synchronizer = _TransactionEventSynchronizer()
+
+class EventCard:
+    """
+    Stands for a card (as far as a reader slot is concerned), recording
+    power and APDU events.
+    """
+    def __init__(self, card, ring=event_ring):
+        self._card = card
+        self._record = ring.record
+
+    def __repr__(self):
+        return '<%s(card=%r) object at %x>' % (
+            self.__class__.__name__,
+            self._card,
+            id(self),
+        )
+
+    def getATR(self):
+        self._record(EVENT_POWER_ON)
+        return self._card.getATR()
+
+    def clearVolatile(self):
+        self._record(EVENT_POWER_OFF)
+        self._card.clearVolatile()
+
+    def runAPDU(self, command):
+        record = self._record
+        if len(command) >= APDU_HEAD_LENGTH:
+            instruction = command[1]
+            record(
+                EVENT_APDU_START,
+                instruction,
+                (command[2] << 8) | command[3],
+            )
+        else:
+            instruction = -1
+            record(EVENT_APDU_START, instruction)
+        result = self._card.runAPDU(command)
+        record(
+            EVENT_APDU_END,
+            instruction,
+            (result[-2] << 8) | result[-1],
+        )
+        return result
+
+class EventDumper:
+    """
+    Enables the event ring, and dumps it to a file when the process
+    receives a signal.
+    Must be started from the main thread, as it installs a signal handler.
+    """
+    def __init__(
+        self,
+        path,
+        capacity=4096,
+        signal_number=signal.SIGUSR1,
+        ring=event_ring,
+    ):
+        self._path = path
+        self._capacity = capacity
+        self._signal_number = signal_number
+        self._ring = ring
+        self.__previous_handler = None
+
+    def start(self):
+        self._ring.resize(self._capacity)
+        transaction_manager.registerSynch(_transaction_event_synchronizer)
+        self.__previous_handler = signal.signal(
+            self._signal_number,
+            self.__onSignal,
+        )
+
+    def __onSignal(self, signal_number, frame):
+        _ = signal_number, frame # Silence pylint.
+        self.dump()
+
+    def dump(self):
+        try:
+            with open(self._path, 'w', encoding='ascii') as stream:
+                self._ring.dump(stream)
+        except Exception: # pylint: disable=broad-except
+            logger.exception('Failed to dump events to %r', self._path)
+        else:
+            logger.info('Events dumped to %r', self._path)
+
+    def close(self):
+        if self.__previous_handler is not None:
+            signal.signal(self._signal_number, self.__previous_handler)
+            self.__previous_handler = None
+            transaction_manager.unregisterSynch(
+                _transaction_event_synchronizer,
+            )
+            self._ring.resize(0)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def addEventArgumentList(parser):
+    """
+    Add event ring options to an argparse parser.
+    """
+    parser.add_argument(
+        '--event-dump',
+        help='Enable recording of recent events (APDU instructions and status '
+        'words, power changes, transactions, key generation, display '
+        'refreshes) in memory, and write them to this path when receiving '
+        'SIGUSR1. Contains no secret, unlike "--verbose debug".',
+    )
+    parser.add_argument(
+        '--event-buffer-size',
+        type=int,
+        default=4096,
+        help='Number of events kept in memory for --event-dump '
+        '(default: %(default)s).',
+    )
+
+def getEventDumper(args):
+    """
+    Return a (not started) EventDumper for options added by
+    addEventArgumentList, or None if events are not recorded.
+    """
+    if args.event_dump is None:
+        return None
+    return EventDumper(
+        path=os.path.abspath(args.event_dump),
+        capacity=args.event_buffer_size,
+    )
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2018-2020  Vincent Pelletier <plr.vincent@gmail.com>
+#
+# This file is part of python-smartcard-app-openpgp.
+# python-smartcard-app-openpgp is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# python-smartcard-app-openpgp is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with python-smartcard-app-openpgp.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+from transaction.interfaces import NoTransaction
+from ZODB.POSException import (
+    ConnectionStateError,
+    ReadConflictError,
+)
+from smartcard import (
+    APDU_HEAD_LENGTH,
+    APDUHead,
+    LifecycleBase,
+    MASTER_FILE_IDENTIFIER,
+)
+from smartcard.status import (
+    APDUException,
+    UnspecifiedError,
+)
+
+logger = logging.getLogger(__name__)
+
+class ReadOnlyFastPathCard:
+    """
+    Stands for a card (as far as a reader slot is concerned), running the
+    commands an application declares as read-only (see
+    OpenPGP.isReadOnlyCommand) outside of any transaction, from the already
+    loaded objects. All other commands go through Card.runAPDU, and get their
+    own transaction.
+
+    Requires the card's connection to use an explicit transaction manager
+    (like smartcard.utils.transaction_manager): should a command classified
+    as read-only try to modify persistent state, the modification is then
+    rejected before it happens, and the command is re-run in a transaction.
+    Likewise, should a command need to load an object which is not usable
+    outside of a transaction (ex: it got invalidated, or evicted from the
+    cache), it is re-run in a transaction.
+    """
+    def __init__(self, card, application):
+        self._card = card
+        self._isReadOnlyCommand = application.isReadOnlyCommand
+        self._master_file = card.traverse((MASTER_FILE_IDENTIFIER, ))
+
+    def getATR(self):
+        return self._card.getATR()
+
+    def clearVolatile(self):
+        self._card.clearVolatile()
+
+    def __isTerminated(self):
+        try:
+            return (
+                self._master_file.lifecycle & LifecycleBase.TERMINATED_MASK
+            ) == LifecycleBase.TERMINATED
+        except (ConnectionStateError, ReadConflictError):
+            # Let Card.runAPDU check, in a transaction.
+            return True
+
+    def runAPDU(self, command):
+        card = self._card
+        if (
+            len(command) < APDU_HEAD_LENGTH or
+            not self._isReadOnlyCommand(APDUHead.from_buffer_copy(command)) or
+            self.__isTerminated()
+        ):
+            return card.runAPDU(command)
+        # Same as Card.runAPDU, without the transaction.
+        try:
+            result = card._runAPDU(command) # pylint: disable=protected-access
+        except APDUException as exc:
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug('APDU exception', exc_info=True)
+            else:
+                logger.info('APDU exception %r', exc)
+            result = exc.value
+        except NoTransaction:
+            logger.warning(
+                'Command classified as read-only modified persistent state, '
+                'retrying in a transaction: %s',
+                bytes(command[:APDU_HEAD_LENGTH]).hex(),
+            )
+            result = card.runAPDU(command)
+        except (ConnectionStateError, ReadConflictError):
+            logger.info(
+                'Read-only command needs to load objects, retrying in a '
+                'transaction: %s',
+                bytes(command[:APDU_HEAD_LENGTH]).hex(),
+            )
+            result = card.runAPDU(command)
+        except Exception: # pylint: disable=broad-except
+            logger.error(
+                'APDU processing raised an unhandled exception',
+                exc_info=1,
+            )
+            result = UnspecifiedError().value
+        return result
@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2018-2020  Vincent Pelletier <plr.vincent@gmail.com>
+#
+# This file is part of python-smartcard-app-openpgp.
+# python-smartcard-app-openpgp is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# python-smartcard-app-openpgp is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with python-smartcard-app-openpgp.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import time
+import ZODB.DB
+import ZODB.FileStorage
+from smartcard import (
+    Card,
+    MASTER_FILE_IDENTIFIER,
+)
+from smartcard.app.openpgp import (
+    OpenPGP,
+    VolatileSurvivorConnection,
+)
+from smartcard.app.openpgp.fastpath import ReadOnlyFastPathCard
+from smartcard.app.openpgp.snapshot import (
+    CardSnapshot,
+    WarmStartCard,
+)
+from smartcard.utils import transaction_manager
+
+logger = logging.getLogger(__name__)
+
+class _DB(ZODB.DB):
+    # So the card keeps the host's session when it gets ghostified.
+    klass = VolatileSurvivorConnection
+
+class LazyCard:
+    """
+    Stands for a card stored in its own FileStorage (as far as a reader slot
+    is concerned), loaded either in advance (see open and load) or when the
+    slot first gets powered, and which can be unloaded once idle.
+
+    When loaded on demand with a warm-start snapshot matching the
+    FileStorage, loading is further delayed until the host sends a command
+    the snapshot cannot answer.
+
+    Except for loadCard (see serveSnapshot), must only be used from the
+    thread running the reader's event loop, as all cards share the
+    transaction manager Card.runAPDU uses: one transaction is open at a time,
+    and it only involves the connection of the card it runs on.
+    """
+    # Any 2-bytes value is fine, this is not what is used to
+    # select the application.
+    __OPENPGP_FILE_IDENTIFIER = b'\x12\x34'
+    __card = None
+    __connection = None
+    __db = None
+    __slot_card = None
+    __snapshot = None
+    __snapshot_tid = None
+    # Whether the host powered the slot this card is inserted in.
+    powered = False
+
+    def __init__(self, zodb_path, snapshot_path=None):
+        self.__zodb_path = zodb_path
+        self.__snapshot_path = snapshot_path
+        self.last_access = time.monotonic()
+
+    def __repr__(self):
+        return '<%s(zodb_path=%r) object at %x>' % (
+            self.__class__.__name__,
+            self.__zodb_path,
+            id(self),
+        )
+
+    @property
+    def loaded(self):
+        return self.__db is not None
+
+    def getDatabase(self):
+        """
+        Return the ZODB.DB of this card, or None when not loaded.
+        """
+        return self.__db
+
+    def getStorageState(self):
+        """
+        Return the last transaction id and the size of the storage, or None
+        when not loaded.
+        """
+        db = self.__db
+        if db is None:
+            return None
+        storage = db.storage
+        return storage.lastTransaction(), storage.getSize()
+
+    def open(self):
+        """
+        Open the database, if not open yet, without loading the card.
+        Returns whether a warm-start snapshot matches the database.
+        """
+        if self.__db is None:
+            logger.info('%r: initialising the database...', self)
+            self.__db = db = _DB(
+                storage=ZODB.FileStorage.FileStorage(
+                    file_name=self.__zodb_path,
+                ),
+                pool_size=1,
+            )
+            self.__snapshot = None
+            snapshot_path = self.__snapshot_path
+            if snapshot_path is not None:
+                snapshot = CardSnapshot.load(snapshot_path)
+                if (
+                    snapshot is not None and
+                    snapshot.tid == db.storage.lastTransaction()
+                ):
+                    self.__snapshot = snapshot
+                    self.__snapshot_tid = snapshot.tid
+        return self.__snapshot is not None
+
+    def load(self):
+        """
+        Load the card now, rather than when the host first needs it.
+        """
+        if self.__card is None:
+            self.open()
+            self.__slot_card = self.loadCard()
+
+    def serveSnapshot(self):
+        """
+        Answer from the warm-start snapshot (see open) until the card
+        returned by loadCard, typically called from another thread, is given
+        to the returned WarmStartCard.
+        """
+        logger.info('%r: using warm-start snapshot', self)
+        self.__slot_card = slot_card = WarmStartCard(self.__snapshot)
+        return slot_card
+
+    def __getSlotCard(self):
+        slot_card = self.__slot_card
+        if slot_card is None:
+            if self.open():
+                logger.info('%r: using warm-start snapshot', self)
+                slot_card = WarmStartCard(
+                    self.__snapshot,
+                    loadCard=self.loadCard,
+                )
+            else:
+                slot_card = self.loadCard()
+            self.__slot_card = slot_card
+        return slot_card
+
+    def loadCard(self):
+        """
+        Load the card, and return it.
+        Must not be called while another card runs a transaction, as they
+        share the transaction manager.
+        """
+        logger.info('%r: opening a connection to the database...', self)
+        self.__connection = connection = self.__db.open(
+            transaction_manager=transaction_manager,
+        )
+        root = connection.root
+        try:
+            card = root.card
+        except AttributeError:
+            logger.info(
+                '%r: database does not contain a card, building an new one...',
+                self,
+            )
+            with transaction_manager:
+                card = root.card = Card(
+                    name='py-openpgp'.encode('ascii'),
+                )
+                openpgp = OpenPGP(
+                    identifier=self.__OPENPGP_FILE_IDENTIFIER,
+                )
+                openpgp.activateSelf()
+                card.createFile(
+                    card.traverse((MASTER_FILE_IDENTIFIER, )),
+                    openpgp,
+                )
+        else:
+            logger.info('%r: card data found, using it.', self)
+        # XXX: Loading is slow, and the DWC2 accepts receiving transfer
+        # requests while USB bus is active, but rejects them at any other time
+        # - including when USB bus is suspended by host. A warm-start snapshot
+        # allows answering the host while not loaded yet.
+        logger.debug('%r: loading OpenPGP from database...', self)
+        with transaction_manager:
+            openpgp = card.traverse(
+                path=(MASTER_FILE_IDENTIFIER, self.__OPENPGP_FILE_IDENTIFIER),
+            )
+        self.__card = card
+        if self.__snapshot_path is not None:
+            self.__saveSnapshot()
+        return ReadOnlyFastPathCard(card=card, application=openpgp)
+
+    def __saveSnapshot(self):
+        tid = self.__db.storage.lastTransaction()
+        if tid == self.__snapshot_tid:
+            return
+        logger.info('%r: saving warm-start snapshot...', self)
+        try:
+            CardSnapshot.fromCard(self.__card, tid=tid).save(
+                self.__snapshot_path,
+            )
+        except Exception:
+            logger.exception('%r: failed to save warm-start snapshot', self)
+        else:
+            self.__snapshot_tid = tid
+
+    def getATR(self):
+        self.powered = True
+        self.last_access = time.monotonic()
+        return self.__getSlotCard().getATR()
+
+    def runAPDU(self, command):
+        self.last_access = time.monotonic()
+        return self.__getSlotCard().runAPDU(command)
+
+    def clearVolatile(self):
+        self.powered = False
+        self.last_access = time.monotonic()
+        if self.__slot_card is not None:
+            self.__slot_card.clearVolatile()
+
+    def unload(self):
+        """
+        Release the card and its database. It will be loaded again when
+        next needed.
+        """
+        if self.__card is not None and self.__snapshot_path is not None:
+            self.__saveSnapshot()
+        self.__slot_card = None
+        self.__card = None
+        self.__snapshot = None
+        if self.__connection is not None:
+            self.__connection.close()
+            self.__connection = None
+        if self.__db is not None:
+            self.__db.close()
+            self.__db = None
+
+    def unloadIfIdle(self, delay):
+        """
+        Unload if the slot has been powered off for at least delay seconds.
+        Cards in a powered slot are never unloaded, as it would lose the
+        host's session (authentication status, selected file...).
+        Returns whether the card got unloaded.
+        """
+        if (
+            self.loaded and
+            not self.powered and
+            self.last_access < time.monotonic() - delay
+        ):
+            logger.info('Unloading idle %r', self)
+            self.unload()
+            return True
+        return False
@@ -0,0 +1,607 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2018-2020  Vincent Pelletier <plr.vincent@gmail.com>
+#
+# This file is part of python-smartcard-app-openpgp.
+# python-smartcard-app-openpgp is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# python-smartcard-app-openpgp is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with python-smartcard-app-openpgp.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+In-process harness: a card on in-memory storage, fed raw APDUs, and scripted
+scenarios mirroring what GnuPG's scdaemon sends for common operations.
+
+Each scenario also checks the card's answers (status words, signatures,
+decrypted values), so it can be used both as a benchmark and as a conformance
+test.
+"""
+
+from collections import (
+    defaultdict,
+    deque,
+)
+import functools
+import os
+import random
+import time
+from cryptography.hazmat.primitives.asymmetric import (
+    rsa,
+    x25519,
+)
+from cryptography.hazmat.primitives.asymmetric.padding import PKCS1v15
+from cryptography.hazmat.primitives.asymmetric.utils import Prehashed
+from cryptography.hazmat.primitives.hashes import (
+    Hash,
+    SHA256,
+)
+from cryptography.hazmat.primitives import serialization
+import ZODB.DB
+from smartcard import (
+    Card,
+    MASTER_FILE_IDENTIFIER,
+)
+from smartcard.utils import transaction_manager
+from . import (
+    DEFAULT_PW1,
+    DEFAULT_PW3,
+    KeygenService,
+    OpenPGP,
+    OpenPGPRandomPassword,
+    PINQueueConnection,
+    VolatileSurvivorConnection,
+)
+
+OPENPGP_FILE_IDENTIFIER = b'\x12\x34'
+SELECT_OPENPGP = bytes.fromhex('00a4040006d27600012401')
+STATUS_SUCCESS = b'\x90\x00'
+# DER-encoded DigestInfo header for a SHA-256 digest, as sent by GnuPG.
+SHA256_DIGEST_INFO_PREFIX = bytes.fromhex('3031300d060960864801650304020105000420')
+RANDOM_PASSWORD_ROW_NAME_SET = ('A', 'B', 'C')
+RANDOM_PASSWORD_COLUMN_NAME_SET = ('1', '2', '3')
+
+class IdleKeygenService(KeygenService):
+    """
+    Never generates any key, so key generation does not compete with the
+    measured commands.
+    """
+    def request(self, key_list, algorithm_attributes_list, demand=None):
+        pass
+
+idle_keygen_service = IdleKeygenService()
+
+class LoopbackOpenPGP(OpenPGP):
+    """
+    OpenPGP application without background key generation.
+    """
+    _keygen_service = idle_keygen_service
+
+class LoopbackOpenPGPRandomPassword(OpenPGPRandomPassword):
+    """
+    OpenPGPRandomPassword application without background key generation.
+    """
+    _keygen_service = idle_keygen_service
+
+def encodeLength(length):
+    """
+    Returns BER encoding of length.
+    """
+    if length < 0x80:
+        return length.to_bytes(1, 'big')
+    encoded_length = length.to_bytes((length.bit_length() + 7) // 8, 'big')
+    return (0x80 | len(encoded_length)).to_bytes(1, 'big') + encoded_length
+
+def encodeTLV(tag, value):
+    """
+    tag (bytes)
+        Already-encoded tag.
+    Returns BER-TLV encoding of value.
+    """
+    return tag + encodeLength(len(value)) + value
+
+def encodeAPDU(klass, instruction, p1, p2, data=b'', le=None):
+    """
+    Build a command APDU, using extended length when needed.
+    le (int, or None)
+        Expected response length, 0 meaning the maximum. None when no
+        response data is expected.
+    """
+    head = bytes((klass, instruction, p1, p2))
+    extended = len(data) > 0xff or (le is not None and le > 0x100)
+    if data:
+        if extended:
+            head += b'\x00' + len(data).to_bytes(2, 'big')
+        else:
+            head += len(data).to_bytes(1, 'big')
+    if le is None:
+        trailer = b''
+    elif extended:
+        trailer = (le & 0xffff).to_bytes(2, 'big')
+        if not data:
+            trailer = b'\x00' + trailer
+    else:
+        trailer = (le & 0xff).to_bytes(1, 'big')
+    return head + data + trailer
+
+class LoopbackCard:
+    """
+    A card holding an OpenPGP application, to which raw APDUs are fed
+    directly.
+    """
+    def __init__(
+        self,
+        openpgp_class=LoopbackOpenPGP,
+        storage=None,
+        wrapCard=None,
+    ):
+        """
+        openpgp_class (OpenPGP subclass)
+        storage (ZODB storage, or None)
+            Where the card is stored. None for in-memory storage.
+        wrapCard (callable, or None)
+            Receives the card, returns what to feed APDUs to instead (ex: a
+            MemoryAccountingCard).
+        """
+        if issubclass(openpgp_class, OpenPGPRandomPassword):
+            self.__pin_queue = pin_queue = deque([], 2)
+            class DB(ZODB.DB):
+                klass = functools.partial(
+                    PINQueueConnection,
+                    openpgp_kw={
+                        'pin_queue': pin_queue,
+                        'row_name_set': RANDOM_PASSWORD_ROW_NAME_SET,
+                        'column_name_set': RANDOM_PASSWORD_COLUMN_NAME_SET,
+                    },
+                )
+        else:
+            self.__pin_queue = None
+            class DB(ZODB.DB):
+                klass = VolatileSurvivorConnection
+        self.__db = db = DB(storage=storage, pool_size=1)
+        self.__connection = connection = db.open(
+            transaction_manager=transaction_manager,
+        )
+        with transaction_manager:
+            self.card = card = connection.root.card = Card(
+                name='py-openpgp'.encode('ascii'),
+            )
+            openpgp = openpgp_class(identifier=OPENPGP_FILE_IDENTIFIER)
+            openpgp.activateSelf()
+            card.createFile(
+                card.traverse((MASTER_FILE_IDENTIFIER, )),
+                openpgp,
+            )
+        self.openpgp = openpgp = card.traverse(
+            (MASTER_FILE_IDENTIFIER, OPENPGP_FILE_IDENTIFIER),
+        )
+        self.__slot_card = card if wrapCard is None else wrapCard(card)
+        if self.__pin_queue is not None:
+            # PINQueueConnection only handles instances loaded from the
+            # database, not this new one.
+            openpgp.setPinQueue(
+                pin_queue=self.__pin_queue,
+                row_name_set=RANDOM_PASSWORD_ROW_NAME_SET,
+                column_name_set=RANDOM_PASSWORD_COLUMN_NAME_SET,
+            )
+
+    def getDatabase(self):
+        return self.__db
+
+    def getPW1(self):
+        """
+        Return the PIN the card will accept for PW1. For random-password
+        cards, display a new grid, with the valid PIN in the default cell.
+        """
+        pin_queue = self.__pin_queue
+        if pin_queue is None:
+            return DEFAULT_PW1
+        pin_dict = {
+            row + column: '%06i' % random.randrange(1000000)
+            for row in RANDOM_PASSWORD_ROW_NAME_SET
+            for column in RANDOM_PASSWORD_COLUMN_NAME_SET
+        }
+        pin_queue.append(pin_dict)
+        return pin_dict['A1'].encode('utf-8')
+
+    def powerOn(self):
+        """
+        Reset the card, and return its answer-to-reset.
+        """
+        self.__slot_card.clearVolatile()
+        return self.__slot_card.getATR()
+
+    def transmit(self, command):
+        """
+        Run command on the card, fetching the whole response if it is
+        chained.
+        """
+        card = self.__slot_card
+        response = bytes(card.runAPDU(bytearray(command)))
+        while response[-2] == 0x61:
+            response = response[:-2] + bytes(card.runAPDU(
+                bytearray((0x00, 0xc0, 0x00, 0x00, response[-1] or 0xff)),
+            ))
+        return response
+
+    def close(self):
+        self.__connection.close()
+        self.__db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class KeySet:
+    """
+    Host-side copy of the keys imported into the card by the keytocard
+    scenario: RSA 2048 signature and authentication keys, X25519 decryption
+    key (the card's default algorithm attributes).
+    """
+    def __init__(self):
+        self.signature = rsa.generate_private_key(
+            public_exponent=0x10001,
+            key_size=2048,
+        )
+        self.decryption = x25519.X25519PrivateKey.generate()
+        self.authentication = rsa.generate_private_key(
+            public_exponent=0x10001,
+            key_size=2048,
+        )
+
+def _getRSAExtendedHeaderList(control_reference, private_key):
+    private_numbers = private_key.private_numbers()
+    component_list = (
+        (b'\x91', private_numbers.public_numbers.e.to_bytes(4, 'big')),
+        (b'\x92', private_numbers.p.to_bytes(128, 'big')),
+        (b'\x93', private_numbers.q.to_bytes(128, 'big')),
+    )
+    return _getExtendedHeaderList(control_reference, component_list)
+
+def _getExtendedHeaderList(control_reference, component_list):
+    return encodeTLV(
+        b'\x4d',
+        encodeTLV(control_reference, b'') +
+        encodeTLV(
+            b'\x7f\x48',
+            b''.join(
+                tag + encodeLength(len(value))
+                for tag, value in component_list
+            ),
+        ) +
+        encodeTLV(
+            b'\x5f\x48',
+            b''.join(value for _, value in component_list),
+        ),
+    )
+
+def _getFingerprint(key):
+    # Not an OpenPGP v4 fingerprint (which depends on the key creation
+    # time), but it does not matter to the card.
+    digest = Hash(SHA256())
+    digest.update(key.public_key().public_bytes(
+        encoding=serialization.Encoding.DER,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo,
+    ))
+    return digest.finalize()[:20]
+
+class Session:
+    """
+    Runs scenarios on a loopback card, collecting per-command and
+    per-scenario durations (in seconds), and conformance failures.
+    """
+    def __init__(self, loopback_card, key_set):
+        self.loopback_card = loopback_card
+        self.key_set = key_set
+        self.command_duration_dict = defaultdict(list)
+        self.scenario_duration_dict = defaultdict(list)
+        self.failure_list = []
+        self.__scenario_name = None
+
+    def transmit(self, caption, command, expected_status=(STATUS_SUCCESS, )):
+        """
+        Send command to the card, and return response data.
+        expected_status (tuple of bytes)
+            Status words which are not a conformance failure.
+        """
+        start = time.perf_counter()
+        response = self.loopback_card.transmit(command)
+        self.command_duration_dict[caption].append(
+            time.perf_counter() - start,
+        )
+        status = response[-2:]
+        if status not in expected_status:
+            self.fail('%s: unexpected status %s' % (caption, status.hex()))
+        return response[:-2]
+
+    def check(self, condition, message):
+        if not condition:
+            self.fail(message)
+
+    def fail(self, message):
+        self.failure_list.append('%s: %s' % (self.__scenario_name, message))
+
+    def run(self, scenario_name):
+        """
+        Power the card on, and run one scenario from SCENARIO_DICT.
+        """
+        self.__scenario_name = scenario_name
+        self.loopback_card.powerOn()
+        start = time.perf_counter()
+        SCENARIO_DICT[scenario_name](self)
+        self.scenario_duration_dict[scenario_name].append(
+            time.perf_counter() - start,
+        )
+
+    def select(self):
+        self.transmit('SELECT', SELECT_OPENPGP)
+
+    def verify(self, level):
+        if level == 0x83:
+            pin = DEFAULT_PW3
+            caption = 'VERIFY PW3'
+        else:
+            pin = self.loopback_card.getPW1()
+            caption = 'VERIFY PW1'
+        self.transmit(caption, encodeAPDU(0x00, 0x20, 0x00, level, pin))
+
+    def readPublicKey(self, control_reference):
+        return self.transmit(
+            'READ PUBLIC KEY',
+            encodeAPDU(0x00, 0x47, 0x81, 0x00, control_reference, le=0),
+        )
+
+def scenarioStartup(session):
+    """
+    scdaemon probing a newly-inserted card, then "gpg --card-status".
+    """
+    session.select()
+    for caption, tag in (
+        ('GET DATA AID', b'\x00\x4f'),
+        ('GET DATA historical bytes', b'\x5f\x52'),
+        ('GET DATA application related data', b'\x00\x6e'),
+        ('GET DATA cardholder data', b'\x00\x65'),
+        ('GET DATA URL', b'\x5f\x50'),
+        ('GET DATA login data', b'\x00\x5e'),
+        ('GET DATA security support template', b'\x00\x7a'),
+        ('GET DATA password status bytes', b'\x00\xc4'),
+    ):
+        session.transmit(
+            caption,
+            encodeAPDU(0x00, 0xca, tag[0], tag[1], le=0),
+        )
+    for control_reference in (b'\xb6\x00', b'\xb8\x00', b'\xa4\x00'):
+        session.readPublicKey(control_reference)
+
+def scenarioKeyToCard(session):
+    """
+    "gpg --edit-key" "keytocard", for all 3 keys, fingerprints and
+    timestamps included.
+    """
+    key_set = session.key_set
+    session.select()
+    session.verify(0x83)
+    now = int(time.time()).to_bytes(4, 'big')
+    for (
+        caption,
+        control_reference,
+        extended_header_list,
+        key,
+        fingerprint_tag,
+        timestamp_tag,
+    ) in (
+        (
+            'PUT DATA signature key',
+            b'\xb6',
+            _getRSAExtendedHeaderList(b'\xb6', key_set.signature),
+            key_set.signature,
+            0xc7,
+            0xce,
+        ),
+        (
+            'PUT DATA decryption key',
+            b'\xb8',
+            _getExtendedHeaderList(b'\xb8', (
+                (
+                    b'\x92',
+                    key_set.decryption.private_bytes(
+                        encoding=serialization.Encoding.Raw,
+                        format=serialization.PrivateFormat.Raw,
+                        encryption_algorithm=serialization.NoEncryption(),
+                    ),
+                ),
+            )),
+            key_set.decryption,
+            0xc8,
+            0xcf,
+        ),
+        (
+            'PUT DATA authentication key',
+            b'\xa4',
+            _getRSAExtendedHeaderList(b'\xa4', key_set.authentication),
+            key_set.authentication,
+            0xc9,
+            0xd0,
+        ),
+    ):
+        session.transmit(
+            caption,
+            encodeAPDU(0x00, 0xdb, 0x3f, 0xff, extended_header_list),
+        )
+        session.transmit(
+            'PUT DATA fingerprint',
+            encodeAPDU(0x00, 0xda, 0x00, fingerprint_tag, _getFingerprint(key)),
+        )
+        session.transmit(
+            'PUT DATA timestamp',
+            encodeAPDU(0x00, 0xda, 0x00, timestamp_tag, now),
+        )
+        public_key = session.readPublicKey(control_reference + b'\x00')
+        if isinstance(key, rsa.RSAPrivateKey):
+            expected = key.public_key().public_numbers().n.to_bytes(256, 'big')
+        else:
+            expected = key.public_key().public_bytes(
+                encoding=serialization.Encoding.Raw,
+                format=serialization.PublicFormat.Raw,
+            )
+        session.check(
+            expected in public_key,
+            '%s: public key does not match imported key' % (caption, ),
+        )
+
+def getDigestInfo(message):
+    """
+    Returns the SHA-256 digest of message, and the DigestInfo GnuPG sends
+    the card to sign it.
+    """
+    digest = Hash(SHA256())
+    digest.update(message)
+    digest = digest.finalize()
+    return digest, SHA256_DIGEST_INFO_PREFIX + digest
+
+def encodeECDHCipher(public_key):
+    """
+    Returns the PSO:DECIPHER command data GnuPG sends for an ECDH session key
+    encrypted to given ephemeral public key (bytes).
+    """
+    return encodeTLV(
+        b'\xa6',
+        encodeTLV(
+            b'\x7f\x49',
+            encodeTLV(b'\x86', public_key),
+        ),
+    )
+
+def scenarioSign(session):
+    """
+    "gpg --sign": one signature, PIN entered for it.
+    """
+    session.select()
+    session.transmit(
+        'GET DATA application related data',
+        encodeAPDU(0x00, 0xca, 0x00, 0x6e, le=0),
+    )
+    session.verify(0x81)
+    digest, digest_info = getDigestInfo(os.urandom(32))
+    signature = session.transmit(
+        'PSO:COMPUTE DIGITAL SIGNATURE',
+        encodeAPDU(0x00, 0x2a, 0x9e, 0x9a, digest_info, le=0),
+    )
+    try:
+        session.key_set.signature.public_key().verify(
+            signature=signature,
+            data=digest,
+            padding=PKCS1v15(),
+            algorithm=Prehashed(SHA256()),
+        )
+    except Exception: # pylint: disable=broad-except
+        session.fail('invalid signature')
+
+def scenarioDecrypt(session):
+    """
+    "gpg --decrypt": one session key decryption (ECDH), PIN entered for it.
+    """
+    session.select()
+    session.transmit(
+        'GET DATA application related data',
+        encodeAPDU(0x00, 0xca, 0x00, 0x6e, le=0),
+    )
+    session.verify(0x82)
+    ephemeral_key = x25519.X25519PrivateKey.generate()
+    shared_secret = session.transmit(
+        'PSO:DECIPHER',
+        encodeAPDU(
+            0x00, 0x2a, 0x80, 0x86,
+            encodeECDHCipher(ephemeral_key.public_key().public_bytes(
+                encoding=serialization.Encoding.Raw,
+                format=serialization.PublicFormat.Raw,
+            )),
+            le=0,
+        ),
+    )
+    session.check(
+        shared_secret == ephemeral_key.exchange(
+            session.key_set.decryption.public_key(),
+        ),
+        'wrong shared secret',
+    )
+
+def scenarioAuthenticate(session):
+    """
+    ssh authentication through gpg-agent: INTERNAL AUTHENTICATE.
+    """
+    session.select()
+    session.transmit(
+        'GET DATA application related data',
+        encodeAPDU(0x00, 0xca, 0x00, 0x6e, le=0),
+    )
+    session.verify(0x82)
+    digest, digest_info = getDigestInfo(os.urandom(32))
+    signature = session.transmit(
+        'INTERNAL AUTHENTICATE',
+        encodeAPDU(0x00, 0x88, 0x00, 0x00, digest_info, le=0),
+    )
+    try:
+        session.key_set.authentication.public_key().verify(
+            signature=signature,
+            data=digest,
+            padding=PKCS1v15(),
+            algorithm=Prehashed(SHA256()),
+        )
+    except Exception: # pylint: disable=broad-except
+        session.fail('invalid authentication signature')
+
+SCENARIO_DICT = {
+    'startup': scenarioStartup,
+    'keytocard': scenarioKeyToCard,
+    'sign': scenarioSign,
+    'decrypt': scenarioDecrypt,
+    'authenticate': scenarioAuthenticate,
+}
+
+def getPercentile(sample_list, percentile):
+    """
+    Nearest-rank percentile of sample_list, which must be sorted.
+    """
+    return sample_list[max(
+        0,
+        -(-len(sample_list) * percentile // 100) - 1,
+    )]
+
+def runScenarios(
+    scenario_name_list=tuple(SCENARIO_DICT),
+    iterations=10,
+    openpgp_class=LoopbackOpenPGP,
+    loopback_card=None,
+):
+    """
+    Run each scenario iterations times, on a single card which keys got
+    imported into beforehand.
+    loopback_card (LoopbackCard, or None)
+        Card to use (left open), instead of a new one of openpgp_class.
+    Returns the Session, holding durations and failures.
+    """
+    if loopback_card is None:
+        with LoopbackCard(openpgp_class=openpgp_class) as loopback_card:
+            return runScenarios(
+                scenario_name_list=scenario_name_list,
+                iterations=iterations,
+                loopback_card=loopback_card,
+            )
+    key_set = KeySet()
+    setup_session = Session(loopback_card, key_set)
+    setup_session.run('keytocard')
+    session = Session(loopback_card, key_set)
+    session.failure_list.extend(setup_session.failure_list)
+    for scenario_name in scenario_name_list:
+        for _ in range(iterations):
+            session.run(scenario_name)
+    return session
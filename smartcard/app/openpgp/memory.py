@@ -0,0 +1,585 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2018-2020  Vincent Pelletier <plr.vincent@gmail.com>
+#
+# This file is part of python-smartcard-app-openpgp.
+# python-smartcard-app-openpgp is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# python-smartcard-app-openpgp is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with python-smartcard-app-openpgp.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Memory accounting and memory pressure handling.
+
+Accounting uses tracemalloc: the memory each APDU retains and peaks at is
+measured per instruction, occasionally with snapshots telling which
+subsystem retained it, and the traced footprint of each subsystem is
+periodically measured. Only allocations made through the Python allocator
+are traced: memory allocated by C libraries (ex: OpenSSL key material,
+freetype faces) is only visible in the resident size.
+
+Under memory pressure (resident size above a limit, or system available
+memory below a threshold), ZODB connection caches and the number of keys
+generated in advance get capped until pressure goes away.
+"""
+
+import functools
+import gc
+import logging
+import os
+import threading
+import tracemalloc
+import weakref
+from smartcard import APDU_HEAD_LENGTH
+from smartcard.app.openpgp import keygen_service
+from smartcard.app.openpgp.metrics import (
+    SIZE_BUCKET_TUPLE,
+    registry as metrics_registry,
+)
+
+logger = logging.getLogger(__name__)
+
+# Subsystems, and the path fragments identifying their code. An allocation
+# belongs to the subsystem of the most recent frame matching any of these,
+# checked in this order.
+SUBSYSTEM_LIST = (
+    ('display', ('/smartcard/app/openpgp/cli/randpin/', '/freetype/')),
+    ('keys', ('/cryptography/', )),
+    # Connection caches and unpickled card state.
+    ('zodb', ('/ZODB/', '/persistent/', '/BTrees/', '/transaction/')),
+    ('card', ('/smartcard/', )),
+)
+SUBSYSTEM_OTHER = 'other'
+_IGNORED_FILENAME_SET = frozenset((tracemalloc.__file__, __file__))
+# Leave pressure mode once below this fraction of the limits.
+PRESSURE_HYSTERESIS = .9
+# A loaded card uses a few tens of persistent objects, so this cap evicts
+# most of them while keeping the card and its application loaded. Lower caps
+# also evict the application, whose keys then get decoded on every command.
+DEFAULT_CACHE_SIZE = 10
+
+_SIZE_SUFFIX_DICT = {
+    'k': 1 << 10,
+    'm': 1 << 20,
+    'g': 1 << 30,
+}
+
+def parseSize(value):
+    """
+    Parse a byte count, optionally suffixed with k, M or G (powers of 1024).
+    """
+    multiplier = _SIZE_SUFFIX_DICT.get(value[-1:].lower())
+    if multiplier is None:
+        return int(value)
+    return int(float(value[:-1]) * multiplier)
+
+def getResidentSize():
+    """
+    Return the resident set size of the current process, in bytes.
+    """
+    with open('/proc/self/statm', 'r', encoding='ascii') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+def getAvailableMemory():
+    """
+    Return the memory available to start new applications without swapping,
+    in bytes, or None if the kernel does not tell.
+    """
+    with open('/proc/meminfo', 'r', encoding='ascii') as meminfo:
+        for line in meminfo:
+            if line.startswith('MemAvailable:'):
+                return int(line.split()[1]) * 1024
+    return None
+
+@functools.lru_cache(maxsize=4096)
+def getSubsystem(traceback):
+    """
+    Return the name of the subsystem given tracemalloc traceback belongs to,
+    or None for allocations made by memory accounting itself.
+    """
+    if traceback[-1].filename in _IGNORED_FILENAME_SET:
+        return None
+    # Most recent frame first.
+    for frame in reversed(traceback):
+        filename = frame.filename
+        for subsystem, fragment_tuple in SUBSYSTEM_LIST:
+            if any(fragment in filename for fragment in fragment_tuple):
+                return subsystem
+    return SUBSYSTEM_OTHER
+
+def getFootprint(snapshot=None):
+    """
+    Return a dict of subsystem name: traced bytes.
+    """
+    if snapshot is None:
+        snapshot = tracemalloc.take_snapshot()
+    result = dict.fromkeys(
+        [x for x, _ in SUBSYSTEM_LIST] + [SUBSYSTEM_OTHER],
+        0,
+    )
+    for statistic in snapshot.statistics('traceback'):
+        subsystem = getSubsystem(statistic.traceback)
+        if subsystem is not None:
+            result[subsystem] += statistic.size
+    return result
+
+class _InstructionAccount:
+    __slots__ = (
+        'count',
+        'retained',
+        'peak',
+        'retained_histogram',
+        'peak_histogram',
+        'subsystem_dict',
+    )
+
+    def __init__(self, registry, instruction):
+        caption = (
+            'none' if instruction is None else
+            '%02x' % (instruction, )
+        )
+        self.count = 0
+        self.retained = 0
+        self.peak = 0
+        self.retained_histogram = registry.histogram(
+            'smartcard_openpgp_apdu_memory_retained_bytes',
+            'Traced memory still allocated after APDUs, by instruction',
+            bucket_tuple=SIZE_BUCKET_TUPLE,
+            instruction=caption,
+        )
+        self.peak_histogram = registry.histogram(
+            'smartcard_openpgp_apdu_memory_peak_bytes',
+            'Traced memory peak during APDUs, above the memory allocated '
+            'before them, by instruction',
+            bucket_tuple=SIZE_BUCKET_TUPLE,
+            instruction=caption,
+        )
+        # Subsystem name -> retained bytes, from the last snapshot pair.
+        self.subsystem_dict = {}
+
+class MemoryMonitor:
+    """
+    Accounts memory (if enabled) and applies caps under memory pressure,
+    from a background thread checking every interval seconds.
+    """
+    __resident_size = None
+    __available = None
+    __pressure = False
+
+    def __init__(
+        self,
+        accounting=False,
+        report_path=None,
+        snapshot_interval=100,
+        frame_count=8,
+        resident_limit=None,
+        available_min=None,
+        cache_size=DEFAULT_CACHE_SIZE,
+        keygen_pool_depth=0,
+        interval=10,
+        registry=metrics_registry,
+        keygen_service=keygen_service, # pylint: disable=redefined-outer-name
+    ):
+        """
+        accounting (bool)
+            Whether to trace memory allocations. Slows everything down.
+        report_path (str, or None)
+            File to periodically write an accounting report into.
+        snapshot_interval (int)
+            Every how many APDUs of a given instruction to take snapshots
+            around one, to tell which subsystem retains memory.
+        frame_count (int)
+            Number of frames tracemalloc keeps per allocation. More frames
+            classify allocations better, at a higher cost.
+        resident_limit (int, or None)
+            Resident size, in bytes, above which there is memory pressure.
+        available_min (int, or None)
+            System available memory, in bytes, below which there is memory
+            pressure.
+        cache_size (int)
+            ZODB connection cache size, in objects, under memory pressure.
+            Databases must use VolatileSurvivorConnection for cards to keep
+            the host's session when evicted.
+        keygen_pool_depth (int)
+            Number of keys generated in advance per card and key list, under
+            memory pressure.
+        interval (float)
+            Seconds between checks.
+        """
+        self._accounting = accounting
+        self._report_path = report_path
+        self._snapshot_interval = snapshot_interval
+        self._frame_count = frame_count
+        self._resident_limit = resident_limit
+        self._available_min = available_min
+        self._cache_size = cache_size
+        self._keygen_pool_depth = keygen_pool_depth
+        self._interval = interval
+        self._registry = registry
+        self._keygen_service = keygen_service
+        self.__database_getter_list = []
+        # ZODB.DB -> cache size before pressure
+        self.__cache_size_dict = weakref.WeakKeyDictionary()
+        # Instruction byte -> _InstructionAccount
+        self.__instruction_dict = {}
+        self.__footprint_dict = {}
+        self.__stop_event = threading.Event()
+        self.__thread = None
+        self.__resident_gauge = registry.gauge(
+            'smartcard_openpgp_memory_resident_bytes',
+            'Resident set size of the process',
+        )
+        self.__pressure_gauge = registry.gauge(
+            'smartcard_openpgp_memory_pressure',
+            'Whether memory caps are being applied',
+        )
+        self.__cache_gauge = registry.gauge(
+            'smartcard_openpgp_zodb_cache_objects',
+            'Non-ghost objects in ZODB connection caches',
+        )
+        self.__keygen_gauge = registry.gauge(
+            'smartcard_openpgp_keygen_pool_keys',
+            'Keys generated in advance',
+        )
+
+    @property
+    def pressure(self):
+        return self.__pressure
+
+    def addDatabaseGetter(self, getDatabase):
+        """
+        getDatabase (callable)
+            Returns a ZODB.DB whose cache is to be capped, or None when
+            there is currently none.
+        """
+        self.__database_getter_list.append(getDatabase)
+
+    def __iterDatabase(self):
+        for getDatabase in self.__database_getter_list:
+            db = getDatabase()
+            if db is not None:
+                yield db
+
+    def start(self):
+        if self._accounting and not tracemalloc.is_tracing():
+            tracemalloc.start(self._frame_count)
+        self.__stop_event.clear()
+        self.__thread = thread = threading.Thread(
+            target=self.__run,
+            name='memory',
+            daemon=True,
+        )
+        thread.start()
+
+    def __run(self):
+        stop_event = self.__stop_event
+        while True:
+            try:
+                self.check()
+                if self._accounting:
+                    self.updateFootprint()
+                    if self._report_path is not None:
+                        self.writeReport()
+            except Exception: # pylint: disable=broad-except
+                logger.exception('Memory check failed')
+            if stop_event.wait(self._interval):
+                break
+
+    def runAPDU(self, card, command):
+        """
+        Run command on card, accounting its memory usage if enabled.
+        """
+        if not self._accounting:
+            return card.runAPDU(command)
+        instruction = command[1] if len(command) >= APDU_HEAD_LENGTH else None
+        try:
+            account = self.__instruction_dict[instruction]
+        except KeyError:
+            account = self.__instruction_dict[instruction] = (
+                _InstructionAccount(self._registry, instruction)
+            )
+        before_snapshot = None
+        if not account.count % self._snapshot_interval:
+            # Do not count the release of earlier garbage.
+            gc.collect()
+            before_snapshot = tracemalloc.take_snapshot()
+        account.count += 1
+        before_size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        try:
+            return card.runAPDU(command)
+        finally:
+            after_size, peak = tracemalloc.get_traced_memory()
+            retained = after_size - before_size
+            peak -= before_size
+            account.retained += retained
+            account.peak = max(account.peak, peak)
+            account.retained_histogram.observe(retained)
+            account.peak_histogram.observe(peak)
+            if before_snapshot is not None:
+                subsystem_dict = dict.fromkeys(
+                    [x for x, _ in SUBSYSTEM_LIST] + [SUBSYSTEM_OTHER],
+                    0,
+                )
+                for statistic_diff in tracemalloc.take_snapshot().compare_to(
+                    before_snapshot,
+                    'traceback',
+                ):
+                    subsystem = getSubsystem(statistic_diff.traceback)
+                    if subsystem is not None:
+                        subsystem_dict[subsystem] += statistic_diff.size_diff
+                account.subsystem_dict = subsystem_dict
+
+    def updateFootprint(self):
+        """
+        Measure the traced footprint of each subsystem.
+        """
+        self.__footprint_dict = footprint_dict = getFootprint()
+        registry = self._registry
+        for subsystem, size in footprint_dict.items():
+            registry.gauge(
+                'smartcard_openpgp_memory_traced_bytes',
+                'Memory allocated through the Python allocator, by subsystem',
+                subsystem=subsystem,
+            ).set(size)
+
+    def check(self):
+        """
+        Measure memory usage, and enter or leave memory pressure mode.
+        """
+        self.__resident_size = resident_size = getResidentSize()
+        self.__available = available = getAvailableMemory()
+        self.__resident_gauge.set(resident_size)
+        resident_limit = self._resident_limit
+        available_min = self._available_min
+        if self.__pressure:
+            pressure = (
+                resident_limit is not None and
+                resident_size > resident_limit * PRESSURE_HYSTERESIS
+            ) or (
+                available_min is not None and available is not None and
+                available < available_min / PRESSURE_HYSTERESIS
+            )
+        else:
+            pressure = (
+                resident_limit is not None and
+                resident_size > resident_limit
+            ) or (
+                available_min is not None and available is not None and
+                available < available_min
+            )
+        if pressure != self.__pressure:
+            self.__pressure = pressure
+            self.__pressure_gauge.set(int(pressure))
+            if pressure:
+                logger.warning(
+                    'Memory pressure (resident: %i, available: %s), capping '
+                    'ZODB caches to %i objects and keys generated in advance '
+                    'to %i',
+                    resident_size,
+                    available,
+                    self._cache_size,
+                    self._keygen_pool_depth,
+                )
+                self._keygen_service.setPoolDepth(self._keygen_pool_depth)
+            else:
+                logger.info(
+                    'Memory pressure gone (resident: %i, available: %s), '
+                    'lifting caps',
+                    resident_size,
+                    available,
+                )
+                self._keygen_service.setPoolDepth(None)
+                cache_size_dict = self.__cache_size_dict
+                for db in self.__iterDatabase():
+                    if db in cache_size_dict:
+                        # Caches shrink at the next transaction boundary of
+                        # the thread using their connection.
+                        db.setCacheSize(cache_size_dict.pop(db))
+        if pressure:
+            # Also cap databases opened since pressure started.
+            cache_size_dict = self.__cache_size_dict
+            for db in self.__iterDatabase():
+                if db not in cache_size_dict:
+                    cache_size = db.getCacheSize()
+                    cache_size_dict[db] = cache_size
+                    db.setCacheSize(min(cache_size, self._cache_size))
+        self.__cache_gauge.set(sum(
+            db.cacheSize()
+            for db in self.__iterDatabase()
+        ))
+        self.__keygen_gauge.set(self._keygen_service.getHeldKeyCount())
+
+    def getReport(self):
+        """
+        Return a human-readable accounting report.
+        """
+        line_list = [
+            'resident: %s bytes, available: %s bytes, pressure: %s' % (
+                self.__resident_size,
+                self.__available,
+                'yes' if self.__pressure else 'no',
+            ),
+            'zodb cache: %i objects, keys generated in advance: %i' % (
+                sum(db.cacheSize() for db in self.__iterDatabase()),
+                self._keygen_service.getHeldKeyCount(),
+            ),
+            'traced bytes by subsystem:',
+        ]
+        for subsystem, size in sorted(
+            self.__footprint_dict.items(),
+            key=lambda x: x[1],
+            reverse=True,
+        ):
+            line_list.append('  %-8s %12i' % (subsystem, size))
+        line_list.append(
+            'per instruction: count, mean retained bytes, max peak bytes, '
+            'retained bytes by subsystem in the last sampled APDU:',
+        )
+        for instruction, account in sorted(
+            self.__instruction_dict.items(),
+            key=lambda x: -1 if x[0] is None else x[0],
+        ):
+            line_list.append('  %-4s %8i %10i %10i  %s' % (
+                'none' if instruction is None else '%02x' % (instruction, ),
+                account.count,
+                account.retained // account.count,
+                account.peak,
+                ' '.join(
+                    '%s=%i' % x
+                    for x in sorted(account.subsystem_dict.items())
+                    if x[1]
+                ),
+            ))
+        line_list.append('')
+        return '\n'.join(line_list)
+
+    def writeReport(self):
+        temporary_path = self._report_path + '.tmp'
+        with open(temporary_path, 'w', encoding='utf-8') as report_file:
+            report_file.write(self.getReport())
+        os.replace(temporary_path, self._report_path)
+
+    def close(self):
+        if self.__thread is not None:
+            self.__stop_event.set()
+            self.__thread.join()
+            self.__thread = None
+            if self._accounting:
+                if self._report_path is not None:
+                    self.updateFootprint()
+                    try:
+                        self.writeReport()
+                    except Exception: # pylint: disable=broad-except
+                        logger.exception('Failed to write memory report')
+                tracemalloc.stop()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class MemoryAccountingCard:
+    """
+    Stands for a card (as far as a reader slot is concerned), running APDUs
+    through a MemoryMonitor.
+    """
+    def __init__(self, card, monitor):
+        self._card = card
+        self._monitor = monitor
+
+    def __repr__(self):
+        return '<%s(card=%r) object at %x>' % (
+            self.__class__.__name__,
+            self._card,
+            id(self),
+        )
+
+    def getATR(self):
+        return self._card.getATR()
+
+    def clearVolatile(self):
+        self._card.clearVolatile()
+
+    def runAPDU(self, command):
+        return self._monitor.runAPDU(self._card, command)
+
+def addMemoryArgumentList(parser):
+    """
+    Add memory accounting and capping options to an argparse parser.
+    """
+    parser.add_argument(
+        '--memory-report',
+        help='Enable memory accounting (which slows everything down), '
+        'periodically writing a report of the memory retained by each '
+        'instruction and held by each subsystem in this file. Also exported '
+        'as metrics.',
+    )
+    parser.add_argument(
+        '--memory-limit',
+        type=parseSize,
+        help='Resident size (ex: 64M) above which ZODB caches and keys '
+        'generated in advance get capped.',
+    )
+    parser.add_argument(
+        '--memory-available-min',
+        type=parseSize,
+        help='System available memory (ex: 32M) below which ZODB caches and '
+        'keys generated in advance get capped.',
+    )
+    parser.add_argument(
+        '--memory-cache-size',
+        type=int,
+        default=DEFAULT_CACHE_SIZE,
+        help='ZODB cache size, in objects, under memory pressure. Below the '
+        'default, keys get decoded again on every command '
+        '(default: %(default)s).',
+    )
+    parser.add_argument(
+        '--memory-keygen-depth',
+        type=int,
+        default=0,
+        help='Number of keys generated in advance per card and key list under '
+        'memory pressure, keys being otherwise generated on request '
+        '(default: %(default)s).',
+    )
+    parser.add_argument(
+        '--memory-interval',
+        type=float,
+        default=10,
+        help='Number of seconds between memory checks '
+        '(default: %(default)s).',
+    )
+
+def getMemoryMonitor(args):
+    """
+    Return a (not started) MemoryMonitor for options added by
+    addMemoryArgumentList, or None if memory is neither accounted nor capped.
+    """
+    if (
+        args.memory_report is None and
+        args.memory_limit is None and
+        args.memory_available_min is None
+    ):
+        return None
+    return MemoryMonitor(
+        accounting=args.memory_report is not None,
+        report_path=(
+            None if args.memory_report is None else
+            os.path.abspath(args.memory_report)
+        ),
+        resident_limit=args.memory_limit,
+        available_min=args.memory_available_min,
+        cache_size=args.memory_cache_size,
+        keygen_pool_depth=args.memory_keygen_depth,
+        interval=args.memory_interval,
+    )
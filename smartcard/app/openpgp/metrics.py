@@ -0,0 +1,407 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2018-2020  Vincent Pelletier <plr.vincent@gmail.com>
+#
+# This file is part of python-smartcard-app-openpgp.
+# python-smartcard-app-openpgp is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# python-smartcard-app-openpgp is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with python-smartcard-app-openpgp.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Metrics: counters, gauges and histograms, rendered in Prometheus text exposition
+format to a textfile (for node exporter's textfile collector) and to any
+client connecting to a UNIX socket.
+
+Metrics are updated without locking: each is expected to be updated from a
+single thread (ex: the reader's event loop, the keygen thread), and
+rendering tolerates seeing an update half-way.
+"""
+
+from bisect import bisect_left
+import logging
+import os
+import select
+import socket
+import threading
+import time
+from smartcard import APDU_HEAD_LENGTH
+
+logger = logging.getLogger(__name__)
+
+# Seconds
+LATENCY_BUCKET_TUPLE = (
+    .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10,
+)
+# Bytes
+SIZE_BUCKET_TUPLE = (64, 256, 1024, 4096, 16384, 65536, 262144)
+
+class Counter:
+    __slots__ = ('value', )
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def iterSamples(self, name, label_string):
+        yield name, label_string, self.value
+
+class Gauge:
+    __slots__ = ('value', )
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def iterSamples(self, name, label_string):
+        yield name, label_string, self.value
+
+class Histogram:
+    __slots__ = ('_bucket_tuple', '_count_list', 'sum', 'count')
+
+    def __init__(self, bucket_tuple=LATENCY_BUCKET_TUPLE):
+        self._bucket_tuple = bucket_tuple
+        # Last entry counts values above the largest bucket.
+        self._count_list = [0] * (len(bucket_tuple) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self._count_list[bisect_left(self._bucket_tuple, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def iterSamples(self, name, label_string):
+        if label_string:
+            bucket_label_format = label_string[:-1] + ',le="%s"}'
+        else:
+            bucket_label_format = '{le="%s"}'
+        total = 0
+        for bound, count in zip(
+            self._bucket_tuple + ('+Inf', ),
+            self._count_list,
+        ):
+            total += count
+            yield name + '_bucket', bucket_label_format % (bound, ), total
+        yield name + '_sum', label_string, self.sum
+        yield name + '_count', label_string, self.count
+
+class MetricsRegistry:
+    """
+    Holds metrics, by name and labels.
+    """
+    def __init__(self):
+        self.__lock = threading.Lock()
+        # name -> (type, help, {label_string: metric})
+        self.__family_dict = {}
+
+    def __get(self, metric_type, factory, name, help_text, label_dict):
+        label_string = (
+            '{%s}' % (','.join(
+                '%s="%s"' % (key, value)
+                for key, value in sorted(label_dict.items())
+            ), )
+            if label_dict else
+            ''
+        )
+        try:
+            family_type, _, metric_dict = self.__family_dict[name]
+        except KeyError:
+            with self.__lock:
+                family_type, _, metric_dict = self.__family_dict.setdefault(
+                    name,
+                    (metric_type, help_text, {}),
+                )
+        if family_type != metric_type:
+            raise TypeError('%s is a %s' % (name, family_type))
+        try:
+            return metric_dict[label_string]
+        except KeyError:
+            with self.__lock:
+                return metric_dict.setdefault(label_string, factory())
+
+    def counter(self, name, help_text, **label_dict):
+        """
+        Return the counter with given name and labels, creating it if needed.
+        """
+        return self.__get('counter', Counter, name, help_text, label_dict)
+
+    def gauge(self, name, help_text, **label_dict):
+        """
+        Return the gauge with given name and labels, creating it if needed.
+        """
+        return self.__get('gauge', Gauge, name, help_text, label_dict)
+
+    def histogram(
+        self,
+        name,
+        help_text,
+        bucket_tuple=LATENCY_BUCKET_TUPLE,
+        **label_dict
+    ):
+        """
+        Return the histogram with given name and labels, creating it if
+        needed.
+        """
+        return self.__get(
+            'histogram',
+            lambda: Histogram(bucket_tuple=bucket_tuple),
+            name,
+            help_text,
+            label_dict,
+        )
+
+    def render(self):
+        """
+        Return all metrics in Prometheus text exposition format.
+        """
+        with self.__lock:
+            family_list = sorted(
+                (name, metric_type, help_text, list(metric_dict.items()))
+                for name, (
+                    metric_type,
+                    help_text,
+                    metric_dict,
+                ) in self.__family_dict.items()
+            )
+        line_list = []
+        append = line_list.append
+        for name, metric_type, help_text, metric_list in family_list:
+            append('# HELP %s %s' % (name, help_text))
+            append('# TYPE %s %s' % (name, metric_type))
+            for label_string, metric in sorted(metric_list):
+                for sample_name, sample_label_string, value in (
+                    metric.iterSamples(name, label_string)
+                ):
+                    append('%s%s %s' % (sample_name, sample_label_string, value))
+        append('')
+        return '\n'.join(line_list)
+
+registry = MetricsRegistry()
+
+class MetricsCard:
+    """
+    Stands for a card (as far as a reader slot is concerned), measuring
+    how long each APDU takes, per instruction.
+    """
+    def __init__(self, card, registry=registry, getStorageState=None): # pylint: disable=redefined-outer-name
+        """
+        getStorageState (callable, or None)
+            Returns a (last transaction id, storage size) tuple, or None if
+            the storage is not available. Used to count commits, and the
+            bytes they add to the storage.
+        """
+        self._card = card
+        self._registry = registry
+        self._getStorageState = getStorageState
+        # Instruction byte -> histogram
+        self.__duration_dict = {}
+        self.__commit_counter = registry.counter(
+            'smartcard_openpgp_zodb_commits_total',
+            'APDUs which modified the card',
+        )
+        self.__commit_size = registry.histogram(
+            'smartcard_openpgp_zodb_commit_bytes',
+            'Storage growth caused by APDUs which modified the card',
+            bucket_tuple=SIZE_BUCKET_TUPLE,
+        )
+
+    def __repr__(self):
+        return '<%s(card=%r) object at %x>' % (
+            self.__class__.__name__,
+            self._card,
+            id(self),
+        )
+
+    def getATR(self):
+        return self._card.getATR()
+
+    def clearVolatile(self):
+        self._card.clearVolatile()
+
+    def runAPDU(self, command):
+        getStorageState = self._getStorageState
+        before_state = None if getStorageState is None else getStorageState()
+        start = time.perf_counter()
+        result = self._card.runAPDU(command)
+        duration = time.perf_counter() - start
+        instruction = command[1] if len(command) >= APDU_HEAD_LENGTH else None
+        try:
+            histogram = self.__duration_dict[instruction]
+        except KeyError:
+            histogram = self.__duration_dict[instruction] = (
+                self._registry.histogram(
+                    'smartcard_openpgp_apdu_duration_seconds',
+                    'Time taken to run APDUs, by instruction',
+                    instruction=(
+                        'none' if instruction is None else
+                        '%02x' % (instruction, )
+                    ),
+                )
+            )
+        histogram.observe(duration)
+        if getStorageState is not None:
+            after_state = getStorageState()
+            if (
+                before_state is not None and
+                after_state is not None and
+                before_state[0] != after_state[0]
+            ):
+                self.__commit_counter.inc()
+                self.__commit_size.observe(after_state[1] - before_state[1])
+        return result
+
+class MetricsExporter:
+    """
+    Makes a registry's metrics available from a background thread, by
+    periodically writing them to a textfile and/or by answering connections
+    on a UNIX socket (ex: "socat - UNIX-CONNECT:<path>").
+    """
+    def __init__(
+        self,
+        registry=registry, # pylint: disable=redefined-outer-name
+        textfile_path=None,
+        socket_path=None,
+        interval=60,
+    ):
+        self._registry = registry
+        self._textfile_path = textfile_path
+        self._socket_path = socket_path
+        self._interval = interval
+        self.__thread = None
+        self.__socket = None
+        self.__stop_read, self.__stop_write = None, None
+
+    def start(self):
+        if self._socket_path is not None:
+            try:
+                os.unlink(self._socket_path)
+            except FileNotFoundError:
+                pass
+            self.__socket = server_socket = socket.socket(
+                socket.AF_UNIX,
+                socket.SOCK_STREAM,
+            )
+            server_socket.bind(self._socket_path)
+            server_socket.listen(4)
+        self.__stop_read, self.__stop_write = os.pipe()
+        self.__thread = thread = threading.Thread(
+            target=self.__run,
+            name='metrics',
+            daemon=True,
+        )
+        thread.start()
+
+    def writeTextfile(self):
+        # node exporter may read the file at any time: write to a temporary
+        # file, then rename over.
+        temporary_path = self._textfile_path + '.tmp'
+        with open(temporary_path, 'w', encoding='utf-8') as textfile:
+            textfile.write(self._registry.render())
+        os.replace(temporary_path, self._textfile_path)
+
+    def __run(self):
+        read_list = [self.__stop_read]
+        if self.__socket is not None:
+            read_list.append(self.__socket)
+        next_write = 0
+        while True:
+            if self._textfile_path is not None:
+                now = time.monotonic()
+                if next_write <= now:
+                    try:
+                        self.writeTextfile()
+                    except Exception: # pylint: disable=broad-except
+                        logger.exception('Failed to write metrics textfile')
+                    next_write = now + self._interval
+                timeout = next_write - now
+            else:
+                timeout = None
+            ready_list, _, _ = select.select(read_list, [], [], timeout)
+            if self.__stop_read in ready_list:
+                break
+            if self.__socket in ready_list:
+                client, _ = self.__socket.accept()
+                try:
+                    client.sendall(self._registry.render().encode('utf-8'))
+                except OSError:
+                    pass
+                finally:
+                    client.close()
+
+    def close(self):
+        if self.__thread is not None:
+            os.write(self.__stop_write, b'\x00')
+            self.__thread.join()
+            self.__thread = None
+            os.close(self.__stop_read)
+            os.close(self.__stop_write)
+        if self.__socket is not None:
+            self.__socket.close()
+            self.__socket = None
+            os.unlink(self._socket_path)
+        if self._textfile_path is not None:
+            try:
+                self.writeTextfile()
+            except Exception: # pylint: disable=broad-except
+                logger.exception('Failed to write metrics textfile')
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def addMetricsArgumentList(parser):
+    """
+    Add metrics exporter options to an argparse parser.
+    """
+    parser.add_argument(
+        '--metrics-textfile',
+        help='Path to a file in which to periodically write metrics, in '
+        'Prometheus text format (ex: for node exporter textfile collector). '
+        'Must end in ".prom" for node exporter.',
+    )
+    parser.add_argument(
+        '--metrics-socket',
+        help='Path to a UNIX socket on which to serve metrics, in Prometheus '
+        'text format.',
+    )
+    parser.add_argument(
+        '--metrics-interval',
+        type=float,
+        default=60,
+        help='Number of seconds between metrics textfile updates '
+        '(default: %(default)s).',
+    )
+
+def getMetricsExporter(args):
+    """
+    Return a (not started) MetricsExporter for options added by
+    addMetricsArgumentList, or None if metrics are not exported.
+    """
+    if args.metrics_textfile is None and args.metrics_socket is None:
+        return None
+    return MetricsExporter(
+        textfile_path=(
+            None if args.metrics_textfile is None else
+            os.path.abspath(args.metrics_textfile)
+        ),
+        socket_path=(
+            None if args.metrics_socket is None else
+            os.path.abspath(args.metrics_socket)
+        ),
+        interval=args.metrics_interval,
+    )
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2018-2020  Vincent Pelletier <plr.vincent@gmail.com>
+#
+# This file is part of python-smartcard-app-openpgp.
+# python-smartcard-app-openpgp is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# python-smartcard-app-openpgp is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with python-smartcard-app-openpgp.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+On-demand profiling of a running card: once armed by a signal, the next
+APDUs are run under cProfile, and statistics are written as pstats files,
+one per instruction. Profiling then stops by itself.
+"""
+
+import cProfile
+import logging
+import os
+import signal
+import threading
+import time
+from smartcard import APDU_HEAD_LENGTH
+
+logger = logging.getLogger(__name__)
+
+class APDUProfiler:
+    """
+    Arms when the process receives a signal, then profiles the next
+    apdu_count APDUs, or the APDUs received within duration seconds,
+    whichever comes first. Statistics are written when the duration elapses
+    even if no further APDU is received.
+    Must be started from the main thread, as it installs a signal handler.
+    """
+    __deadline = None
+    __remaining = 0
+
+    def __init__(
+        self,
+        directory,
+        apdu_count=100,
+        duration=None,
+        signal_number=signal.SIGUSR2,
+    ):
+        self._directory = directory
+        self._apdu_count = apdu_count
+        self._duration = duration
+        self._signal_number = signal_number
+        self.__previous_handler = None
+        # Instruction byte -> cProfile.Profile
+        self.__profile_dict = {}
+        # Reentrant, as arm() may be called from a signal handler interrupting
+        # the main thread while it holds this lock.
+        self.__lock = threading.RLock()
+        self.__timer = None
+        # Number of APDUs being profiled.
+        self.__running = 0
+
+    def start(self):
+        self.__previous_handler = signal.signal(
+            self._signal_number,
+            self.__onSignal,
+        )
+
+    def __onSignal(self, signal_number, frame):
+        _ = signal_number, frame # Silence pylint.
+        self.arm()
+
+    @property
+    def armed(self):
+        return self.__remaining > 0
+
+    def arm(self):
+        with self.__lock:
+            logger.info('Profiling the next %i APDUs', self._apdu_count)
+            self.__cancelTimer()
+            self.__remaining = self._apdu_count
+            if self._duration is None:
+                self.__deadline = None
+            else:
+                self.__deadline = time.monotonic() + self._duration
+                self.__timer = timer = threading.Timer(
+                    self._duration,
+                    self.__onDeadline,
+                )
+                timer.daemon = True
+                timer.start()
+
+    def __cancelTimer(self):
+        timer = self.__timer
+        if timer is not None:
+            self.__timer = None
+            timer.cancel()
+
+    def __isExpired(self):
+        deadline = self.__deadline
+        return deadline is not None and deadline <= time.monotonic()
+
+    def __onDeadline(self):
+        with self.__lock:
+            # If an APDU is being profiled, it flushes once done.
+            if self.__remaining and not self.__running and self.__isExpired():
+                self.flush()
+
+    def runAPDU(self, card, command):
+        """
+        Run command on card, profiling it if armed.
+        """
+        if not self.__remaining:
+            return card.runAPDU(command)
+        with self.__lock:
+            if not self.__remaining:
+                profile = None
+            elif self.__isExpired():
+                self.flush()
+                profile = None
+            else:
+                instruction = (
+                    command[1] if len(command) >= APDU_HEAD_LENGTH else None
+                )
+                try:
+                    profile = self.__profile_dict[instruction]
+                except KeyError:
+                    profile = self.__profile_dict[instruction] = (
+                        cProfile.Profile()
+                    )
+                self.__running += 1
+        if profile is None:
+            return card.runAPDU(command)
+        profile.enable()
+        try:
+            return card.runAPDU(command)
+        finally:
+            profile.disable()
+            with self.__lock:
+                self.__running -= 1
+                if self.__remaining:
+                    self.__remaining -= 1
+                    if not self.__remaining or self.__isExpired():
+                        self.flush()
+
+    def flush(self):
+        """
+        Stop profiling, and write collected statistics.
+        """
+        with self.__lock:
+            self.__cancelTimer()
+            self.__remaining = 0
+            self.__deadline = None
+            profile_dict = self.__profile_dict
+            self.__profile_dict = {}
+        prefix = time.strftime('%Y%m%d-%H%M%S')
+        for instruction, profile in profile_dict.items():
+            path = os.path.join(
+                self._directory,
+                '%s-%i-ins-%s.pstats' % (
+                    prefix,
+                    os.getpid(),
+                    'none' if instruction is None else '%02x' % (instruction, ),
+                ),
+            )
+            try:
+                profile.dump_stats(path)
+            except Exception: # pylint: disable=broad-except
+                logger.exception('Failed to write %r', path)
+            else:
+                logger.info('Wrote profile %r', path)
+
+    def close(self):
+        if self.__remaining:
+            self.flush()
+        if self.__previous_handler is not None:
+            signal.signal(self._signal_number, self.__previous_handler)
+            self.__previous_handler = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class ProfilingCard:
+    """
+    Stands for a card (as far as a reader slot is concerned), running APDUs
+    through an APDUProfiler.
+    """
+    def __init__(self, card, profiler):
+        self._card = card
+        self._profiler = profiler
+
+    def __repr__(self):
+        return '<%s(card=%r) object at %x>' % (
+            self.__class__.__name__,
+            self._card,
+            id(self),
+        )
+
+    def getATR(self):
+        return self._card.getATR()
+
+    def clearVolatile(self):
+        self._card.clearVolatile()
+
+    def runAPDU(self, command):
+        return self._profiler.runAPDU(self._card, command)
+
+def addProfilerArgumentList(parser):
+    """
+    Add profiler options to an argparse parser.
+    """
+    parser.add_argument(
+        '--profile-directory',
+        help='Enable on-demand profiling: on SIGUSR2, profile the next APDUs '
+        'and write statistics (in pstats format, one file per instruction) '
+        'in this directory.',
+    )
+    parser.add_argument(
+        '--profile-apdu-count',
+        type=int,
+        default=100,
+        help='Number of APDUs to profile after receiving SIGUSR2 '
+        '(default: %(default)s).',
+    )
+    parser.add_argument(
+        '--profile-duration',
+        type=float,
+        default=60,
+        help='Maximum number of seconds to profile after receiving SIGUSR2, '
+        '0 for no limit (default: %(default)s).',
+    )
+
+def getAPDUProfiler(args):
+    """
+    Return a (not started) APDUProfiler for options added by
+    addProfilerArgumentList, or None if profiling is disabled.
+    """
+    if args.profile_directory is None:
+        return None
+    return APDUProfiler(
+        directory=os.path.abspath(args.profile_directory),
+        apdu_count=args.profile_apdu_count,
+        duration=args.profile_duration or None,
+    )
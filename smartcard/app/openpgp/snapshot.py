@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2018-2020  Vincent Pelletier <plr.vincent@gmail.com>
+#
+# This file is part of python-smartcard-app-openpgp.
+# python-smartcard-app-openpgp is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# python-smartcard-app-openpgp is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with python-smartcard-app-openpgp.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Warm-start snapshots: the responses a card gives to the read-only commands
+hosts send when a card gets inserted (application selection, public data
+objects, public keys), so they can be served while the card is still being
+loaded from its database.
+
+A snapshot is tied to the database transaction id it was produced from, and
+must be ignored if the database changed since.
+"""
+
+import logging
+import os
+import struct
+import threading
+from smartcard import decodeAPDU
+from smartcard.status import (
+    SUCCESS,
+    APDUException,
+    InstructionConditionsOfUseNotSatisfied,
+    successWithMoreResponseBytes,
+)
+
+logger = logging.getLogger(__name__)
+
+INSTRUCTION_SELECT = 0xa4
+INSTRUCTION_GET_RESPONSE = 0xc0
+
+_SNAPSHOT_MAGIC = b'OPGPSNP1'
+_SNAPSHOT_HEADER = struct.Struct('>8s8sHH')
+_SNAPSHOT_ENTRY_HEADER = struct.Struct('>HI')
+
+_SELECT_OPENPGP = bytes.fromhex('00a4040006d27600012401')
+# Only data objects readable without any authentication may be listed here.
+SNAPSHOT_COMMAND_LIST = (_SELECT_OPENPGP, ) + tuple(
+    bytes.fromhex('00ca' + x)
+    for x in (
+        '004f', # Application identifier
+        '005b', # Name
+        '005e', # Login data
+        '0065', # Cardholder related data
+        '006e', # Application related data
+        '007a', # Security support template
+        '00c4', # PW status bytes
+        '00c5', # Fingerprints
+        '00c6', # CA fingerprints
+        '00cd', # Key generation timestamps
+        '00de', # Key information
+        '00f9', # Key derived function
+        '00fa', # Algorithm information
+        '0101', # Private use 1
+        '0102', # Private use 2
+        '5f2d', # Language preference
+        '5f35', # Sex
+        '5f50', # URL
+        '5f52', # Historical bytes
+        '7f21', # Cardholder certificate
+    )
+) + tuple(
+    # Read public key (GENERATE ASYMMETRIC KEY PAIR, P1=0x81)
+    bytes.fromhex('0047810002' + x + '00')
+    for x in (
+        'b6', # Signature key
+        'b8', # Decryption key
+        'a4', # Authentication key
+    )
+)
+
+def _getCommandKey(head, command_data):
+    return bytes(head) + bytes(command_data)
+
+class CardSnapshot:
+    """
+    Responses of a card to SNAPSHOT_COMMAND_LIST, and its answer-to-reset.
+    """
+    def __init__(self, tid, atr, response_dict):
+        self.tid = tid
+        self.atr = atr
+        self._response_dict = response_dict
+
+    @classmethod
+    def fromCard(cls, card, tid):
+        """
+        Run SNAPSHOT_COMMAND_LIST on card, keeping successful responses.
+        Clears card volatile state before and after: do not call while a host
+        is using this card.
+        tid (bytes)
+            Id of the last transaction committed in the card's database.
+        """
+        card.clearVolatile()
+        response_dict = {}
+        for command in SNAPSHOT_COMMAND_LIST:
+            response = bytes(card.runAPDU(bytearray(command)))
+            # Fetch the rest of long responses.
+            while response[-2] == 0x61:
+                response = response[:-2] + bytes(card.runAPDU(bytearray((
+                    0x00,
+                    INSTRUCTION_GET_RESPONSE,
+                    0x00,
+                    0x00,
+                    response[-1] or 0xff,
+                ))))
+            if response[-2:] == SUCCESS:
+                head, command_data, _ = decodeAPDU(bytearray(command))
+                response_dict[_getCommandKey(head, command_data)] = response
+        atr = bytes(card.getATR())
+        card.clearVolatile()
+        return cls(tid=tid, atr=atr, response_dict=response_dict)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Returns a CardSnapshot instance, or None if there is no usable snapshot
+        at given path.
+        """
+        try:
+            with open(path, 'rb') as snapshot_file:
+                data = snapshot_file.read()
+        except FileNotFoundError:
+            return None
+        try:
+            (
+                magic,
+                tid,
+                atr_length,
+                entry_count,
+            ) = _SNAPSHOT_HEADER.unpack_from(data)
+            if magic != _SNAPSHOT_MAGIC:
+                raise ValueError('bad magic')
+            offset = _SNAPSHOT_HEADER.size
+            atr = data[offset:offset + atr_length]
+            offset += atr_length
+            response_dict = {}
+            for _ in range(entry_count):
+                (
+                    key_length,
+                    response_length,
+                ) = _SNAPSHOT_ENTRY_HEADER.unpack_from(data, offset)
+                offset += _SNAPSHOT_ENTRY_HEADER.size
+                key = data[offset:offset + key_length]
+                offset += key_length
+                response = data[offset:offset + response_length]
+                offset += response_length
+                if len(response) != response_length:
+                    raise ValueError('truncated')
+                response_dict[key] = response
+            if offset != len(data):
+                raise ValueError('trailing data')
+        except (struct.error, ValueError):
+            logger.warning('Ignoring corrupted snapshot %r', path, exc_info=1)
+            return None
+        return cls(tid=tid, atr=atr, response_dict=response_dict)
+
+    def save(self, path):
+        """
+        Atomically replace the snapshot at given path.
+        """
+        chunk_list = [
+            _SNAPSHOT_HEADER.pack(
+                _SNAPSHOT_MAGIC,
+                self.tid,
+                len(self.atr),
+                len(self._response_dict),
+            ),
+            self.atr,
+        ]
+        for key, response in self._response_dict.items():
+            chunk_list.append(_SNAPSHOT_ENTRY_HEADER.pack(
+                len(key),
+                len(response),
+            ))
+            chunk_list.append(key)
+            chunk_list.append(response)
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as snapshot_file:
+            snapshot_file.write(b''.join(chunk_list))
+        os.replace(temp_path, path)
+
+    def getResponse(self, head, command_data):
+        """
+        Returns the full response to given command, or None if it is not part
+        of the snapshot.
+        """
+        return self._response_dict.get(_getCommandKey(head, command_data))
+
+class WarmStartCard:
+    """
+    Stands for a card (as far as a reader slot is concerned) while the actual
+    card is loaded from its database, answering from a snapshot.
+
+    Only basic channel commands present in the snapshot are answered. On any
+    other command, wait for the actual card to be available, transfer the
+    application selection to it, and forward the command. From then on, all
+    calls are forwarded to the actual card.
+    """
+    _card = None
+    _load_error = None
+
+    def __init__(self, snapshot, loadCard=None):
+        """
+        snapshot (CardSnapshot)
+        loadCard (callable)
+            If provided, called without arguments when the actual card is
+            first needed, and returns it. Otherwise, setCard or setLoadError
+            must be called, typically from another thread.
+        """
+        self._snapshot = snapshot
+        self._loadCard = loadCard
+        self._ready = threading.Event()
+        self.__clearVolatile()
+
+    def __clearVolatile(self):
+        self._selected = False
+        self._queue = None
+
+    def setCard(self, card):
+        """
+        To be called once the actual card is loaded. May be called from any
+        thread.
+        """
+        self._card = card
+        self._ready.set()
+
+    def setLoadError(self, exc):
+        """
+        To be called if the actual card could not be loaded. May be called
+        from any thread.
+        """
+        self._load_error = exc
+        self._ready.set()
+
+    def __getCard(self):
+        if not self._ready.is_set():
+            if self._loadCard is None:
+                logger.info('Command not in snapshot, waiting for card to load')
+                self._ready.wait()
+            else:
+                logger.info('Command not in snapshot, loading card')
+                self.setCard(self._loadCard())
+        if self._load_error is not None:
+            raise RuntimeError('Card failed to load') from self._load_error
+        card = self._card
+        if self._snapshot is not None:
+            # First access to the actual card: transfer the application
+            # selection.
+            if self._selected:
+                card.runAPDU(bytearray(_SELECT_OPENPGP))
+            self._snapshot = None
+        return card
+
+    def getATR(self):
+        if self._snapshot is None:
+            return self.__getCard().getATR()
+        return self._snapshot.atr
+
+    def clearVolatile(self):
+        self.__clearVolatile()
+        if self._ready.is_set() and self._load_error is None:
+            self._snapshot = None
+            self._card.clearVolatile()
+
+    def runAPDU(self, command):
+        if self._snapshot is not None:
+            result = self.__runSnapshotAPDU(command)
+            if result is not None:
+                return result
+        return self.__getCard().runAPDU(command)
+
+    def __runSnapshotAPDU(self, command):
+        try:
+            head, command_data, response_len = decodeAPDU(command)
+        except APDUException:
+            return None
+        # Basic channel, no chaining nor secure messaging.
+        if head.klass != 0:
+            return None
+        instruction = head.instruction
+        if self._queue is not None:
+            if instruction == INSTRUCTION_SELECT:
+                return None
+            if instruction != INSTRUCTION_GET_RESPONSE:
+                # Same as what Card does.
+                return InstructionConditionsOfUseNotSatisfied().value
+            if command_data or head.parameter1 or head.parameter2:
+                return None
+            return self.__dequeue(response_len)
+        if instruction != INSTRUCTION_SELECT and not self._selected:
+            return None
+        response = self._snapshot.getResponse(head, command_data)
+        if response is None:
+            return None
+        if instruction == INSTRUCTION_SELECT:
+            self._selected = True
+        if len(response) - 2 > response_len:
+            self._queue = response[:-2]
+            return self.__dequeue(response_len)
+        return bytearray(response)
+
+    def __dequeue(self, response_len):
+        result = self._queue[:response_len]
+        remain = self._queue[response_len:]
+        if remain:
+            self._queue = remain
+            return bytearray(result) + successWithMoreResponseBytes(
+                min(0xff, len(remain)),
+            )
+        self._queue = None
+        return bytearray(result) + SUCCESS
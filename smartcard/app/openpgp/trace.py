@@ -0,0 +1,418 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2018-2020  Vincent Pelletier <plr.vincent@gmail.com>
+#
+# This file is part of python-smartcard-app-openpgp.
+# python-smartcard-app-openpgp is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# python-smartcard-app-openpgp is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with python-smartcard-app-openpgp.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+APDU traces: what a host sent to a card, and how long the card took to
+answer, stored in a fixed-size ring file; and their replay.
+
+Command data is only recorded for instructions known not to carry secrets
+(see RECORDED_DATA_INSTRUCTION_SET), and response data is never recorded:
+only its length and the status word. So a trace contains no PIN, no key
+material, no plaintext.
+"""
+
+from collections import namedtuple
+import logging
+import os
+import random
+import struct
+import time
+from cryptography.hazmat.primitives.asymmetric import x25519
+from cryptography.hazmat.primitives import serialization
+from smartcard import (
+    APDU_HEAD_LENGTH,
+    INSTRUCTION_BERTLV_MASK,
+    INSTRUCTION_GENERATE_ASYMMETRIC_KEY_PAIR,
+    INSTRUCTION_GET_CHALLENGE,
+    INSTRUCTION_GET_DATA,
+    INSTRUCTION_GET_RESPONSE,
+    INSTRUCTION_INTERNAL_AUTHENTICATE,
+    INSTRUCTION_MANAGE_SECURITY_ENVIRONMENT,
+    INSTRUCTION_PERFORM_SECURIY_OPERATION,
+    INSTRUCTION_SELECT,
+    INSTRUCTION_VERIFY,
+    decodeAPDU,
+)
+from . import DEFAULT_PW3
+from .loopback import (
+    KeySet,
+    LoopbackCard,
+    LoopbackOpenPGP,
+    Session,
+    encodeAPDU,
+    encodeECDHCipher,
+    getDigestInfo,
+)
+
+logger = logging.getLogger(__name__)
+
+RECORD_KIND_APDU = 0
+RECORD_KIND_POWER_ON = 1
+RECORD_KIND_POWER_OFF = 2
+
+# Instructions (without their BER-TLV bit) whose command data is recorded.
+RECORDED_DATA_INSTRUCTION_SET = frozenset((
+    INSTRUCTION_GENERATE_ASYMMETRIC_KEY_PAIR,
+    INSTRUCTION_GET_CHALLENGE,
+    INSTRUCTION_GET_DATA,
+    INSTRUCTION_GET_RESPONSE,
+    INSTRUCTION_MANAGE_SECURITY_ENVIRONMENT,
+    INSTRUCTION_SELECT,
+))
+# Longer command data is not recorded, even for the above instructions.
+RECORDED_DATA_MAX_LENGTH = 32
+
+_MAGIC = b'OPGPTRC1'
+# magic, capacity (in records), total number of records ever written
+_HEADER = struct.Struct('>8sIQ')
+# start (seconds since epoch), duration (microseconds), reader, kind, APDU
+# head, command data length, expected response length, response data length,
+# status word, recorded command data length, recorded command data
+_RECORD = struct.Struct('>dIBB4sHIIB2s%is' % (RECORDED_DATA_MAX_LENGTH, ))
+
+TraceRecord = namedtuple(
+    'TraceRecord',
+    (
+        'start',
+        'duration',
+        'reader',
+        'kind',
+        'head',
+        'command_length',
+        'response_length',
+        'response_data_length',
+        'status',
+        'data',
+    ),
+)
+TraceRecord.__doc__ = """
+One traced event.
+start (float): time.time() at which the event started
+duration (float): seconds the card took to handle it
+reader (int): index of the reader the card is inserted in
+kind (int): RECORD_KIND_*
+head (bytes): the 4 bytes of APDU head, for RECORD_KIND_APDU
+command_length (int): command data length
+response_length (int): expected response length (Le)
+response_data_length (int): response length, excluding status word
+status (bytes): the 2 bytes of status word
+data (bytes, or None): command data, None when not recorded
+"""
+
+def _isDataRecorded(instruction):
+    return (
+        instruction & ~INSTRUCTION_BERTLV_MASK
+    ) in RECORDED_DATA_INSTRUCTION_SET
+
+class TraceRecorder:
+    """
+    Appends records to a ring file, overwriting the oldest ones once
+    capacity is reached.
+    """
+    def __init__(self, path, capacity=65536):
+        """
+        path (str)
+            If the file exists and has the same capacity, new records are
+            added to it. Otherwise, it is (re)created.
+        capacity (int)
+            Number of records the file holds.
+        """
+        self.__fd = fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        header = os.pread(fd, _HEADER.size, 0)
+        if len(header) == _HEADER.size:
+            magic, file_capacity, total = _HEADER.unpack(header)
+        else:
+            magic = file_capacity = None
+        if magic != _MAGIC or file_capacity != capacity:
+            os.ftruncate(fd, 0)
+            total = 0
+            os.pwrite(fd, _HEADER.pack(_MAGIC, capacity, total), 0)
+        self.__capacity = capacity
+        self.__total = total
+
+    def append(self, record):
+        total = self.__total
+        os.pwrite(
+            self.__fd,
+            _RECORD.pack(
+                record.start,
+                min(int(record.duration * 1e6), 0xffffffff),
+                record.reader,
+                record.kind,
+                record.head,
+                record.command_length,
+                record.response_length,
+                record.response_data_length,
+                0 if record.data is None else len(record.data),
+                record.status,
+                record.data or b'',
+            ),
+            _HEADER.size + (total % self.__capacity) * _RECORD.size,
+        )
+        self.__total = total = total + 1
+        os.pwrite(self.__fd, _HEADER.pack(_MAGIC, self.__capacity, total), 0)
+
+    def close(self):
+        if self.__fd is not None:
+            os.close(self.__fd)
+            self.__fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def iterTrace(path):
+    """
+    Yield TraceRecord instances from given ring file, oldest first.
+    """
+    with open(path, 'rb') as trace_file:
+        magic, capacity, total = _HEADER.unpack(
+            trace_file.read(_HEADER.size),
+        )
+        if magic != _MAGIC:
+            raise ValueError('%r is not a trace file' % (path, ))
+        if total > capacity:
+            first = total % capacity
+            index_list = list(range(first, capacity)) + list(range(first))
+        else:
+            index_list = range(total)
+        for index in index_list:
+            trace_file.seek(_HEADER.size + index * _RECORD.size)
+            (
+                start,
+                duration,
+                reader,
+                kind,
+                head,
+                command_length,
+                response_length,
+                response_data_length,
+                data_length,
+                status,
+                data,
+            ) = _RECORD.unpack(trace_file.read(_RECORD.size))
+            yield TraceRecord(
+                start=start,
+                duration=duration / 1e6,
+                reader=reader,
+                kind=kind,
+                head=head,
+                command_length=command_length,
+                response_length=response_length,
+                response_data_length=response_data_length,
+                status=status,
+                data=(
+                    data[:data_length]
+                    if data_length or not command_length else
+                    None
+                ),
+            )
+
+class TracingCard:
+    """
+    Stands for a card (as far as a reader slot is concerned), recording
+    every power change and APDU to a TraceRecorder.
+    """
+    def __init__(self, card, recorder, reader=0):
+        self._card = card
+        self._recorder = recorder
+        self._reader = reader
+
+    def __repr__(self):
+        return '<%s(card=%r) object at %x>' % (
+            self.__class__.__name__,
+            self._card,
+            id(self),
+        )
+
+    def __record(self, kind, start, duration, **kw):
+        record = TraceRecord(
+            start=start,
+            duration=duration,
+            reader=self._reader,
+            kind=kind,
+            **kw
+        )
+        try:
+            self._recorder.append(record)
+        except Exception: # pylint: disable=broad-except
+            logger.exception('Failed to record APDU trace')
+
+    def getATR(self):
+        start = time.time()
+        before = time.perf_counter()
+        result = self._card.getATR()
+        self.__record(
+            kind=RECORD_KIND_POWER_ON,
+            start=start,
+            duration=time.perf_counter() - before,
+            head=b'\x00' * APDU_HEAD_LENGTH,
+            command_length=0,
+            response_length=0,
+            response_data_length=len(result),
+            status=b'\x00\x00',
+            data=b'',
+        )
+        return result
+
+    def clearVolatile(self):
+        start = time.time()
+        before = time.perf_counter()
+        self._card.clearVolatile()
+        self.__record(
+            kind=RECORD_KIND_POWER_OFF,
+            start=start,
+            duration=time.perf_counter() - before,
+            head=b'\x00' * APDU_HEAD_LENGTH,
+            command_length=0,
+            response_length=0,
+            response_data_length=0,
+            status=b'\x00\x00',
+            data=b'',
+        )
+
+    def runAPDU(self, command):
+        start = time.time()
+        before = time.perf_counter()
+        result = self._card.runAPDU(command)
+        duration = time.perf_counter() - before
+        head = bytes(command[:APDU_HEAD_LENGTH]).ljust(APDU_HEAD_LENGTH, b'\x00')
+        try:
+            _, command_data, response_length = decodeAPDU(command)
+        except Exception: # pylint: disable=broad-except
+            command_data = command[APDU_HEAD_LENGTH:]
+            response_length = 0
+        self.__record(
+            kind=RECORD_KIND_APDU,
+            start=start,
+            duration=duration,
+            head=head,
+            command_length=len(command_data),
+            response_length=response_length,
+            response_data_length=len(result) - 2,
+            status=bytes(result[-2:]),
+            data=(
+                bytes(command_data)
+                if (
+                    _isDataRecorded(head[1]) and
+                    len(command_data) <= RECORDED_DATA_MAX_LENGTH
+                ) else
+                None
+            ),
+        )
+        return result
+
+class _CommandSynthesizer:
+    """
+    Builds stand-in command data for commands whose data was not recorded,
+    deterministically from seed. Knows the PINs and keys of cards prepared
+    by replay.
+    """
+    def __init__(self, loopback_card, seed):
+        self.__loopback_card = loopback_card
+        self.__random = random.Random(seed)
+
+    def __getRandomBytes(self, length):
+        return self.__random.getrandbits(length * 8).to_bytes(length, 'big')
+
+    def __call__(self, record):
+        """
+        Returns command data, or None if the command cannot be replayed.
+        """
+        instruction = record.head[1]
+        p1p2 = record.head[2:]
+        if instruction == INSTRUCTION_VERIFY:
+            if record.head[3] == 0x83:
+                return DEFAULT_PW3
+            return self.__loopback_card.getPW1()
+        if instruction == INSTRUCTION_PERFORM_SECURIY_OPERATION:
+            if p1p2 == b'\x9e\x9a':
+                return getDigestInfo(self.__getRandomBytes(32))[1]
+            if p1p2 == b'\x80\x86':
+                return encodeECDHCipher(
+                    x25519.X25519PrivateKey.from_private_bytes(
+                        self.__getRandomBytes(32),
+                    ).public_key().public_bytes(
+                        encoding=serialization.Encoding.Raw,
+                        format=serialization.PublicFormat.Raw,
+                    ),
+                )
+            return None
+        if instruction == INSTRUCTION_INTERNAL_AUTHENTICATE:
+            return getDigestInfo(self.__getRandomBytes(32))[1]
+        # Data-modifying commands (PUT DATA, CHANGE REFERENCE DATA...):
+        # replaying them with made-up data would diverge from the traced
+        # card state.
+        return None
+
+def replay(
+    record_iterable,
+    reader=0,
+    openpgp_class=LoopbackOpenPGP,
+    seed=0,
+    recorder=None,
+):
+    """
+    Replay the APDU and power records of given reader on a fresh card,
+    with keys and default PINs.
+    Command data which was not recorded is replaced by equivalent data
+    valid for that card (see _CommandSynthesizer). Commands which cannot
+    be synthesized are skipped.
+    recorder (TraceRecorder, or None)
+        Where to trace the replay, for later comparison.
+    Yields (record, replayed_record) tuples, replayed_record being None
+    for skipped commands.
+    """
+    with LoopbackCard(openpgp_class=openpgp_class) as loopback_card:
+        Session(loopback_card, KeySet()).run('keytocard')
+        loopback_card.powerOn()
+        synthesize = _CommandSynthesizer(loopback_card, seed)
+        replayed_record_list = []
+        class Recorder:
+            @staticmethod
+            def append(replayed_record):
+                replayed_record_list.append(replayed_record)
+                if recorder is not None:
+                    recorder.append(replayed_record)
+        card = TracingCard(
+            card=loopback_card.card,
+            recorder=Recorder,
+            reader=reader,
+        )
+        for record in record_iterable:
+            if record.reader != reader:
+                continue
+            if record.kind == RECORD_KIND_POWER_ON:
+                card.getATR()
+            elif record.kind == RECORD_KIND_POWER_OFF:
+                card.clearVolatile()
+            else:
+                data = record.data
+                if data is None:
+                    data = synthesize(record)
+                    if data is None:
+                        yield record, None
+                        continue
+                klass, instruction, p1, p2 = record.head
+                card.runAPDU(bytearray(encodeAPDU(
+                    klass, instruction, p1, p2,
+                    data,
+                    le=record.response_length or None,
+                )))
+            yield record, replayed_record_list.pop()
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2018-2020  Vincent Pelletier <plr.vincent@gmail.com>
+#
+# This file is part of python-smartcard-app-openpgp.
+# python-smartcard-app-openpgp is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# python-smartcard-app-openpgp is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with python-smartcard-app-openpgp.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Golden image tests for the random PIN display screens, rendered by
+"smartcard-openpgp-benchmark display".
+
+Reference images in golden/display/ were recorded with:
+  smartcard-openpgp-benchmark display --count 1 \\
+    --font /usr/share/fonts/truetype/dejavu/DejaVuSansMono.ttf \\
+    --golden tests/golden/display --record-golden
+They depend on the font file and on the freetype version, and are skipped
+when the font is missing.
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import unittest
+try:
+    from smartcard.app.openpgp.cli.randpin import screen
+except ImportError: # freetype missing
+    screen = None
+from smartcard.app.openpgp.cli import benchmark
+
+GOLDEN_DIRECTORY = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    'golden',
+    'display',
+)
+FONT_PATH = '/usr/share/fonts/truetype/dejavu/DejaVuSansMono.ttf'
+
+@unittest.skipIf(screen is None, 'randpin dependencies missing')
+@unittest.skipIf(not os.path.exists(FONT_PATH), '%s missing' % (FONT_PATH, ))
+class DisplayGoldenTests(unittest.TestCase):
+    def _run(self, count):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            try:
+                benchmark.benchmarkDisplay(argparse.Namespace(
+                    count=count,
+                    font=FONT_PATH,
+                    frame_path=None,
+                    golden=GOLDEN_DIRECTORY,
+                    record_golden=False,
+                ))
+            except SystemExit:
+                self.fail(output.getvalue())
+
+    def test_firstFrame(self):
+        self._run(count=1)
+
+    def test_countIndependent(self):
+        # Golden images are of the first frame of each kind.
+        self._run(count=12)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,358 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2018-2020  Vincent Pelletier <plr.vincent@gmail.com>
+#
+# This file is part of python-smartcard-app-openpgp.
+# python-smartcard-app-openpgp is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# python-smartcard-app-openpgp is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with python-smartcard-app-openpgp.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Golden image tests for the e-Paper framebuffer drawing primitives.
+
+Reference images in golden/framebuffer/ were rendered by the original,
+pixel-by-pixel, framebuffer implementation. Every implementation must
+render them identically, except for the scenes listed in
+ACCEPTED_CHANGE_DICT, which must match their ".accepted.pbm" image instead.
+
+Text scenes depend on the font file and on the freetype version, and are
+skipped when the font is missing.
+
+Run with:
+  python -m unittest discover -s tests
+"""
+
+import os
+import unittest
+try:
+    from smartcard.app.openpgp.cli.randpin import framebuffer
+    from smartcard.app.openpgp.cli.randpin.headless import (
+        getImageRowList,
+        getPBM,
+    )
+except ImportError: # freetype missing
+    framebuffer = None
+
+GOLDEN_DIRECTORY = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    'golden',
+    'framebuffer',
+)
+FONT_PATH = '/usr/share/fonts/truetype/dejavu/DejaVuSansMono.ttf'
+# Same geometry as the e-Paper display framebuffer.
+WIDTH = 250
+HEIGHT = 122
+
+# Scenes whose rendering intentionally changed, with the reason.
+ACCEPTED_CHANGE_DICT = {
+    'line-on': 'Sloped lines use integer error stepping, which resolves '
+        'exact half-pixel ties consistently, where float error accumulation '
+        'picked either side.',
+    'line-off': 'Same as line-on.',
+    'line-xor': 'Same as line-on.',
+    'circle-fill-xor': 'Filled circles paint each column once. They used to '
+        'paint overlapping half-columns, which XOR cancelled out.',
+}
+
+def drawBackground(fb):
+    """
+    Draw a checkerboard with putPixel, so drawing in any color shows.
+    """
+    for x in range(WIDTH):
+        for y in range(HEIGHT):
+            if (x // 3 + y // 5) & 1:
+                fb.putPixel(x, y)
+
+def drawRectOutline(fb, color, face): # pylint: disable=unused-argument
+    for ax, ay, bx, by in (
+        (0, 0, 249, 121),
+        (5, 5, 40, 30),
+        (45, 3, 46, 60),
+        (50, 8, 90, 15),
+        (95, 20, 96, 21),
+        (100, 40, 180, 100),
+        (185, 7, 245, 9),
+        (190, 30, 240, 118),
+    ):
+        fb.rect(ax, ay, bx, by, color=color)
+
+def drawRectFill(fb, color, face): # pylint: disable=unused-argument
+    for ax, ay, bx, by in (
+        (5, 5, 40, 30),
+        (45, 3, 46, 60),
+        (50, 8, 90, 15),
+        (95, 20, 96, 21),
+        (100, 40, 180, 100),
+        (185, 7, 245, 9),
+        (190, 30, 240, 118),
+        (10, 70, 60, 110),
+        (30, 90, 80, 116),
+    ):
+        fb.rect(ax, ay, bx, by, color=color, fill=True)
+
+def _drawCircleList(fb, color, fill):
+    for x, y, r in (
+        (60, 60, 0),
+        (60, 60, 1),
+        (60, 60, 2),
+        (60, 60, 5),
+        (60, 60, 20),
+        (60, 60, 40),
+        (20, 20, 15),
+        (180, 60, 50),
+        (215, 95, 17),
+    ):
+        fb.circle(x, y, r, color=color, fill=fill)
+
+def drawCircleOutline(fb, color, face): # pylint: disable=unused-argument
+    _drawCircleList(fb, color, fill=False)
+
+def drawCircleFill(fb, color, face): # pylint: disable=unused-argument
+    _drawCircleList(fb, color, fill=True)
+
+def drawLine(fb, color, face): # pylint: disable=unused-argument
+    center_x = 125
+    center_y = 61
+    # Endpoints on a rectangle around the center, for all kinds of slopes,
+    # including exact 1:2 and 2:1 ones.
+    for x in range(5, 246, 12):
+        fb.line(center_x, center_y, x, 2, color=color)
+        fb.line(x, 119, center_x, center_y, color=color)
+    for y in range(2, 120, 9):
+        fb.line(center_x, center_y, 5, y, color=color)
+        fb.line(245, y, center_x, center_y, color=color)
+    fb.line(10, 60, 10, 60, color=color)
+    fb.line(20, 100, 60, 100, color=color)
+    fb.line(200, 10, 200, 50, color=color)
+
+def drawText(fb, color, face):
+    fb.printLineAt(face, 2, 2, 'AVAWa.0123456789', height=12, color=color)
+    fb.printLineAt(face, 2, 16, 'Tries: 3 gjpqy', height=16, color=color)
+    fb.printLineAt(face, 2, 34, 'Ready, unplugged', height=24, color=color)
+    fb.printLineAt(face, 150, 60, 'clipped text', width=60, color=color)
+    fb.printAt(
+        face,
+        2, 62,
+        'Multi-line text\nwith a newline, wrapped to width',
+        width=140,
+        line_height=14,
+        color=color,
+    )
+
+SCENE_DICT = {
+    'rect-outline': drawRectOutline,
+    'rect-fill': drawRectFill,
+    'circle-outline': drawCircleOutline,
+    'circle-fill': drawCircleFill,
+    'line': drawLine,
+    'text': drawText,
+}
+
+def getSceneNameList():
+    """
+    Return the golden image names, one per scene and color.
+    """
+    return [
+        '%s-%s' % (scene, color_name)
+        for scene in SCENE_DICT
+        for color_name in ('on', 'off', 'xor')
+    ]
+
+def render(framebuffer_class, name, face):
+    """
+    Render given scene with given Framebuffer class, and return it as a PBM
+    image.
+    """
+    scene, color_name = name.rsplit('-', 1)
+    fb = framebuffer_class(width=WIDTH, height=HEIGHT)
+    drawBackground(fb)
+    SCENE_DICT[scene](
+        fb,
+        {
+            'on': framebuffer_class.COLOR_ON,
+            'off': framebuffer_class.COLOR_OFF,
+            'xor': framebuffer_class.COLOR_XOR,
+        }[color_name],
+        face,
+    )
+    return getPBM(
+        getImageRowList(bytes(fb.pixelbuffer), WIDTH, HEIGHT),
+        WIDTH,
+    )
+
+def _getPixelDifferenceCount(image_a, image_b):
+    return sum(
+        bin(a ^ b).count('1')
+        for a, b in zip(image_a, image_b)
+    )
+
+def _readGolden(name):
+    with open(os.path.join(GOLDEN_DIRECTORY, name + '.pbm'), 'rb') as image:
+        return image.read()
+
+@unittest.skipIf(framebuffer is None, 'randpin dependencies missing')
+class FramebufferGoldenTests(unittest.TestCase):
+    def _getFramebufferClassList(self):
+        result = [framebuffer.BytearrayFramebuffer]
+        if framebuffer.numpy is not None:
+            result.append(framebuffer.NumPyFramebuffer)
+        return result
+
+    def _getFace(self, name):
+        if not name.startswith('text-'):
+            return None
+        if not os.path.exists(FONT_PATH):
+            self.skipTest('%s missing' % (FONT_PATH, ))
+        return framebuffer.freetype.Face(FONT_PATH)
+
+    def _checkScene(self, name):
+        face = self._getFace(name)
+        golden = _readGolden(name)
+        if name in ACCEPTED_CHANGE_DICT:
+            accepted = _readGolden(name + '.accepted')
+            # Otherwise, the entry is not needed anymore.
+            self.assertNotEqual(golden, accepted)
+            golden = accepted
+        for framebuffer_class in self._getFramebufferClassList():
+            with self.subTest(framebuffer_class=framebuffer_class.__name__):
+                image = render(framebuffer_class, name, face)
+                self.assertTrue(
+                    image == golden,
+                    '%i pixels differ' % (
+                        _getPixelDifferenceCount(image, golden),
+                    ),
+                )
+
+@unittest.skipIf(framebuffer is None, 'randpin dependencies missing')
+class FramebufferEdgeTests(unittest.TestCase):
+    """
+    Drawing partly or wholly off-screen, or with unordered coordinates.
+    """
+    _getFramebufferClassList = FramebufferGoldenTests._getFramebufferClassList
+
+    def _getFramebuffer(self, framebuffer_class):
+        fb = framebuffer_class(width=WIDTH, height=HEIGHT)
+        drawBackground(fb)
+        fb.popDirtyRect()
+        return fb
+
+    def _assertSameFramebuffer(self, fb, reference):
+        self.assertEqual(bytes(fb.pixelbuffer), bytes(reference.pixelbuffer))
+        self.assertEqual(fb.popDirtyRect(), reference.popDirtyRect())
+
+    def test_rectCornerOrder(self):
+        for framebuffer_class in self._getFramebufferClassList():
+            for color in (-1, 0, 1):
+                for fill in (False, True):
+                    for ax, ay, bx, by in (
+                        (50, 60, 10, 20),
+                        (50, 20, 10, 60),
+                        (10, 60, 50, 20),
+                    ):
+                        with self.subTest(
+                            framebuffer_class=framebuffer_class.__name__,
+                            color=color,
+                            fill=fill,
+                            corners=(ax, ay, bx, by),
+                        ):
+                            reference = self._getFramebuffer(framebuffer_class)
+                            reference.rect(
+                                10, 20, 50, 60,
+                                color=color,
+                                fill=fill,
+                            )
+                            fb = self._getFramebuffer(framebuffer_class)
+                            fb.rect(ax, ay, bx, by, color=color, fill=fill)
+                            self._assertSameFramebuffer(fb, reference)
+
+    def test_rectFlat(self):
+        for framebuffer_class in self._getFramebufferClassList():
+            for color in (-1, 0, 1):
+                for ax, ay, bx, by in (
+                    (10, 20, 50, 20),
+                    (50, 20, 10, 20),
+                    (30, 5, 30, 40),
+                    (30, 40, 30, 5),
+                    (7, 7, 7, 7),
+                ):
+                    with self.subTest(
+                        framebuffer_class=framebuffer_class.__name__,
+                        color=color,
+                        corners=(ax, ay, bx, by),
+                    ):
+                        # The outline of a flat rectangle is the whole
+                        # rectangle: each pixel painted once, none outside.
+                        fb = self._getFramebuffer(framebuffer_class)
+                        fb.rect(ax, ay, bx, by, color=color)
+                        reference = self._getFramebuffer(framebuffer_class)
+                        reference.rect(ax, ay, bx, by, color=color, fill=True)
+                        self._assertSameFramebuffer(fb, reference)
+
+    def _checkBlit(self, framebuffer_class, blit, x, y, line_length, data):
+        fb = self._getFramebuffer(framebuffer_class)
+        getattr(fb, blit)(x, y, line_length, data, framebuffer_class.COLOR_XOR)
+        # putPixel clips each pixel.
+        reference = self._getFramebuffer(framebuffer_class)
+        stride = ((line_length + 7) >> 3) << 3
+        for index in range(len(data) * 8):
+            line, offset = divmod(index, stride)
+            if offset < line_length and data[index >> 3] >> (index & 7) & 1:
+                if blit == 'blitRowImage':
+                    pixel = (x + offset, y + line)
+                else:
+                    pixel = (x + line, y + offset)
+                reference.putPixel(*pixel, color=framebuffer_class.COLOR_XOR)
+        self.assertEqual(bytes(fb.pixelbuffer), bytes(reference.pixelbuffer))
+        # The whole on-screen part of the image is dirty, not more.
+        x_min, x_max, y_min, y_max = fb.popDirtyRect()
+        self.assertLessEqual(0, x_min)
+        self.assertLessEqual(x_max, WIDTH)
+        self.assertLessEqual(0, y_min)
+        self.assertLessEqual(y_max, (HEIGHT + 7) >> 3)
+        ref_x_min, ref_x_max, ref_y_min, ref_y_max = reference.popDirtyRect()
+        if ref_x_min < ref_x_max:
+            self.assertLessEqual(x_min, ref_x_min)
+            self.assertLessEqual(ref_x_max, x_max)
+            self.assertLessEqual(y_min, ref_y_min)
+            self.assertLessEqual(ref_y_max, y_max)
+
+    def test_blitClipped(self):
+        data = bytes(range(0x5a, 0x5a + 24))
+        for framebuffer_class in self._getFramebufferClassList():
+            for blit in ('blitRowImage', 'blitColumnImage'):
+                for x, y in (
+                    (5, HEIGHT - 4),
+                    (WIDTH - 4, 5),
+                    (WIDTH - 4, HEIGHT - 4),
+                    (-4, -4),
+                    (-20, 5),
+                    (5, HEIGHT + 2),
+                ):
+                    with self.subTest(
+                        framebuffer_class=framebuffer_class.__name__,
+                        blit=blit,
+                        x=x,
+                        y=y,
+                    ):
+                        self._checkBlit(framebuffer_class, blit, x, y, 12, data)
+
+def _addSceneTest(name):
+    def test(self):
+        self._checkScene(name) # pylint: disable=protected-access
+    test.__name__ = 'test_' + name.replace('-', '_')
+    setattr(FramebufferGoldenTests, test.__name__, test)
+
+for _name in getSceneNameList():
+    _addSceneTest(_name)
+del _name
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2018-2020  Vincent Pelletier <plr.vincent@gmail.com>
+#
+# This file is part of python-smartcard-app-openpgp.
+# python-smartcard-app-openpgp is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# python-smartcard-app-openpgp is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with python-smartcard-app-openpgp.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for ZODB cache caps applied under memory pressure.
+"""
+
+import unittest
+from smartcard.app.openpgp import loopback
+
+class CacheCapTests(unittest.TestCase):
+    def _runScenarios(self, openpgp_class, cache_size):
+        with loopback.LoopbackCard(openpgp_class=openpgp_class) as card:
+            card.getDatabase().setCacheSize(cache_size)
+            session = loopback.runScenarios(
+                iterations=1,
+                loopback_card=card,
+            )
+            self.assertEqual(session.failure_list, [])
+            self.assertLessEqual(card.getDatabase().cacheSize(), cache_size)
+
+    def test_sessionSurvivesEviction(self):
+        # Much smaller than a card's working set: the card itself gets
+        # ghostified between commands.
+        for openpgp_class in (
+            loopback.LoopbackOpenPGP,
+            loopback.LoopbackOpenPGPRandomPassword,
+        ):
+            with self.subTest(openpgp_class=openpgp_class.__name__):
+                self._runScenarios(openpgp_class, cache_size=2)
+
+if __name__ == '__main__':
+    unittest.main()